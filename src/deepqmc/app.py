@@ -1,5 +1,4 @@
 import logging
-import pickle
 import sys
 import warnings
 from pathlib import Path
@@ -34,7 +33,9 @@ def instantiate_ansatz(hamil, ansatz):
 
     return hk.without_apply_rng(
         hk.transform(
-            lambda phys_conf, return_mos=False: ansatz(hamil)(phys_conf, return_mos)
+            lambda phys_conf, return_mos=False, geometry=None: ansatz(hamil)(
+                phys_conf, return_mos, geometry=geometry
+            )
         )
     )
 
@@ -52,10 +53,12 @@ def train_from_checkpoint(workdir, restdir, evaluate, chkpt='LAST', **kwargs):
     restdir = Path(to_absolute_path(get_original_cwd())) / restdir
     if not restdir.is_dir():
         raise ValueError(f'restdir {restdir!r} is not a directory')
-    cfg, step, train_state = task_from_workdir(restdir, chkpt)
+    # the optimizer state is not needed for the evaluation
+    parts = ('sampler', 'params') if evaluate else None
+    cfg, step, train_state = task_from_workdir(restdir, chkpt, parts)
     while cfg.task.get('restdir', False):
         restdir = Path(to_absolute_path(get_original_cwd())) / cfg.task.restdir
-        cfg, *_ = task_from_workdir(restdir, chkpt)
+        cfg, *_ = task_from_workdir(restdir, chkpt, ())
     log.info(f'Found original config file in {restdir}')
     cfg.task.workdir = workdir
     if evaluate:
@@ -66,21 +69,25 @@ def train_from_checkpoint(workdir, restdir, evaluate, chkpt='LAST', **kwargs):
     call(cfg['task'], _convert_='all', train_state=train_state, **kwargs)
 
 
-def task_from_workdir(workdir, chkpt):
-    from .train import CheckpointStore
+def task_from_workdir(workdir, chkpt, parts=None):
+    from .log import CheckpointStore, load_checkpoint
 
     workdir = Path(workdir)
     assert workdir.is_dir()
     cfg = OmegaConf.load(workdir / '.hydra/config.yaml')
     if chkpt == 'LAST':
-        chkpts = list(workdir.glob(CheckpointStore.PATTERN.format('*')))
-        if not chkpts:
-            chkpts = (workdir / 'training').glob(CheckpointStore.PATTERN.format('*'))
-        chkpt = sorted(chkpts)[-1]
+        for chkptdir in [workdir, workdir / 'training']:
+            chkpts = [
+                p
+                for pattern in [CheckpointStore.PATTERN, CheckpointStore.PICKLE_PATTERN]
+                for p in chkptdir.glob(pattern.format('*'))
+            ]
+            if chkpts:
+                break
+        chkpt = max(chkpts, key=lambda p: int(p.stem.split('-')[-1]))
     else:
         chkpt = workdir / chkpt
-    with open(chkpt, 'rb') as f:
-        step, train_state = pickle.load(f)
+    step, train_state = load_checkpoint(chkpt, parts)
     return cfg, step, train_state
 
 
@@ -7,11 +7,11 @@ import jax.numpy as jnp
 __all__ = ()
 
 EWMState = namedtuple(
-    'EWMState', 'step params buffer mean var sqerr', defaults=6 * [None]
+    'EWMState', 'step params mean var sqerr moments', defaults=6 * [None]
 )
 
 
-def init_ewm(
+def ewm_params(
     max_alpha=0.999,
     decay_alpha=10,
     window_size=None,
@@ -20,59 +20,117 @@ def init_ewm(
 ):
     if window_size is None:
         window_size = ceil(decay_alpha * (1 / (1 - max_alpha) - 2))
-    state = EWMState(
-        step=0,
-        params={
-            'clip': clip,
-            'max_alpha': max_alpha,
-            'decay_alpha': decay_alpha,
-            'alpha': jnp.zeros(window_size),
-        },
-        buffer=jnp.zeros(window_size),
+    return {
+        'clip': clip,
+        'max_alpha': max_alpha,
+        'decay_alpha': decay_alpha,
+        'window_size': window_size,
+    }
+
+
+def update_ewm_state(x, state):
+    r"""Add a value to the exponentially weighted moving average.
+
+    The weight of a new value decays from 1/2 to :data:`1 - max_alpha` over the
+    first :data:`window_size` steps. The mean, the variance and the squared error
+    of the mean are updated recursively at a constant cost per step, using the
+    weighted sums of squared weights of the deviations from the mean. Beyond the
+    first :data:`window_size` steps, the values keep decaying geometrically. The
+    leaves of the state can be arrays of independent averages.
+    """
+    params = state.params
+    step = jnp.minimum(state.step, params['window_size'] - 2)
+    alpha = jnp.maximum(1 - params['max_alpha'], 1 / (2 + step / params['decay_alpha']))
+    var, sqweight, sqweight_dev, sqerr = state.moments
+    dev = x - state.mean
+    shift = alpha * dev
+    decay = (1 - alpha) ** 2
+    # the sums over the previous values are shifted to the new mean
+    sqweight_dev, sqerr = (
+        decay * (sqweight_dev - shift * sqweight) + alpha**2 * (1 - alpha) * dev,
+        decay * (sqerr - 2 * shift * sqweight_dev + shift**2 * sqweight)
+        + (alpha * (1 - alpha) * dev) ** 2,
     )
+    sqweight = decay * sqweight + alpha**2
+    var = (1 - alpha) * (var + alpha * dev**2)
+    return state._replace(
+        step=state.step + 1,
+        mean=state.mean + shift,
+        var=var,
+        sqerr=sqerr,
+        moments=(var, sqweight, sqweight_dev, sqerr),
+    )
+
+
+def first_ewm_state(x, state):
+    r"""Start the exponentially weighted moving average with a value."""
+    zeros, ones = jnp.zeros_like(x), jnp.ones_like(x)
+    return state._replace(
+        step=jnp.zeros_like(x, dtype=int),
+        mean=x,
+        var=ones,
+        sqerr=ones,
+        moments=(zeros, ones, zeros, zeros),
+    )
+
+
+def init_ewm(**kwargs):
+    r"""Initialize the exponentially weighted moving average of a scalar.
+
+    Args:
+        kwargs: the parameters of the average, see :func:`ewm_params`.
+
+    Returns:
+        tuple: the initial state, whose :data:`mean` is :data:`None`, and a jitted
+        function updating the state with a new value.
+    """
+    state = EWMState(step=0, params=ewm_params(**kwargs))
 
     @jax.jit
     def update(x, state):
-        clip, max_alpha, decay_alpha, alpha = (
-            state.params['clip'],
-            state.params['max_alpha'],
-            state.params['decay_alpha'],
-            state.params['alpha'],
-        )
         if state.mean is None:
-            state.params['alpha'] = state.params['alpha'].at[0].set(1.0)
-            return state._replace(
-                buffer=state.buffer.at[0].set(x),
-                step=0,
-                mean=x,
-                var=jnp.array(1.0),
-                sqerr=jnp.array(1.0),
-            )
-        buffer = jnp.concatenate([x[None], state.buffer[:-1]])
-        alpha = jax.lax.cond(
-            state.step + 1 >= len(alpha),
-            lambda: alpha,
-            lambda: jnp.concatenate(
-                [
-                    jnp.maximum(1 - max_alpha, 1 / (2 + state.step / decay_alpha))[
-                        None
-                    ],
-                    alpha[:-1],
-                ]
-            ),
+            return first_ewm_state(x, state)
+        return update_ewm_state(x, state)
+
+    return state, update
+
+
+def init_batched_ewm(n, **kwargs):
+    r"""Initialize independent exponentially weighted moving averages.
+
+    The averages are updated in a single call, e.g., one per molecule. The mean,
+    variance and squared error of an average without values are :data:`nan`.
+
+    Args:
+        n (int): the number of averages.
+        kwargs: the parameters of the averages, see :func:`ewm_params`.
+
+    Returns:
+        tuple: the initial state, and a jitted function updating the state with an
+        array of new values, which skips the averages whose values are :data:`nan`.
+    """
+    nans = jnp.full(n, jnp.nan)
+    state = EWMState(
+        step=jnp.full(n, -1),
+        params=ewm_params(**kwargs),
+        mean=nans,
+        var=nans,
+        sqerr=nans,
+        moments=4 * (nans,),
+    )
+
+    @jax.jit
+    def update(x, state):
+        new = jax.tree_util.tree_map(
+            lambda first, updated: jnp.where(state.step < 0, first, updated),
+            first_ewm_state(x, state)._replace(params=None),
+            update_ewm_state(x, state)._replace(params=None),
         )
-        beta = jnp.concatenate([jnp.array([1.0]), jnp.cumprod(1 - alpha[:-1])])
-        weights = alpha * beta
-        mean = (weights * buffer).sum()
-        variance = weights * (buffer - mean) ** 2
-        state.params['alpha'] = alpha
-        state.params['clip'] = clip
-        return state._replace(
-            step=state.step + 1,
-            buffer=buffer,
-            mean=mean,
-            var=variance.sum(),
-            sqerr=(weights * variance).sum(),
+        new = jax.tree_util.tree_map(
+            lambda new, old: jnp.where(jnp.isnan(x), old, new),
+            new,
+            state._replace(params=None),
         )
+        return new._replace(params=state.params)
 
     return state, update
@@ -1,16 +1,29 @@
 from collections import namedtuple
 from functools import partial
+from itertools import islice
 
 import haiku as hk
 import jax
 import jax.numpy as jnp
 import kfac_jax
 import optax
+from jax import lax
 
 from .kfacext import make_graph_patterns
+from .parallel import (
+    DEVICE_AXIS,
+    all_device_gather,
+    all_device_mean,
+    gather_on_one_device,
+    pmap,
+    replicate_on_devices,
+    select_device_walkers,
+    select_one_device,
+    split_on_devices,
+)
+from .precision import cast_to_output
 from .utils import (
-    exp_normalize_mean,
-    masked_mean,
+    chunked_vmap,
     per_mol_stats,
     segment_nanmean,
     tree_norm,
@@ -75,37 +88,119 @@ def fit_wf(  # noqa: C901
     *,
     clip_mask_fn=None,
     clip_mask_kwargs=None,
+    smpl_stats_level='full',
+    smpl_stats_every=1,
+    sharded=False,
+    pipelined=False,
+    local_energy_kwargs=None,
+    chunk_size=None,
+    fused_steps=None,
 ):
+    r"""Fit or sample a wave function.
+
+    In the sharded mode the walkers are split equally across all local devices,
+    each of which samples its walkers and evaluates their local energies and
+    gradients, while the parameters and optimizer state are replicated. The
+    gradients, the optimizer statistics and the reported statistics are reduced
+    across the devices, and the local energies are clipped and the walkers are
+    weighted based on the walkers of all devices, such that the training agrees
+    with the unsharded one. The yielded training states always hold the walkers of
+    all devices and a single copy of the parameters, independent of the devices.
+
+    In the pipelined mode the walkers used in a training step are sampled with
+    the parameters of the previous step, so that the sampling of the walkers for
+    the next step does not depend on the optimizer step. Both are compiled into
+    a single program, in which they can run concurrently. The walkers are
+    reweighted to the current parameters with the weights of
+    :class:`~deepqmc.sampling.ResampledSampler`, which therefore has to be part
+    of the sampler chain. The pipelined mode requires an optimizer and is not
+    supported with a sharded KFAC.
+
+    The :data:`local_energy_kwargs` are passed to the
+    :meth:`~deepqmc.hamil.Hamiltonian.local_energy` of the Hamiltonian, e.g., to
+    estimate the Laplacian stochastically.
+
+    Without an optimizer, the local energies evaluated by the sampler, e.g., by
+    :class:`~deepqmc.sampling.LangevinSampler` with :data:`local_energy=True`, are
+    reused instead of being evaluated again.
+
+    If :data:`chunk_size` is specified, the local energies are evaluated
+    sequentially in chunks of this many walkers, which bounds the memory required
+    by the Laplacians independently of the sample size. With :data:`optax`
+    optimizers, the same applies to the derivatives of the wave function with
+    respect to its parameters, whereas KFAC evaluates them for the whole batch,
+    since its curvature estimate relies on the layers registered in a single
+    evaluation. The results agree with the evaluation of the whole batch at once.
+
+    If :data:`fused_steps` is specified, this many consecutive steps are compiled
+    into a single program, which returns to Python only once per block of steps.
+    This avoids the dispatch overhead of the individual steps, which dominates for
+    small systems. A single tuple is yielded per block, containing the index,
+    training state and statistics of its last step, while the local energies of
+    all steps of the block are stacked along a leading axis and transferred to the
+    host at once. The statistics additionally contain the wave function values of
+    the walkers after each step of the block under :data:`psi`. The sampling
+    statistics of the last step are computed if :data:`smpl_stats_every` divides
+    the index of any step of the block. The results agree with the unfused steps.
+    """
     stats_fn = partial(per_mol_stats, len(sampler))
+    # KFAC cannot register the layers of the wave function inside a loop
+    jvp_chunk_size = (
+        chunk_size if isinstance(opt, optax.GradientTransformation) else None
+    )
+    n_devices = jax.local_device_count() if sharded else 1
+    assert not sample_size % n_devices
+    if (
+        (fused_steps or pipelined)
+        and sharded
+        and not (opt is None or isinstance(opt, optax.GradientTransformation))
+    ):
+        raise ValueError(
+            'Fused and pipelined steps are not supported with a sharded KFAC'
+        )
+    if pipelined and opt is None:
+        raise ValueError('Pipelined steps require an optimizer')
 
     @partial(jax.custom_jvp, nondiff_argnums=(1, 2))
     def loss_fn(params, rng, batch):
         phys_conf, weight = batch
         rng_batch = jax.random.split(rng, len(weight))
-        E_loc, hamil_stats = jax.vmap(
-            hamil.local_energy(partial(ansatz.apply, params))
+        E_loc, hamil_stats = chunked_vmap(
+            hamil.local_energy(
+                partial(ansatz.apply, params), **(local_energy_kwargs or {})
+            ),
+            chunk_size,
         )(rng_batch, phys_conf)
         loss = jnp.nanmean(E_loc * weight)
-        stats = {
-            **stats_fn(E_loc, phys_conf.mol_idx, 'E_loc'),
+        return loss, (E_loc, energy_stats(E_loc, hamil_stats, phys_conf.mol_idx))
+
+    def energy_stats(E_loc, hamil_stats, mol_idx):
+        E_loc_all, hamil_stats, mol_idx = all_device_gather(
+            cast_to_output('energy', (E_loc, hamil_stats, mol_idx))
+        )
+        return {
+            **stats_fn(E_loc_all, mol_idx, 'E_loc'),
             **{
-                k_hamil: stats_fn(v_hamil, phys_conf.mol_idx, k_hamil, mean_only=True)
+                k_hamil: stats_fn(v_hamil, mol_idx, k_hamil, mean_only=True)
                 for k_hamil, v_hamil in hamil_stats.items()
             },
         }
-        return loss, (E_loc, stats)
 
     @loss_fn.defjvp
     def loss_jvp(rng, batch, primals, tangents):
         phys_conf, weight = batch
         loss, aux = loss_fn(*primals, rng, batch)
         E_loc, _ = aux
-        E_loc_s, gradient_mask = (clip_mask_fn or median_log_squeeze_and_mask)(
-            E_loc, **(clip_mask_kwargs or {})
+        # the local energies are clipped based on the walkers of all devices
+        E_loc_s, gradient_mask = select_device_walkers(
+            (clip_mask_fn or median_log_squeeze_and_mask)(
+                all_device_gather(E_loc), **(clip_mask_kwargs or {})
+            ),
+            len(E_loc),
         )
-        E_mean = segment_nanmean(E_loc_s * weight, phys_conf.mol_idx, len(sampler))[
-            phys_conf.mol_idx
-        ]
+        E_mean = segment_nanmean(
+            *all_device_gather((E_loc_s * weight, phys_conf.mol_idx)), len(sampler)
+        )[phys_conf.mol_idx]
         assert E_loc_s.shape == E_loc.shape, (
             f'Error with clipping function: shape of E_loc {E_loc.shape} '
             f'must equal shape of clipped E_loc {E_loc_s.shape}.'
@@ -116,12 +211,18 @@ def fit_wf(  # noqa: C901
         )
 
         def log_likelihood(params):  # log(psi(theta))
-            return jax.vmap(ansatz.apply, (None, 0))(params, phys_conf).log
+            return chunked_vmap(
+                lambda phys_conf: ansatz.apply(params, phys_conf).log, jvp_chunk_size
+            )(phys_conf)
 
         log_psi, log_psi_tangent = jax.jvp(log_likelihood, primals, tangents)
         kfac_jax.register_normal_predictive_distribution(log_psi[:, None])
         loss_tangent = (E_loc_s - E_mean) * log_psi_tangent * weight
-        loss_tangent = masked_mean(loss_tangent, gradient_mask)
+        # the gradients are averaged over the devices, so the masked mean is
+        # normalized by the average number of unmasked walkers per device
+        loss_tangent = jnp.where(gradient_mask, loss_tangent, 0).sum() / (
+            all_device_mean(gradient_mask.sum())
+        )
         return (loss, aux), (loss_tangent, aux)
         # jax.custom_jvp has actually no official support for auxiliary output.
         # the second aux in the tangent output should be in fact aux_tangent.
@@ -132,19 +233,31 @@ def fit_wf(  # noqa: C901
 
     if opt is None:
 
-        @jax.jit
         def _step(_rng_opt, params, _opt_state, batch):
             loss, (E_loc, stats) = loss_fn(params, _rng_opt, batch)
 
             return params, None, E_loc, {'per_mol': stats}
 
+        def _sampled_energy(state, select_idxs):
+            E_loc, hamil_stats = (
+                sampler.get_state(k, state, select_idxs)
+                for k in ('E_loc', 'hamil_stats')
+            )
+            mol_idx = sampler.phys_conf(state, select_idxs).mol_idx
+            return E_loc, {'per_mol': energy_stats(E_loc, hamil_stats, mol_idx)}
+
+        step_fn = (pmap if sharded else jax.jit)(_step)
+        sampled_energy = (partial(pmap, in_axes=(0, None)) if sharded else jax.jit)(
+            _sampled_energy
+        )
+
     elif isinstance(opt, optax.GradientTransformation):
 
-        @jax.jit
         def _step(rng, params, opt_state, batch):
             (loss, (E_loc, per_mol_stats)), grads = energy_and_grad_fn(
                 params, rng, batch
             )
+            grads = all_device_mean(grads)
             updates, opt_state = opt.update(grads, opt_state, params)
             param_norm, update_norm, grad_norm = map(
                 tree_norm, [params, updates, grads]
@@ -158,6 +271,9 @@ def fit_wf(  # noqa: C901
             }
             return params, opt_state, E_loc, stats
 
+        step_fn = (pmap if sharded else jax.jit)(_step)
+
+        @(pmap if sharded else lambda f: f)
         def init_opt(rng, params, batch):
             opt_state = opt.init(params)
             return opt_state
@@ -165,13 +281,18 @@ def fit_wf(  # noqa: C901
     else:
 
         def _step(rng, params, opt_state, batch):
-            params, opt_state, opt_stats = opt.step(
-                params,
-                opt_state,
-                rng,
-                batch=batch,
-                momentum=0,
-            )
+            if fused_steps or pipelined:
+                # the step counter is traced in the fused and pipelined steps,
+                # such that the step is called without the checks of its
+                # arguments, which read the counter on the host to start the
+                # burn-in with a data iterator, which is not used
+                params, opt_state, opt_stats = opt._step(
+                    params, opt_state, rng, batch, None, None, 0, None
+                )
+            else:
+                params, opt_state, opt_stats = opt.step(
+                    params, opt_state, rng, batch=batch, momentum=0
+                )
             stats = {
                 'opt/param_norm': opt_stats['param_norm'],
                 'opt/grad_norm': opt_stats['precon_grad_norm'],
@@ -185,6 +306,8 @@ def fit_wf(  # noqa: C901
                 stats,
             )
 
+        step_fn = _step
+
         def init_opt(rng, params, batch):
             opt_state = opt.init(
                 params,
@@ -204,61 +327,261 @@ def fit_wf(  # noqa: C901
             num_burnin_steps=0,
             min_damping=1e-4,
             inverse_update_period=1,
+            multi_device=sharded,
+            pmap_axis_name=DEVICE_AXIS,
         )
 
-    @jax.jit
-    def sample_wf(state, rng, params, select_idxs):
-        return sampler.sample(rng, state, partial(ansatz.apply, params), select_idxs)
+    def _sample_wf(state, rng, params, select_idxs, stats_level):
+        state, phys_conf, stats = sampler.sample(
+            rng,
+            state,
+            partial(ansatz.apply, params),
+            select_idxs,
+            stats_level=stats_level,
+        )
+        return state, phys_conf, walker_weight(state, select_idxs), stats
 
-    @jax.jit
-    def update_sampler(state, params):
-        return sampler.update(state, partial(ansatz.apply, params))
+    def walker_weight(state, select_idxs):
+        log_weight = sampler.get_state(
+            'log_weight', state, select_idxs, default=jnp.zeros(len(select_idxs))
+        )
+        # the weights are normalized over the walkers of all devices
+        weight = jnp.exp(log_weight - all_device_gather(log_weight).max())
+        return weight / all_device_mean(weight.mean())
+
+    def _update_sampler(state, params, rng=None):
+        return sampler.update(state, partial(ansatz.apply, params), rng)
+
+    def _reweight_walkers(state, params, select_idxs):
+        state = sampler.update(state, partial(ansatz.apply, params))
+        phys_conf = sampler.phys_conf(state, select_idxs)
+        return state, phys_conf, walker_weight(state, select_idxs)
+
+    def _pipelined_step(
+        rng_sample, rng_kfac, smpl_state, params, opt_state, select_idxs, stats_level
+    ):
+        # the walkers sampled with the previous parameters are reweighted, after
+        # which the sampling of the walkers for the next step and the optimizer
+        # step are independent
+        smpl_state, phys_conf, weight = _reweight_walkers(
+            smpl_state, params, select_idxs
+        )
+        smpl_state, _, _, smpl_stats = _sample_wf(
+            smpl_state, rng_sample, params, select_idxs, stats_level
+        )
+        params, opt_state, E_loc, stats = _step(
+            rng_kfac, params, opt_state, (phys_conf, weight)
+        )
+        return smpl_state, params, opt_state, phys_conf, E_loc, stats, smpl_stats
+
+    if sharded:
+        sample_wf = pmap(
+            _sample_wf, in_axes=(0, 0, 0, None), static_broadcasted_argnums=4
+        )
+        update_sampler = pmap(_update_sampler)
+        pipelined_step = pmap(
+            _pipelined_step,
+            in_axes=(0, 0, 0, 0, 0, None),
+            static_broadcasted_argnums=6,
+        )
+    else:
+        sample_wf = jax.jit(_sample_wf, static_argnums=4)
+        update_sampler = jax.jit(_update_sampler)
+        pipelined_step = jax.jit(_pipelined_step, static_argnums=6)
+
+    def split_rng(rng):
+        return jax.random.split(rng, n_devices) if sharded else rng
 
     def train_step(rng, step, smpl_state, params, opt_state):
         rng_sample, rng_kfac = jax.random.split(rng)
-        select_idxs = sampler.select_idxs(sample_size, step)
-        smpl_state, phys_conf, smpl_stats = sample_wf(
-            smpl_state, rng_sample, params, select_idxs
-        )
-        weight = exp_normalize_mean(
-            sampler.get_state(
-                'log_weight',
+        select_idxs = sampler.select_idxs(sample_size // n_devices, step)
+        stats_level = smpl_stats_level if step % smpl_stats_every == 0 else 'none'
+        if pipelined:
+            (
+                smpl_state,
+                params,
+                opt_state,
+                phys_conf,
+                E_loc,
+                stats,
+                smpl_stats,
+            ) = pipelined_step(
+                split_rng(rng_sample),
+                split_rng(rng_kfac),
                 smpl_state,
+                params,
+                opt_state,
                 select_idxs,
-                default=jnp.zeros(sample_size),
+                stats_level,
             )
-        )
-        params, opt_state, E_loc, stats = _step(
-            rng_kfac,
-            params,
-            opt_state,
-            (phys_conf, weight),
-        )
-        if opt is not None:
+        else:
+            smpl_state, phys_conf, weight, smpl_stats = sample_wf(
+                smpl_state, split_rng(rng_sample), params, select_idxs, stats_level
+            )
+            if reuse_energy:
+                # the local energies were evaluated by the sampler
+                E_loc, stats = sampled_energy(smpl_state, select_idxs)
+            else:
+                params, opt_state, E_loc, stats = step_fn(
+                    split_rng(rng_kfac),
+                    params,
+                    opt_state,
+                    (phys_conf, weight),
+                )
+        if opt is not None and not pipelined:
             # WF was changed in _step, update psi values stored in smpl_state
             smpl_state = update_sampler(smpl_state, params)
         stats['per_mol'] = {**stats['per_mol'], **smpl_stats['per_mol']}
+        if sharded:
+            # the statistics are identical on all devices
+            stats = select_one_device(stats)
+            # the local energies are ordered by molecules as in a single batch
+            mol_idx = phys_conf.mol_idx.reshape(-1)
+            E_loc = E_loc.reshape(-1)[jnp.argsort(mol_idx, kind='stable')]
         return smpl_state, params, opt_state, E_loc, stats
 
+    def _fused_train_steps(
+        rngs, select_idxs, smpl_state, params, opt_state, stats_level
+    ):
+        def train_step(carry, xs, stats_level):
+            smpl_state, params, opt_state = carry
+            rng, select_idxs = xs
+            rng_sample, rng_kfac = jax.random.split(rng)
+            if sharded:
+                # the same keys as in the unfused steps
+                rng_sample, rng_kfac = (
+                    jax.random.split(rng, n_devices)[lax.axis_index(DEVICE_AXIS)]
+                    for rng in (rng_sample, rng_kfac)
+                )
+            if pipelined:
+                (
+                    smpl_state,
+                    params,
+                    opt_state,
+                    phys_conf,
+                    E_loc,
+                    stats,
+                    smpl_stats,
+                ) = _pipelined_step(
+                    rng_sample,
+                    rng_kfac,
+                    smpl_state,
+                    params,
+                    opt_state,
+                    select_idxs,
+                    stats_level,
+                )
+            else:
+                smpl_state, phys_conf, weight, smpl_stats = _sample_wf(
+                    smpl_state, rng_sample, params, select_idxs, stats_level
+                )
+                if reuse_energy:
+                    E_loc, stats = _sampled_energy(smpl_state, select_idxs)
+                else:
+                    params, opt_state, E_loc, stats = _step(
+                        rng_kfac, params, opt_state, (phys_conf, weight)
+                    )
+            if opt is not None and not pipelined:
+                smpl_state = _update_sampler(smpl_state, params)
+            stats['per_mol'] = {**stats['per_mol'], **smpl_stats['per_mol']}
+            return (smpl_state, params, opt_state), (
+                (E_loc, phys_conf.mol_idx, smpl_state['psi']),
+                stats,
+            )
+
+        def scan_step(carry, xs):
+            carry, (y, _) = train_step(carry, xs, 'none')
+            return carry, y
+
+        # only the statistics of the last step are returned, the sampling
+        # statistics of the other steps are not computed
+        carry, ys = lax.scan(
+            scan_step, (smpl_state, params, opt_state), (rngs[:-1], select_idxs[:-1])
+        )
+        carry, (y, stats) = train_step(carry, (rngs[-1], select_idxs[-1]), stats_level)
+        ys = jax.tree_util.tree_map(lambda xs, x: jnp.concatenate([xs, x[None]]), ys, y)
+        return carry, ys, stats
+
+    if sharded:
+        fused_train_steps = pmap(
+            _fused_train_steps,
+            in_axes=(None, None, 0, 0, 0),
+            static_broadcasted_argnums=5,
+        )
+    else:
+        fused_train_steps = jax.jit(_fused_train_steps, static_argnums=5)
+
+    def fused_train_block(rngs, steps, smpl_state, params, opt_state):
+        select_idxs = jnp.stack(
+            [sampler.select_idxs(sample_size // n_devices, step) for step in steps]
+        )
+        stats_level = (
+            smpl_stats_level
+            if any(step % smpl_stats_every == 0 for step in steps)
+            else 'none'
+        )
+        train_state, (E_loc, mol_idx, psi), stats = fused_train_steps(
+            jnp.stack(rngs), select_idxs, smpl_state, params, opt_state, stats_level
+        )
+        if sharded:
+            stats = select_one_device(stats)
+            psi = gather_on_one_device(psi, axis=2)
+            E_loc, mol_idx = gather_on_one_device((E_loc, mol_idx), axis=1)
+            E_loc = jnp.take_along_axis(
+                E_loc, jnp.argsort(mol_idx, axis=-1, kind='stable'), axis=-1
+            )
+        E_loc, stats = jax.device_get((E_loc, {**stats, 'psi': psi}))
+        return *train_state, E_loc, stats
+
     if train_state:
         smpl_state, params, opt_state = train_state
     else:
         rng, rng_init_fit = jax.random.split(rng)
         params, smpl_state = init_fit(rng_init_fit, hamil, ansatz, sampler, sample_size)
         opt_state = None
+    if pipelined and 'log_weight' not in smpl_state:
+        raise ValueError('Pipelined training requires a ResampledSampler')
+    if sharded:
+        # the walker states are stacked along a leading molecule axis
+        smpl_state = split_on_devices(smpl_state, n_devices, axis=1)
+        params = replicate_on_devices(params, n_devices)
+        if opt_state is not None:
+            opt_state = replicate_on_devices(opt_state, n_devices)
+    if opt is None and 'E_loc' not in smpl_state:
+        # the sampler might evaluate the local energies, but the walkers were
+        # sampled by another sampler, e.g., in a training
+        rng, rng_update = jax.random.split(rng)
+        smpl_state = update_sampler(smpl_state, params, split_rng(rng_update))
+    reuse_energy = opt is None and 'E_loc' in smpl_state
     if opt is not None and opt_state is None:
         rng, rng_opt = jax.random.split(rng)
-        init_select_idxs = sampler.select_idxs(sample_size, 0)
+        init_select_idxs = sampler.select_idxs(sample_size // n_devices, 0)
+        phys_conf = (
+            pmap(sampler.phys_conf, in_axes=(0, None)) if sharded else sampler.phys_conf
+        )(smpl_state, init_select_idxs)
         opt_state = init_opt(
-            rng_opt,
+            split_rng(rng_opt),
             params,
-            (
-                sampler.phys_conf(smpl_state, init_select_idxs),
-                jnp.ones(sample_size),
-            ),
+            (phys_conf, jnp.ones(phys_conf.r.shape[:-2])),
         )
     train_state = smpl_state, params, opt_state
 
-    for step, rng in zip(steps, hk.PRNGSequence(rng)):
-        *train_state, E_loc, stats = train_step(rng, step, *train_state)
-        yield step, TrainState(*train_state), E_loc, stats
+    rngs = hk.PRNGSequence(rng)
+    if fused_steps:
+        steps = iter(steps)
+        blocks = iter(lambda: list(islice(steps, fused_steps)), [])
+    else:
+        blocks = ([step] for step in steps)
+    for block in blocks:
+        step = block[-1]
+        if fused_steps:
+            *train_state, E_loc, stats = fused_train_block(
+                [next(rngs) for _ in block], block, *train_state
+            )
+        else:
+            *train_state, E_loc, stats = train_step(next(rngs), step, *train_state)
+        smpl_state, params, opt_state = train_state
+        if sharded:
+            smpl_state = gather_on_one_device(smpl_state, axis=1)
+            params, opt_state = select_one_device((params, opt_state))
+        yield step, TrainState(smpl_state, params, opt_state), E_loc, stats
@@ -7,15 +7,24 @@ from jax import ops
 
 from ..utils import flatten
 from .graph import (
+    DenseGraphEdges,
     Graph,
     GraphNodes,
     GraphUpdate,
     MolecularGraphEdgeBuilder,
+    dense_edge_blocks,
+    dense_sender_data,
     difference_callback,
 )
 from .utils import NodeEdgeMapping
 
 
+def apply_to_edge_features(fn, features):
+    r"""Apply a function to the edge features, flattening dense edges."""
+    updated = fn(features.reshape(-1, features.shape[-1]))
+    return updated.reshape(*features.shape[:-1], updated.shape[-1])
+
+
 class ElectronGNNLayer(hk.Module):
     r"""
     The message passing layer of :class:`ElectronGNN`.
@@ -92,6 +101,10 @@ class ElectronGNNLayer(hk.Module):
             typ for typ in edge_types if not self.last_layer or typ not in {'nn', 'en'}
         )
         self.mapping = NodeEdgeMapping(self.edge_types, node_data=node_data)
+        self.dense_blocks = {
+            typ: dense_edge_blocks(typ, n_nuc, n_up, n_down)[0]
+            for typ in self.edge_types
+        }
         assert update_rule in [
             'concatenate',
             'featurewise',
@@ -176,12 +189,18 @@ class ElectronGNNLayer(hk.Module):
                     # combine features along leading dim, apply MLP and split
                     # into channels again to please kfac
                     keys, feats = zip(*features.items())
+                    shapes = [f.shape[:-1] for f in feats]
+                    feats = [f.reshape(-1, f.shape[-1]) for f in feats]
                     split_idxs = list(accumulate([len(f) for f in feats]))
                     feats = jnp.split(self.u(jnp.concatenate(feats)), split_idxs)
-                    updated_features = dict(zip(keys, feats))
+                    updated_features = {
+                        key: f.reshape(*shape, f.shape[-1])
+                        for key, f, shape in zip(keys, feats, shapes)
+                    }
                 elif self.deep_features == 'separate':
                     updated_features = {
-                        typ: self.u[typ](edge.features) for typ, edge in edges.items()
+                        typ: apply_to_edge_features(self.u[typ], edge.features)
+                        for typ, edge in edges.items()
                     }
 
                 if self.residual:
@@ -195,14 +214,33 @@ class ElectronGNNLayer(hk.Module):
 
         return update_edges
 
+    def sender_data_of_edges(self, typ, edges, x):
+        if isinstance(edges, DenseGraphEdges):
+            return dense_sender_data(self.dense_blocks[typ], x)
+        return x[edges.senders]
+
+    def sum_over_receivers(self, typ, edges, message):
+        if isinstance(edges, DenseGraphEdges):
+            return jnp.where(edges.mask[..., None], message, 0).sum(axis=1)
+        return ops.segment_sum(
+            data=message,
+            segment_ids=edges.receivers,
+            num_segments=self.mapping.receiver_data_of(typ, 'n_nodes'),
+        )
+
     def get_aggregate_edges_for_nodes_fn(self):
         def aggregate_edges_for_nodes(nodes, edges):
             if self.convolution:
-                we = {typ: self.w[typ](edge.features) for typ, edge in edges.items()}
+                we = {
+                    typ: apply_to_edge_features(self.w[typ], edge.features)
+                    for typ, edge in edges.items()
+                }
                 hx = {
-                    typ: (self.h[typ](self.mapping.sender_data_of(typ, nodes)))[
-                        edges[typ].senders
-                    ]
+                    typ: self.sender_data_of_edges(
+                        typ,
+                        edges[typ],
+                        self.h[typ](self.mapping.sender_data_of(typ, nodes)),
+                    )
                     for typ in self.edge_types
                 }
                 message = {typ: we[typ] * hx[typ] for typ in self.edge_types}
@@ -210,11 +248,7 @@ class ElectronGNNLayer(hk.Module):
                 message = {typ: edge.features for typ, edge in edges.items()}
 
             z = {
-                typ: ops.segment_sum(
-                    data=message[typ],
-                    segment_ids=edges[typ].receivers,
-                    num_segments=self.mapping.receiver_data_of(typ, 'n_nodes'),
-                )
+                typ: self.sum_over_receivers(typ, edges[typ], message[typ])
                 for typ in self.edge_types
             }
             return z
@@ -315,6 +349,11 @@ class ElectronGNN(hk.Module):
         layer_factory (Callable): a callable that generates a layer of the GNN.
         ghost_coords: optional, specifies the coordinates of one or more ghost atoms,
             useful for breaking spatial symmetries of the nuclear geometry.
+        dense_edges (bool): if :data:`True`, the edges are stored as dense blocks
+            of all sender nodes for each receiver node, with the missing edges
+            masked, and the messages are summed over an axis of the blocks. If
+            :data:`False`, the edges are stored as lists of sender and receiver
+            node indices, and the messages are summed with segment sums.
     """
 
     def __init__(
@@ -330,6 +369,7 @@ class ElectronGNN(hk.Module):
         atom_type_embeddings,
         layer_factory,
         ghost_coords=None,
+        dense_edges=False,
     ):
         super().__init__()
         n_nuc, n_up, n_down = mol.n_particles
@@ -377,6 +417,7 @@ class ElectronGNN(hk.Module):
         self.edge_features = edge_features
         self.edge_types = edge_types
         self.positional_electron_embeddings = positional_electron_embeddings
+        self.dense_edges = dense_edges
 
     def node_factory(self, phys_conf):
         n_elec_types = self.node_data['n_node_types']['electrons']
@@ -388,23 +429,31 @@ class ElectronGNN(hk.Module):
                 self.n_down,
                 ['ne'],
                 feature_callbacks={
-                    'ne': lambda *args: self.edge_features['ne'](
-                        difference_callback(*args)
+                    'ne': (
+                        self.edge_features['ne']
+                        if self.dense_edges
+                        else lambda *args: self.edge_features['ne'](
+                            difference_callback(*args)
+                        )
                     )
                 },
+                dense=self.dense_edges,
             )
             ne_edges = edge_factory(phys_conf)['ne']
-            ne_pos_feat = (
-                jnp.zeros(
-                    (
-                        self.n_up + self.n_down + 1,
-                        self.n_nuc + 1,
-                        ne_edges.features.shape[-1],
+            if self.dense_edges:
+                ne_pos_feat = ne_edges.features  # [n_elec, n_nuc, n_edge_feat_dim]
+            else:
+                ne_pos_feat = (
+                    jnp.zeros(
+                        (
+                            self.n_up + self.n_down + 1,
+                            self.n_nuc + 1,
+                            ne_edges.features.shape[-1],
+                        )
                     )
-                )
-                .at[ne_edges.receivers, ne_edges.senders]
-                .set(ne_edges.features)[: self.n_up + self.n_down, : self.n_nuc]
-            )  # [n_elec, n_nuc, n_edge_feat_dim]
+                    .at[ne_edges.receivers, ne_edges.senders]
+                    .set(ne_edges.features)[: self.n_up + self.n_down, : self.n_nuc]
+                )  # [n_elec, n_nuc, n_edge_feat_dim]
             x = flatten(ne_pos_feat, start_axis=1)
         else:
             X = hk.Embed(n_elec_types, self.embedding_dim, name='ElectronicEmbedding')
@@ -422,6 +471,8 @@ class ElectronGNN(hk.Module):
         r"""Compute all the graph edges used in the GNN."""
 
         def feature_callback(typ, *callback_args):
+            if self.dense_edges:
+                return self.edge_features[typ](*callback_args)
             return self.edge_features[typ](difference_callback(*callback_args))
 
         edge_factory = MolecularGraphEdgeBuilder(
@@ -432,6 +483,7 @@ class ElectronGNN(hk.Module):
             feature_callbacks={
                 typ: partial(feature_callback, typ) for typ in self.edge_types
             },
+            dense=self.dense_edges,
         )
         return edge_factory(phys_conf)
 
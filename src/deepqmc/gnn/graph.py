@@ -1,14 +1,18 @@
 from collections import namedtuple
+from functools import partial
 
 import jax.numpy as jnp
+import numpy as np
 from jax.tree_util import tree_map, tree_structure, tree_transpose
 
 GraphEdges = namedtuple('GraphEdges', 'senders receivers features')
+DenseGraphEdges = namedtuple('DenseGraphEdges', 'mask features')
 GraphNodes = namedtuple('GraphNodes', 'nuclei electrons')
 Graph = namedtuple('Graph', 'nodes edges')
 
 __all__ = [
     'GraphEdgeBuilder',
+    'DenseGraphEdgeBuilder',
     'MolecularGraphEdgeBuilder',
     'GraphUpdate',
     'difference_callback',
@@ -54,7 +58,7 @@ def mask_self_edges(idx):
 def difference_callback(pos_sender, pos_receiver, sender_idx, receiver_idx):
     r"""feature_callback computing the Euclidian difference vector for each edge."""
     if len(pos_sender) == 0 or len(pos_receiver) == 0:
-        return jnp.zeros((len(sender_idx), 3))
+        return jnp.zeros((*sender_idx.shape, 3))
     diffs = pos_receiver[receiver_idx] - pos_sender[sender_idx]
     return diffs
 
@@ -131,6 +135,119 @@ def GraphEdgeBuilder(
     return build
 
 
+def dense_edge_blocks(edge_type, n_nuc, n_up, n_down):
+    r"""Return the blocks of the dense edges of a molecular edge type.
+
+    The receiver nodes of the dense edges are arranged in blocks of consecutive
+    nodes, each of which receives edges from a range of consecutive sender nodes.
+
+    Args:
+        edge_type (str): the name of the edge type, see
+            :func:`MolecularGraphEdgeBuilder`.
+        n_nuc (int): number of nuclei.
+        n_up (int): number of spin-up electrons.
+        n_down (int): number of spin-down electrons.
+
+    Returns:
+        tuple: the blocks as pairs of the receiver and sender node index ranges,
+        and whether the edges between nodes of the same index are masked.
+    """
+    n_elec = n_up + n_down
+    nuc, elec, up, down = (0, n_nuc), (0, n_elec), (0, n_up), (n_up, n_elec)
+    return {
+        'nn': ([(nuc, nuc)], True),
+        'ne': ([(elec, nuc)], False),
+        'en': ([(nuc, elec)], False),
+        'same': ([(up, up), (down, down)], True),
+        'anti': ([(up, down), (down, up)], False),
+        'up': ([(elec, up)], False),
+        'down': ([(elec, down)], False),
+    }[edge_type]
+
+
+def dense_sender_data(blocks, x):
+    r"""Arrange the data of the sender nodes along the edges of dense blocks.
+
+    Args:
+        blocks (Sequence): the blocks of the dense edges, see
+            :func:`dense_edge_blocks`.
+        x (float, (:math:`N_\text{sender}`, ...)): the data of the sender nodes.
+
+    Returns:
+        float, (:math:`N_\text{receiver}`, :math:`M`, ...): the data of the
+        senders of each receiver node, padded with zeros to the largest number
+        :math:`M` of senders in a block.
+    """
+    n_sender = max(stop - start for _, (start, stop) in blocks)
+    return jnp.concatenate(
+        [
+            jnp.broadcast_to(
+                jnp.pad(
+                    x[start:stop],
+                    [(0, n_sender - (stop - start))] + (x.ndim - 1) * [(0, 0)],
+                ),
+                (recv_stop - recv_start, n_sender, *x.shape[1:]),
+            )
+            for (recv_start, recv_stop), (start, stop) in blocks
+        ]
+    )
+
+
+def DenseGraphEdgeBuilder(blocks, mask_self, feature_callback):
+    r"""
+    Create a function that builds graph edges as dense blocks.
+
+    Instead of lists of sender and receiver node indices, the edges are stored as
+    arrays of shape (:math:`N_\text{receiver}`, :math:`M`, ...), where the second
+    axis runs over the senders of a receiver node. The senders missing in the
+    smaller blocks and the edges between nodes of the same index are masked.
+
+    Args:
+        blocks (Sequence): the blocks of the dense edges, see
+            :func:`dense_edge_blocks`.
+        mask_self (bool): whether to mask edges between nodes of the same index.
+        feature_callback (Callable): a function that takes the difference vectors
+            of the edges and returns some data (features) computed for the edges.
+    """
+    receivers = [recv for recv, _ in blocks]
+    assert all(start == stop for (_, stop), (start, _) in zip(receivers, receivers[1:]))
+    n_sender = max(stop - start for _, (start, stop) in blocks)
+    mask = np.concatenate(
+        [
+            np.broadcast_to(
+                np.arange(n_sender) < stop - start, (recv_stop - recv_start, n_sender)
+            )
+            & ~(
+                mask_self
+                & (
+                    np.arange(recv_start, recv_stop)[:, None]
+                    == np.arange(start, start + n_sender)
+                )
+            )
+            for (recv_start, recv_stop), (start, stop) in blocks
+        ]
+    )
+
+    def build(pos_sender, pos_receiver):
+        r"""
+        Build dense graph edges.
+
+        Args:
+            pos_sender (float, (:math:`N_{nodes}`, 3)): coordinates of graph nodes
+                that send edges.
+            pos_receiver (float, (:math:`M_{nodes}`, 3)): coordinates of graph nodes
+                that receive edges.
+
+        Returns:
+            A :class:`~deepqmc.gnn.graph.DenseGraphEdges` instance.
+        """
+        assert pos_receiver.shape[0] == len(mask)
+        diffs = pos_receiver[:, None] - dense_sender_data(blocks, pos_sender)
+        return DenseGraphEdges(jnp.asarray(mask), feature_callback(diffs))
+
+    return build
+
+
 def concatenate_edges(edges):
     r"""
     Concatenate two edge lists.
@@ -146,7 +263,9 @@ def concatenate_edges(edges):
     )
 
 
-def MolecularGraphEdgeBuilder(n_nuc, n_up, n_down, edge_types, feature_callbacks):
+def MolecularGraphEdgeBuilder(
+    n_nuc, n_up, n_down, edge_types, feature_callbacks, *, dense=False
+):
     r"""
     Create a function that builds many types of molecular edges.
 
@@ -162,7 +281,10 @@ def MolecularGraphEdgeBuilder(n_nuc, n_up, n_down, edge_types, feature_callbacks
                 - ``'same'``: edges betwen same-spin electrons
                 - ``'anti'``: edges betwen opposite-spin electrons
         feature_callbacks (dict): a mapping from names of edge types to the
-            feature callbacks passed to the :class:`GraphEdgeBuilder` of that edge type.
+            feature callbacks passed to the :class:`GraphEdgeBuilder` of that edge
+            type, or to the :class:`DenseGraphEdgeBuilder` if :data:`dense`.
+        dense (bool): if :data:`True`, build :class:`DenseGraphEdges` instead of
+            edge lists.
     """
     n_elec = n_up + n_down
     builder_mapping = {
@@ -250,6 +372,25 @@ def MolecularGraphEdgeBuilder(n_nuc, n_up, n_down, edge_types, feature_callbacks
         'down': lambda pc: builders['down'](pc.r[n_up:], pc.r),
     }
 
+    if dense:
+        dense_builders = {
+            edge_type: DenseGraphEdgeBuilder(
+                *dense_edge_blocks(edge_type, n_nuc, n_up, n_down),
+                feature_callback=feature_callbacks[edge_type],
+            )
+            for edge_type in edge_types
+        }
+
+        def build_dense(edge_type, phys_conf):
+            sender, receiver = {'nn': 'RR', 'ne': 'Rr', 'en': 'rR'}.get(edge_type, 'rr')
+            return dense_builders[edge_type](
+                getattr(phys_conf, sender), getattr(phys_conf, receiver)
+            )
+
+        build_rules = {
+            edge_type: partial(build_dense, edge_type) for edge_type in edge_types
+        }
+
     def build(phys_conf):
         r"""
         Build many types of molecular graph edges.
@@ -5,13 +5,18 @@ import jax_dataclasses as jdc
 from jax import random, vmap
 
 from ..physics import (
+    LAPLACIANS,
+    PROBES,
+    WF_RATIOS,
     electronic_potential,
-    laplacian,
     local_potential,
+    hutchinson_laplacian,
     nonlocal_potential,
     nuclear_energy,
     pairwise_distance,
+    pairwise_geometry,
 )
+from ..precision import cast_to_compute, cast_to_output
 from ..types import PhysicalConfiguration
 from ..utils import argmax_random_choice
 from .base import Hamiltonian
@@ -33,11 +38,31 @@ class MolecularHamiltonian(Hamiltonian):
         mol (~deepqmc.Molecule): the molecule to consider
         elec_std (float): optional, a default value of the scaling factor
         of the spread of electrons around the nuclei.
+        laplacian (str): optional, the computation of the Laplacian, either
+            ``'hvp'`` for a loop over Hessian-vector products, or ``'forward'``
+            for a single forward pass vectorized over the electron coordinates.
+        nonlocal_kwargs (dict): optional, extra arguments passed to
+            :func:`~deepqmc.physics.nonlocal_potential`, such as
+            :data:`wf_ratio='locality'` to evaluate the nonlocal pseudopotential
+            within the locality approximation, or :data:`screening_tol` and
+            :data:`screening_capacity` to restrict its quadrature to the electrons
+            near the cores, or :data:`quadrature_chunk_size` to bound its memory.
+            With screening, the number of electrons neglected due to the
+            screening capacity is reported as :data:`hamil/V_nl_overflow`.
     """
 
-    def __init__(self, *, mol, elec_std=1.0):
+    def __init__(self, *, mol, elec_std=1.0, laplacian='hvp', nonlocal_kwargs=None):
+        if laplacian not in LAPLACIANS:
+            raise ValueError(f'Unknown Laplacian: {laplacian!r}')
+        nonlocal_kwargs = nonlocal_kwargs or {}
+        if nonlocal_kwargs.get('wf_ratio', 'exact') not in WF_RATIOS:
+            raise ValueError(
+                f'Unknown wave function ratio: {nonlocal_kwargs["wf_ratio"]!r}'
+            )
         self.mol = mol
         self.elec_std = elec_std
+        self.laplacian = laplacian
+        self.nonlocal_kwargs = nonlocal_kwargs
 
     def init_sample(self, rng, Rs, n, elec_std=None):
         r"""
@@ -125,19 +150,67 @@ class MolecularHamiltonian(Hamiltonian):
         assert down.sum() == self.mol.n_down
         return up, down
 
-    def local_energy(self, wf, return_grad=False):
+    def local_energy(
+        self,
+        wf,
+        return_grad=False,
+        *,
+        return_psi=False,
+        n_probes=None,
+        probes='rademacher',
+    ):
+        r"""
+        Return a function that calculates the local energy of the wave function.
+
+        Args:
+            wf (~deepqmc.wf.WaveFunction): the wave function ansatz, which is
+                passed the :class:`~deepqmc.physics.PairwiseGeometry` shared with
+                the potentials as the keyword argument :data:`geometry`.
+            return_grad (bool): optional, whether to return also the gradient of
+                the log of the wave function.
+            return_psi (bool): optional, whether to return also the value of the
+                wave function, which is obtained in the same pass.
+            n_probes (int): optional, if specified the Laplacian is estimated
+                stochastically from this number of random probe vectors, see
+                :func:`~deepqmc.physics.hutchinson_laplacian`.
+            probes (str): optional, the distribution of the probe vectors.
+        """
+        if probes not in PROBES:
+            raise ValueError(f'Unknown probe distribution: {probes!r}')
+
         def loc_ene(rng, phys_conf):
             def wave_function(r):
                 pc = jdc.replace(phys_conf, r=r.reshape(-1, 3))
-                return wf(pc).log
-
-            lap_log_psis, quantum_force = laplacian(wave_function)(
-                phys_conf.r.flatten()
-            )
+                geometry = pairwise_geometry(pc)
+                psi = wf(pc, geometry=geometry)
+                return psi.log, (psi, geometry)
+
+            # the value of the wave function and the pairwise geometry are
+            # obtained in the same pass as the derivatives, and are reused by the
+            # potentials
+            if n_probes is None:
+                lap = LAPLACIANS[self.laplacian](wave_function, has_aux=True)
+            else:
+                rng, rng_probes = random.split(rng)
+                lap = hutchinson_laplacian(
+                    wave_function, rng_probes, n_probes, probes, has_aux=True
+                )
+            lap_log_psis, quantum_force, (psi, geometry) = lap(phys_conf.r.flatten())
             Es_kin = -0.5 * (lap_log_psis + (quantum_force**2).sum(axis=-1))
-            Es_nuc = nuclear_energy(phys_conf, self.mol)
-            Vs_el = electronic_potential(phys_conf)
-            Vs_loc = local_potential(phys_conf, self.mol)
+            pc = cast_to_compute('energy', phys_conf)
+            if geometry.dists_nuc.dtype != pc.r.dtype:
+                # the Laplacian is evaluated in a different precision
+                geometry = pairwise_geometry(pc)
+            # the contributions are accumulated in the output precision
+            Es_kin, Es_nuc, Vs_el, Vs_loc = cast_to_output(
+                'energy',
+                (
+                    Es_kin,
+                    nuclear_energy(pc, self.mol),
+                    electronic_potential(pc, geometry),
+                    local_potential(pc, self.mol, geometry),
+                ),
+            )
             Es_loc = Es_kin + Vs_loc + Vs_el + Es_nuc
             stats = {
                 'hamil/V_el': Vs_el,
@@ -147,11 +220,30 @@ class MolecularHamiltonian(Hamiltonian):
                 'hamil/quantum_force': (quantum_force**2).sum(axis=-1),
             }
             if self.mol.any_pp:
-                Vs_nl = nonlocal_potential(rng, phys_conf, self.mol, wf)
+                # the electrons neglected by the screening are reported
+                screening = self.nonlocal_kwargs.get('screening_tol') is not None
+                Vs_nl = nonlocal_potential(
+                    rng,
+                    pc,
+                    self.mol,
+                    wf,
+                    psi,
+                    geometry=geometry,
+                    return_overflow=screening,
+                    **self.nonlocal_kwargs,
+                )
+                if screening:
+                    Vs_nl, n_overflow = Vs_nl
+                    stats = {**stats, 'hamil/V_nl_overflow': n_overflow}
+                Vs_nl = cast_to_output('energy', Vs_nl)
                 Es_loc += Vs_nl
                 stats = {**stats, 'hamil/V_nl': Vs_nl}
 
-            result = (Es_loc, quantum_force) if return_grad else Es_loc
-            return result, stats
+            result = (Es_loc,)
+            if return_grad:
+                result += (quantum_force,)
+            if return_psi:
+                result += (psi,)
+            return (result if len(result) > 1 else Es_loc), stats
 
         return loc_ene
@@ -2,7 +2,7 @@ import jax
 import jax.numpy as jnp
 import jax_dataclasses as jdc
 
-from ..physics import laplacian
+from ..physics import LAPLACIANS
 from ..types import PhysicalConfiguration
 from .base import Hamiltonian
 
@@ -10,12 +10,23 @@ __all__ = ['QHOHamiltonian']
 
 
 class QHOHamiltonian(Hamiltonian):
-    r"""Hamiltonian for the quantum harmonic oscillator."""
-
-    def __init__(self, dim, mass, nu):
+    r"""Hamiltonian for the quantum harmonic oscillator.
+
+    Args:
+        dim (int): the number of dimensions.
+        mass (float): the mass of the particle.
+        nu (float): the frequency of the oscillator.
+        laplacian (str): optional, the computation of the Laplacian, see
+            :class:`~deepqmc.hamil.MolecularHamiltonian`.
+    """
+
+    def __init__(self, dim, mass, nu, laplacian='hvp'):
+        if laplacian not in LAPLACIANS:
+            raise ValueError(f'Unknown Laplacian: {laplacian!r}')
         self.dim = (dim,)
         self.mass = mass
         self.nu = nu
+        self.laplacian = laplacian
 
     def local_energy(self, wf):
         def loc_ene(rng, phys_conf):
@@ -23,7 +34,7 @@ class QHOHamiltonian(Hamiltonian):
                 return wf(jdc.replace(phys_conf, r=r)).log
 
             pot = 1 / 2 * self.mass * self.nu**2 * jnp.sum(phys_conf.r**2)
-            lap_log, grad_log = laplacian(wave_function)(phys_conf.r)
+            lap_log, grad_log = LAPLACIANS[self.laplacian](wave_function)(phys_conf.r)
             kin = -1 / (2 * self.mass) * (lap_log + jnp.sum(grad_log**2))
             return kin + pot, {}
 
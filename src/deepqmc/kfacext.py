@@ -11,6 +11,8 @@ from kfac_jax._src.utils import (
     types,
 )
 
+from .precision import cast_to_compute
+
 __all__ = ['make_graph_patterns']
 
 log = logging.getLogger(__name__)
@@ -33,6 +35,8 @@ class DenseBlock(kfac_jax.DenseTwoKroneckerFactored):
     ):
         (x,) = estimation_data['inputs']
         (dy,) = estimation_data['outputs_tangent']
+        x, dy = cast_to_compute('curvature', (x, dy))
+        estimation_data['inputs'], estimation_data['outputs_tangent'] = (x,), (dy,)
         if not kfac_jax.utils.first_dim_is_size(batch_size, x, dy):
             log.debug("Input of dense block doesn't have first dim of batch_size")
             log.debug(f"It's shape is {x.shape}, expanding to {(batch_size, *x.shape)}")
@@ -68,6 +72,7 @@ class RepeatedDenseBlock(kfac_jax.DenseTwoKroneckerFactored):
         estimation_data = dict(**estimation_data)
         (x,) = estimation_data['inputs']
         (dy,) = estimation_data['outputs_tangent']
+        x, dy = cast_to_compute('curvature', (x, dy))
         assert kfac_jax.utils.first_dim_is_size(batch_size, x, dy)
 
         estimation_data['inputs'] = (x.reshape([-1, x.shape[-1]]),)
@@ -1,104 +1,415 @@
+import json
+import os
 import pickle
+import time
 from collections import namedtuple
+from functools import partial
 from pathlib import Path
+from queue import Queue
+from threading import Thread
 
+import h5py
+import jax
 import jax.numpy as jnp
 import numpy as np
 import tensorboard.summary
-from jax.tree_util import tree_map
+from jax.tree_util import (
+    DictKey,
+    GetAttrKey,
+    SequenceKey,
+    tree_flatten_with_path,
+    tree_leaves,
+    tree_map,
+    tree_unflatten,
+)
 
 Checkpoint = namedtuple('Checkpoint', 'step loss path')
 
 
+def _key_name(key):
+    if isinstance(key, DictKey):
+        return str(key.key)
+    if isinstance(key, GetAttrKey):
+        return key.name
+    if isinstance(key, SequenceKey):
+        return str(key.idx)
+    return str(key.key)
+
+
+def save_checkpoint(path, step, state, *, compress_walkers=False):
+    r"""Save a training checkpoint to an HDF5 file.
+
+    The sampler state, the parameters and the optimizer state are stored in
+    separate groups with one dataset per array, named after its position in the
+    state, such that they can be loaded independently of each other.
+
+    Args:
+        path (str): the path of the file.
+        step (int): the step of the checkpoint.
+        state (~deepqmc.fit.TrainState): the training state on the host.
+        compress_walkers (bool): optional, whether to compress the sampler state.
+    """
+    with h5py.File(path, 'w') as f:
+        f.attrs['step'] = step
+        f.attrs['type'] = np.void(pickle.dumps(type(state)))
+        for part, tree in state._asdict().items():
+            group = f.create_group(part)
+            leaves, treedef = tree_flatten_with_path(tree)
+            group.attrs['treedef'] = np.void(pickle.dumps(treedef))
+            names = []
+            for key_path, leaf in leaves:
+                name = '/'.join(map(_key_name, key_path)) or 'leaf'
+                leaf = np.asarray(leaf)
+                dtype = leaf.dtype
+                if dtype.kind == 'V':
+                    # extended floating point types, such as bfloat16, are not
+                    # supported by HDF5 and are stored as raw bits
+                    leaf = leaf.view(f'u{dtype.itemsize}')
+                compress = compress_walkers and part == 'sampler' and leaf.ndim
+                ds = group.create_dataset(
+                    name, data=leaf, compression='gzip' if compress else None
+                )
+                if dtype.kind == 'V':
+                    ds.attrs['dtype'] = dtype.name
+                names.append(name)
+            group.attrs['leaves'] = names
+
+
+def _load_array(path, ds, mmap):
+    offset = ds.id.get_offset()
+    if mmap and ds.chunks is None and ds.ndim and offset is not None:
+        x = np.memmap(path, dtype=ds.dtype, mode='c', shape=ds.shape, offset=offset)
+    else:
+        x = ds[()]
+    return x.view(jnp.dtype(ds.attrs['dtype'])) if 'dtype' in ds.attrs else x
+
+
+def load_checkpoint(path, parts=None, *, mmap=True):
+    r"""Load a training checkpoint.
+
+    Checkpoints pickled by earlier versions are read completely, and their
+    walker states, kept per molecule in a list, are stacked along a leading
+    molecule axis as expected by :class:`~deepqmc.sampling.MultimoleculeSampler`.
+
+    Args:
+        path (str): the path of the checkpoint.
+        parts (Sequence[str]): optional, the parts of the training state to load,
+            e.g., ``('params',)``, the other parts are :data:`None`. All parts are
+            loaded by default.
+        mmap (bool): optional, whether to memory-map the uncompressed arrays from
+            the file instead of reading them.
+
+    Returns:
+        tuple: the step and the training state of the checkpoint.
+    """
+    path = Path(path)
+    if path.suffix == '.pt':
+        with path.open('rb') as f:
+            step, state = pickle.load(f)
+        if isinstance(state.sampler, (list, tuple)):
+            # earlier versions of the MultimoleculeSampler kept a list of the
+            # walker states of the molecules, which are now stacked
+            state = state._replace(
+                sampler=tree_map(lambda *xs: jnp.stack(xs), *state.sampler)
+            )
+        if parts is not None:
+            state = state._replace(**{k: None for k in state._fields if k not in parts})
+        return step, state
+    with h5py.File(path, 'r') as f:
+        cls = pickle.loads(f.attrs['type'].tobytes())
+        state = {}
+        for part in cls._fields:
+            if parts is not None and part not in parts:
+                state[part] = None
+                continue
+            group = f[part]
+            leaves = [
+                _load_array(path, group[name], mmap) for name in group.attrs['leaves']
+            ]
+            state[part] = tree_unflatten(
+                pickle.loads(group.attrs['treedef'].tobytes()), leaves
+            )
+        return int(f.attrs['step']), cls(**state)
+
+
+class _BackgroundWriter:
+    r"""Run write tasks in order on a background thread.
+
+    At most :data:`max_pending` tasks wait to be run, further submissions block
+    until the thread catches up. Errors of the tasks are raised on the next
+    submission.
+    """
+
+    def __init__(self, max_pending):
+        self.queue = Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, task):
+        self._check_error()
+        self.queue.put(task)
+
+    def wait(self):
+        self.queue.join()
+        self._check_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check_error()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing in the background failed') from error
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                task()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
 class CheckpointStore:
     r"""Stores training checkpoints in the working directory.
 
+    The checkpoints are transferred to the host before saving, such that they can
+    be restored independently of the devices they were created on. The host copy
+    is serialized on a background thread, so that the training continues while it
+    is written. Each checkpoint is written to a temporary file which is renamed
+    once complete, so that a crash never leaves a partially written checkpoint.
+    If the writing falls behind, the training waits for the pending checkpoints
+    before another one is saved.
+
     Args:
         workdir (str): path where checkpoints are stored.
         size (int): maximum number of checkpoints stored at any time.
         interval (int): number of steps between two checkpoints.
+        max_pending (int): maximum number of checkpoints waiting to be written.
+        compress_walkers (bool): whether to compress the sampler states in the
+            checkpoints, see :func:`save_checkpoint`.
     """
 
-    PATTERN = 'chkpt-{}.pt'
+    PATTERN = 'chkpt-{}.h5'
+    PICKLE_PATTERN = 'chkpt-{}.pt'
 
-    def __init__(self, workdir, *, size=3, interval=1000):
+    def __init__(
+        self,
+        workdir,
+        *,
+        size=3,
+        interval=1000,
+        max_pending=1,
+        compress_walkers=False,
+    ):
         self.workdir = Path(workdir)
-        for p in self.workdir.glob(self.PATTERN.format('*')):
-            p.unlink()
+        for pattern in [self.PATTERN, self.PICKLE_PATTERN]:
+            for p in self.workdir.glob(pattern.format('*') + '*'):
+                p.unlink()
         self.size = size
         self.interval = interval
+        self.compress_walkers = compress_walkers
         self.chkpts = []
         self.buffer = None
+        self.writer = _BackgroundWriter(max_pending)
 
     def update(self, step, state, loss=jnp.inf):
         self.buffer = (step, state, loss)
         if not self.chkpts or (step >= self.interval + self.chkpts[-1].step):
             self.dump()
         while len(self.chkpts) > self.size:
-            self.chkpts.pop(0).path.unlink()
+            self.writer.submit(self.chkpts.pop(0).path.unlink)
 
     def dump(self):
         step, state, loss = self.buffer
         path = self.workdir / self.PATTERN.format(step)
-        with path.open('wb') as f:
-            pickle.dump((step, state), f)
+        # the host copy must not share memory with the device buffers, which
+        # might be donated in the next step
+        state = tree_map(np.array, jax.device_get(state))
+        self.writer.submit(partial(self._write, path, step, state))
         self.chkpts.append(Checkpoint(step, loss, path))
 
+    def _write(self, path, step, state):
+        tmp_path = path.with_name(path.name + '.tmp')
+        save_checkpoint(tmp_path, step, state, compress_walkers=self.compress_walkers)
+        with tmp_path.open('rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def wait(self):
+        r"""Wait until all pending checkpoints are written."""
+        self.writer.wait()
+
     def close(self):
-        if self.buffer and not any(tree_map(lambda x: x.is_deleted(), self.buffer[1])):
+        if (
+            self.buffer
+            and not (self.chkpts and self.chkpts[-1].step == self.buffer[0])
+            and not any(
+                isinstance(x, jax.Array) and x.is_deleted()
+                for x in tree_leaves(self.buffer[1])
+            )
+        ):
             self.dump()
         # If the training crashes KFAC might have already freed the buffers and the
         # state can no longer be dumped. Preventing this by keeping a copy significantly
         # impacts the performance and is therefore omitted.
+        self.writer.close()
 
     @property
     def last(self):
-        chkpt = self.chkpts[-1]
-        with chkpt.path.open('rb') as f:
-            return pickle.load(f)
+        self.wait()
+        return load_checkpoint(self.chkpts[-1].path, mmap=False)
 
 
 class H5LogTable:
-    r"""An interface for writing results to HDF5 files."""
+    r"""An interface for writing results to HDF5 files.
+
+    The rows are buffered in memory and appended to the datasets in a single
+    write per dataset, see :class:`H5LogWriter`. Rows on the device are transferred
+    to the host only when written.
+
+    Args:
+        group (h5py.Group): the group holding the datasets.
+        chunk_size (int): maximum number of rows in a chunk of the datasets.
+        compression (str): optional, the compression filter of the datasets,
+            e.g., ``'gzip'``.
+    """
+
+    CHUNK_BYTES = 2**20
 
-    def __init__(self, group):
+    def __init__(self, group, *, chunk_size=1000, compression=None):
         self._group = group
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self._rows = {}
 
     def __getitem__(self, label):
         return self._group[label] if label in self._group else []
 
-    def resize(self, size):
-        for ds in self._group.values():
-            ds.resize(size, axis=0)
+    def resize(self, size, decimated=()):
+        r"""Truncate the datasets to the rows of the first :data:`size` steps.
+
+        Args:
+            size (int): the number of steps.
+            decimated (Sequence[str]): optional, the labels of the datasets that
+                hold rows only for the steps recorded in the ``step`` dataset,
+                which are truncated to the rows of the steps before :data:`size`.
+        """
+        n_recorded = size
+        if 'step' in self._group:
+            n_recorded = int(np.searchsorted(self._group['step'][:], size))
+        for label, ds in self._group.items():
+            ds.resize(n_recorded if label in decimated else size, axis=0)
+
+    def take_rows(self):
+        r"""Return the buffered rows and start a new buffer."""
+        rows, self._rows = self._rows, {}
+        return rows
+
+    def write_rows(self, rows):
+        r"""Append rows returned by :meth:`take_rows` to the datasets."""
+        for label, label_rows in rows.items():
+            label_rows = np.stack(jax.device_get(label_rows))
+            n_rows, shape = len(label_rows), label_rows.shape[1:]
+            if label not in self._group:
+                # chunks of about a megabyte for the rows of all walkers
+                row_bytes = max(label_rows[0].nbytes, 1)
+                chunk_rows = max(1, min(self.chunk_size, self.CHUNK_BYTES // row_bytes))
+                self._group.create_dataset(
+                    label,
+                    (0, *shape),
+                    maxshape=(None, *shape),
+                    dtype=label_rows.dtype,
+                    chunks=(chunk_rows, *shape),
+                    compression=self.compression,
+                )
+            ds = self._group[label]
+            ds.resize(ds.shape[0] + n_rows, axis=0)
+            ds[-n_rows:] = label_rows
 
     # mimicking Pytables API
     @property
     def row(self):
         class Appender:
             def __setitem__(_, label, row):  # noqa: B902, N805
-                if isinstance(row, np.ndarray):
-                    shape = row.shape
-                elif isinstance(row, jnp.ndarray):
-                    shape = row.shape
-                elif isinstance(row, (float, int)):
-                    shape = ()
-                if label not in self._group:
-                    if isinstance(row, np.ndarray):
-                        dtype = row.dtype
-                    elif isinstance(row, float):
-                        dtype = float
-                    else:
-                        dtype = None
-                    self._group.create_dataset(
-                        label, (0, *shape), maxshape=(None, *shape), dtype=dtype
-                    )
-                ds = self._group[label]
-                ds.resize(ds.shape[0] + 1, axis=0)
-                ds[-1, ...] = row
+                self._rows.setdefault(label, []).append(row)
 
         return Appender()
 
 
+class H5LogWriter:
+    r"""Write the results buffered in tables of an HDF5 file in the background.
+
+    The buffered rows of all tables are written on a background thread after every
+    :data:`flush_every` steps, or once :data:`flush_interval` seconds passed since
+    the last write. The file is flushed after each write, such that readers in the
+    SWMR mode see complete steps.
+
+    Args:
+        h5file (h5py.File): the file holding the tables.
+        flush_every (int): maximum number of steps buffered.
+        flush_interval (float): maximum number of seconds between two writes.
+        max_pending (int): maximum number of writes waiting to be run.
+        table_kwargs: extra arguments for the :class:`H5LogTable`.
+    """
+
+    def __init__(
+        self,
+        h5file,
+        *,
+        flush_every=100,
+        flush_interval=60.0,
+        max_pending=2,
+        **table_kwargs,
+    ):
+        self.h5file = h5file
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.table_kwargs = table_kwargs
+        self.tables = []
+        self.n_steps = 0
+        self.last_flush = time.monotonic()
+        self.writer = _BackgroundWriter(max_pending)
+
+    def table(self, group):
+        r"""Create a table whose rows are written by the writer."""
+        table = H5LogTable(group, **self.table_kwargs)
+        self.tables.append(table)
+        return table
+
+    def step(self):
+        r"""Mark the end of a step, writing the buffered rows if due."""
+        self.n_steps += 1
+        if (
+            self.n_steps >= self.flush_every
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        r"""Write the buffered rows of all tables."""
+        rows = [table.take_rows() for table in self.tables]
+        self.writer.submit(partial(self._write, rows))
+        self.n_steps = 0
+        self.last_flush = time.monotonic()
+
+    def _write(self, rows):
+        for table, table_rows in zip(self.tables, rows):
+            table.write_rows(table_rows)
+        self.h5file.flush()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
 class TensorboardMetricLogger:
     r"""An interface for writing metrics to Tensorboard."""
 
@@ -115,15 +426,86 @@ class TensorboardMetricLogger:
             step (int): the step at which to add the new entries.
             stats (dict): a dictionary containing the scalar entries to add.
         """
-        per_mol = stats.pop('per_mol')
-        for k, v in per_mol.items():
+        stats = jax.device_get(stats)
+        for k, v in stats['per_mol'].items():
             for i, writer in enumerate(self.per_mol_writers):
-                if not (jnp.isnan(v[i]) or jnp.isinf(v[i])):
+                if np.isfinite(v[i]):
                     writer.add_scalar(f'{prefix}/{k}' if prefix else k, v[i], step)
         for k, v in stats.items():
-            self.global_writer.add_scalar(f'{prefix}/{k}' if prefix else k, v, step)
+            if k != 'per_mol':
+                self.global_writer.add_scalar(f'{prefix}/{k}' if prefix else k, v, step)
 
     def close(self):
         self.global_writer.close()
         for writer in self.per_mol_writers:
             writer.close()
+
+
+class JSONLMetricLogger:
+    r"""An interface for writing metrics to a file with a JSON object per line.
+
+    Each line holds the step, the prefix, the global entries and the lists of the
+    per-molecule entries of an update.
+
+    Args:
+        path (str): the path of the file, which is appended to.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def update(self, step, stats, prefix=None):
+        r"""Append a line with a dictionary of scalar entries.
+
+        Args:
+            step (int): the step at which to add the new entries.
+            stats (dict): a dictionary containing the scalar entries to add.
+        """
+        stats = tree_map(lambda x: np.asarray(x).tolist(), jax.device_get(stats))
+        self.file.write(json.dumps({'step': step, 'prefix': prefix, **stats}) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class AsyncMetricLogger:
+    r"""Write metrics to several metric loggers on a background thread.
+
+    The statistics of an update are transferred to the host at once, and written
+    by the metric loggers on a background thread, such that the training does not
+    wait for the individual entries.
+
+    Args:
+        loggers (list): the metric loggers, e.g., :class:`TensorboardMetricLogger`
+            and :class:`JSONLMetricLogger`.
+        every (int): the number of steps between two logged updates, the updates
+            of the other steps are dropped.
+        max_pending (int): maximum number of updates waiting to be written.
+    """
+
+    def __init__(self, loggers, *, every=1, max_pending=100):
+        self.loggers = loggers
+        self.every = every
+        self.writer = _BackgroundWriter(max_pending)
+
+    def update(self, step, stats, prefix=None):
+        r"""Log a dictionary of scalar entries.
+
+        Args:
+            step (int): the step at which to add the new entries.
+            stats (dict): a dictionary containing the scalar entries to add.
+            prefix (str): optional, the prefix of the names of the entries.
+        """
+        if step % self.every:
+            return
+        stats = jax.device_get(stats)
+        self.writer.submit(partial(self._write, step, stats, prefix))
+
+    def _write(self, step, stats, prefix):
+        for logger in self.loggers:
+            logger.update(step, stats, prefix)
+
+    def close(self):
+        self.writer.close()
+        for logger in self.loggers:
+            logger.close()
@@ -0,0 +1,94 @@
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+from jax import core, lax
+
+__all__ = ()
+
+DEVICE_AXIS = 'device'
+
+pmap = partial(jax.pmap, axis_name=DEVICE_AXIS)
+
+
+def in_pmap():
+    r"""Return whether the current computation is mapped over the devices."""
+    try:
+        core.axis_frame(DEVICE_AXIS)
+    except NameError:
+        return False
+    return True
+
+
+def all_device_mean(x):
+    r"""Average a quantity over all devices, if computed per device."""
+    return lax.pmean(x, DEVICE_AXIS) if in_pmap() else x
+
+
+def all_device_gather(x):
+    r"""Concatenate a per-device walker quantity from all devices."""
+    return lax.all_gather(x, DEVICE_AXIS, tiled=True) if in_pmap() else x
+
+
+def select_device_walkers(x, n_walkers):
+    r"""Take the walkers of the current device from a gathered quantity.
+
+    Args:
+        x: a pytree gathered with :func:`all_device_gather`.
+        n_walkers (int): the number of walkers on each device.
+    """
+    if not in_pmap():
+        return x
+    start = lax.axis_index(DEVICE_AXIS) * n_walkers
+    return jax.tree_util.tree_map(
+        lambda x: lax.dynamic_slice_in_dim(x, start, n_walkers), x
+    )
+
+
+def split_on_devices(tree, n_devices, axis=0):
+    r"""Split the walkers of a pytree into equal parts along a new device axis.
+
+    Leaves without a walker axis, such as the step size of the samplers, are
+    copied to all devices.
+
+    Args:
+        tree: the pytree to split.
+        n_devices (int): the number of devices.
+        axis (int): the walker axis of the leaves.
+    """
+
+    def split(x):
+        x = jnp.asarray(x)
+        if x.ndim <= axis:
+            return jnp.broadcast_to(x, (n_devices, *x.shape))
+        if x.shape[axis] % n_devices:
+            raise ValueError(
+                f'Number of walkers ({x.shape[axis]}) must be divisible by the number '
+                f'of devices ({n_devices})'
+            )
+        x = x.reshape(*x.shape[:axis], n_devices, -1, *x.shape[axis + 1 :])
+        return jnp.moveaxis(x, axis, 0)
+
+    return jax.tree_util.tree_map(split, tree)
+
+
+def gather_on_one_device(tree, axis=0):
+    r"""Merge the device axis of a pytree split with :func:`split_on_devices`."""
+
+    def gather(x):
+        if x.ndim <= axis + 1:
+            return x[0]
+        x = jnp.moveaxis(x, 0, axis)
+        return x.reshape(*x.shape[:axis], -1, *x.shape[axis + 2 :])
+
+    return jax.tree_util.tree_map(gather, tree)
+
+
+def replicate_on_devices(tree, n_devices):
+    r"""Copy a pytree, such as the parameters, to all devices."""
+    return jax.device_put_replicated(tree, jax.local_devices()[:n_devices])
+
+
+def select_one_device(tree):
+    r"""Take the copy of a pytree replicated with :func:`replicate_on_devices`."""
+    return jax.tree_util.tree_map(lambda x: x[0], tree)
@@ -1,9 +1,11 @@
 import jax
 import jax.numpy as jnp
+import jax_dataclasses as jdc
 from scipy.special import legendre
 
+from .precision import cast_to_compute, cast_to_output, output_dtype
 from .types import PhysicalConfiguration
-from .utils import norm, rot_y, rot_z, sph2cart, triu_flat
+from .utils import chunked_vmap, norm, rot_y, rot_z, sph2cart, triu_flat
 
 __all__ = ()
 
@@ -19,11 +21,10 @@ def pairwise_diffs(coords1, coords2):
 
 def pairwise_self_distance(coords, full=False):
     i, j = jnp.triu_indices(coords.shape[-2], k=1)
-    diffs = coords[..., :, None, :] - coords[..., None, :, :]
-    dists = norm(diffs[..., i, j, :], safe=True, axis=-1)
+    dists = norm(coords[..., i, :] - coords[..., j, :], safe=True, axis=-1)
     if full:
         dists = (
-            jnp.zeros(diffs.shape[:-1])
+            jnp.zeros((*coords.shape[:-1], coords.shape[-2]))
             .at[..., i, j]
             .set(dists)
             .at[..., j, i]
@@ -32,6 +33,58 @@ def pairwise_self_distance(coords, full=False):
     return dists
 
 
+@jdc.pytree_dataclass
+class PairwiseGeometry:
+    r"""Hold the pairwise geometry of a physical configuration.
+
+    Computed once per configuration with :func:`pairwise_geometry`, and shared by
+    the wave function and the Hamiltonian, instead of each of them recomputing
+    the electron-nucleus and electron-electron differences and distances.
+
+    Args:
+        diffs_nuc (float, (:math:`N`, :math:`M`, 4)): the electron-nucleus
+            differences, with the squared distances appended, as returned by
+            :func:`pairwise_diffs`.
+        dists_nuc (float, (:math:`N`, :math:`M`)): the electron-nucleus distances.
+        inv_dists_nuc (float, (:math:`N`, :math:`M`)): their inverses.
+        dists_elec (float, (:math:`N`, :math:`N`)): the electron-electron
+            distances, with zeros on the diagonal.
+        inv_dists_elec (float, (:math:`N`, :math:`N`)): their inverses, with zeros
+            on the diagonal.
+    """
+
+    diffs_nuc: jnp.ndarray
+    dists_nuc: jnp.ndarray
+    inv_dists_nuc: jnp.ndarray
+    dists_elec: jnp.ndarray
+    inv_dists_elec: jnp.ndarray
+
+
+def pairwise_geometry(phys_conf):
+    r"""Compute the :class:`PairwiseGeometry` of a physical configuration.
+
+    The electron-electron distances are evaluated only for the upper triangle of
+    electron pairs.
+    """
+    diffs_nuc = pairwise_diffs(phys_conf.r, phys_conf.R)
+    dists_nuc = jnp.sqrt(diffs_nuc[..., -1])
+    i, j = jnp.triu_indices(phys_conf.r.shape[-2], k=1)
+    dists = pairwise_self_distance(phys_conf.r)
+
+    def symmetric(x):
+        return (
+            jnp.zeros((*phys_conf.r.shape[:-1], phys_conf.r.shape[-2]))
+            .at[..., i, j]
+            .set(x)
+            .at[..., j, i]
+            .set(x)
+        )
+
+    return PairwiseGeometry(
+        diffs_nuc, dists_nuc, 1 / dists_nuc, symmetric(dists), symmetric(1 / dists)
+    )
+
+
 def nuclear_energy(phys_conf, mol):
     coulombs = triu_flat(
         mol.ns_valence[:, None] * mol.ns_valence
@@ -39,23 +92,36 @@ def nuclear_energy(phys_conf, mol):
     return coulombs.sum()
 
 
-def electronic_potential(phys_conf):
+def electronic_potential(phys_conf, geometry=None):
+    if geometry is not None:
+        return triu_flat(geometry.inv_dists_elec).sum(axis=-1)
     dists = pairwise_self_distance(phys_conf.r)
     return (1 / dists).sum(axis=-1)
 
 
-def local_potential(phys_conf, mol):
+def local_potential(phys_conf, mol, geometry=None):
     """Return the local or nuclear potential of the whole system.
 
     Evaluates either the classical nuclear potential V_nuc(r) = -Z/r or the local
     part of the potentials V_loc(r) from [Burkatzki et al. 2007] eq. (4) or
     from [Annaberdiyev et al. 2018] eq. (3). Returns the sum of all the local potential
     contributions from all the electrons and nuclei.
+
+    Args:
+        phys_conf (:class:`deepqmc.types.PhysicalConfiguration`): electron and
+            nuclear coordinates.
+        mol (:class:`deepqmc.Molecule`): the molecule.
+        geometry (PairwiseGeometry): optional, the precomputed geometry of
+            :data:`phys_conf`.
     """
 
-    dists = pairwise_distance(phys_conf.r, phys_conf.R)
+    if geometry is None:
+        dists = pairwise_distance(phys_conf.r, phys_conf.R)
+        inv_dists = 1 / dists
+    else:
+        dists, inv_dists = geometry.dists_nuc, geometry.inv_dists_nuc
     Z_eff = mol.charges - mol.ns_core  # effective charge of the nuclei
-    effective_coulomb_potential = -(Z_eff / dists).sum(axis=(-1, -2))
+    effective_coulomb_potential = -(Z_eff * inv_dists).sum(axis=(-1, -2))
     if not mol.any_pp:
         return effective_coulomb_potential
 
@@ -65,7 +131,7 @@ def local_potential(phys_conf, mol):
     r_en = dists[:, idxs]  # electron-nucleus distances for all electrons and PP nuclei
 
     coulomb_term = jnp.einsum(
-        'ij,ki->kji', loc_params[idxs, 0, 1, :], 1 / r_en
+        'ij,ki->kji', loc_params[idxs, 0, 1, :], inv_dists[:, idxs]
     ) * jnp.exp(jnp.einsum('ij,ki->kji', -loc_params[idxs, 0, 0, :], r_en**2))
     const_term = jnp.einsum(
         'ij,kji->kji',
@@ -100,18 +166,19 @@ def get_unit_icosahedron_sph():
 # UNIT_ICOSAHEDRON is (12,3) array of unit icosahedron vertices
 UNIT_ICOSAHEDRON = sph2cart(get_unit_icosahedron_sph())
 QUADRATURE_THETAS = get_unit_icosahedron_sph()[:, 0]
+WF_RATIOS = ('exact', 'locality')
 
 
 def get_quadrature_points(rng, nucleus_position, phys_conf):
     """
-    Transform :data:`phys_conf` of size (N,3) into an array quadrature points.
+    Return the quadrature points of the electrons around a nucleus.
 
-    Return a phys_conf of size (N,12,N,3) that includes all the 12 quadrature point
-    configurations (i.e. reference electron position is shifted to another icosahedron
-    vertex) corresponding to N different reference electron.
+    Return an array of size (N,12,3) with the positions of the 12 quadrature points
+    (i.e. the reference electron position rotated to the randomly oriented
+    icosahedron vertices) of each of the N electrons. Only the displaced electron is
+    stored, the full configurations are obtained with :func:`displace_electron`.
     """
 
-    N = len(phys_conf)
     norm = jnp.linalg.norm(phys_conf.r - nucleus_position, axis=-1)
     theta = jnp.arccos((phys_conf.r - nucleus_position)[..., 2] / norm)
     phi = jnp.arctan2(
@@ -130,44 +197,131 @@ def get_quadrature_points(rng, nucleus_position, phys_conf):
     def transform_coordinates(norm, z_rot, y_rot, z_rot_random, r, nucleus_position):
         return norm * (z_rot @ y_rot @ z_rot_random @ r) + nucleus_position
 
-    # vmapping to include N different rotations corresponding to each electron position
-    transform_coordinates = jax.vmap(
-        transform_coordinates, in_axes=(-1, -3, -3, -3, None, None)
-    )
     # vmapping to be able to transform all 12 icosahedron points at the same time
     transform_coordinates = jax.vmap(
         transform_coordinates, in_axes=(None, None, None, None, -2, None)
     )
+    # vmapping to include N different rotations corresponding to each electron position
+    transform_coordinates = jax.vmap(
+        transform_coordinates, in_axes=(-1, -3, -3, -3, None, None)
+    )
 
-    quadrature_points = transform_coordinates(
+    return transform_coordinates(
         norm, z_rot, y_rot, z_rot_random, UNIT_ICOSAHEDRON, nucleus_position
-    )  # shape: (12,N,3)
-    # we still need to pad the quadrature points with other electron's coordinates
-    quadrature_points_copied = jnp.tile(quadrature_points, (N, 1, 1, 1))
-    rs_copied = jnp.tile(phys_conf.r, (N, 12, 1, 1))
-    criterion = jnp.moveaxis(
-        jnp.moveaxis(jnp.tile(jnp.eye(N), (12, 3, 1, 1)), -3, -1), -4, -3
-    )
-    quadrature_rs = jnp.where(
-        criterion, quadrature_points_copied, rs_copied
-    )  # shape: (N,12,N,3)
+    )  # shape: (N,12,3)
+
+
+def displace_electron(phys_conf, i, r_i):
+    r"""Return :data:`phys_conf` with the :data:`i`-th electron moved to :data:`r_i`."""
     return PhysicalConfiguration(
-        jnp.tile(phys_conf.R[None, None], (N, 12, 1, 1)),
-        quadrature_rs,
-        jnp.broadcast_to(phys_conf.mol_idx, (N, 12)),
+        phys_conf.R, phys_conf.r.at[i].set(r_i), phys_conf.mol_idx
+    )
+
+
+def slater_matrix(orb_up, orb_down):
+    r"""Assemble the Slater matrices from the spin-up and spin-down orbitals.
+
+    For wave functions with spin-factorized determinants the matrices are assembled
+    block-diagonally, such that their determinants equal the products of the
+    spin-up and spin-down determinants.
+
+    Returns:
+        float, (:math:`N_\text{det}`, :math:`N`, :math:`N`): the Slater matrices,
+        rows correspond to electrons, columns to orbitals.
+    """
+    n_up, n_down = orb_up.shape[-2], orb_down.shape[-2]
+    if orb_up.shape[-1] == n_up + n_down:
+        return jnp.concatenate([orb_up, orb_down], axis=-2)
+    return jnp.concatenate(
+        [
+            jnp.pad(orb_up, ((0, 0), (0, 0), (0, n_down))),
+            jnp.pad(orb_down, ((0, 0), (0, 0), (n_up, 0))),
+        ],
+        axis=-2,
+    )
+
+
+def locality_wf_ratio(wf, phys_conf):
+    r"""Return the wave function ratios within the locality approximation.
+
+    The backflow and the Jastrow factor are frozen at :data:`phys_conf`, such that
+    moving the :math:`i`-th electron changes only the :math:`i`-th rows of the
+    Slater matrices, and the ratios of the determinants follow from the matrix
+    determinant lemma. At the displaced configurations only the orbitals without
+    the backflow have to be evaluated.
+
+    Args:
+        wf (deepqmc.wf.WaveFunction): the wave function ansatz, supporting
+            :data:`return_mos='frozen'`.
+        phys_conf (:class:`deepqmc.types.PhysicalConfiguration`): the reference
+            electron and nuclear coordinates.
+
+    Returns:
+        :class:`Callable[phys_conf, i]`: a function that returns the ratio of the
+        wave function at :data:`phys_conf`, which differs from the reference in the
+        position of the :math:`i`-th electron, to the wave function at the
+        reference.
+    """
+    frozen = wf(phys_conf, return_mos='frozen')
+    env, orb, mult = (
+        slater_matrix(*frozen[k]) for k in ('envelope', 'orbitals', 'mult')
     )
+    orb_inv = jnp.linalg.inv(orb)
+
+    def wf_ratio(phys_conf, i):
+        env_i = slater_matrix(*wf(phys_conf, return_mos='envelope'))[:, i]
+        row = orb[:, i] + (env_i - env[:, i]) * mult[:, i]
+        det_ratios = jnp.einsum('kj,kj->k', row, orb_inv[:, :, i])
+        return jnp.sum(frozen['det_weights'] * det_ratios)
+
+    return wf_ratio
 
 
-def nonlocal_potential(rng, phys_conf, mol, wf):
+def pp_nl_cutoff_radius(nl_params, tol):
+    r"""Return the radius beyond which the nonlocal pseudopotential is negligible.
+
+    Args:
+        nl_params (float, (:math:`l_\text{max}+1`, 2, :math:`N_\text{terms}`)):
+            the exponents and coefficients of the Gaussian terms of the nonlocal
+            pseudopotential of one element, padded by zeros.
+        tol (float): the magnitude below which a Gaussian term is neglected.
+    """
+    alphas, coefs = nl_params[..., 0, :], jnp.abs(nl_params[..., 1, :])
+    significant = coefs > tol
+    r_sq = jnp.where(
+        significant,
+        jnp.log(jnp.where(significant, coefs / tol, 1.0))
+        / jnp.where(significant, alphas, 1.0),
+        0.0,
+    )
+    return jnp.sqrt(r_sq.max())
+
+
+def nonlocal_potential(
+    rng,
+    phys_conf,
+    mol,
+    wf,
+    psi=None,
+    *,
+    wf_ratio='exact',
+    screening_tol=None,
+    screening_capacity=None,
+    quadrature_chunk_size=12,
+    geometry=None,
+    return_overflow=False,
+):
     r"""Calculate the non-local term of the pseudopotential.
 
     Formulas are based on data from [Burkatzki et al. 2007] or
     [Annaberdiyev et al. 2018]. Numerical calculation of integrals is based
     on [Li et al. 2022] where 12-point icosahedron quadrature is used.
-    The current implementation is using jax.lax.fori_loop instead of vmap over
-    the index of the rotated electron. This causes roughly 10% slowdown compared
-    to plain vmap, but avoids OOM issues. Further OOM errors could be resolved by
-    replacing the remaining vmap with fori_loop over the 12 quadrature points.
+    Only the positions of the displaced electrons are stored, and the quadrature
+    configurations are assembled within chunks of :data:`quadrature_chunk_size`
+    points, which are evaluated one after another. This trades throughput for
+    memory: chunks of 12 points (the default) evaluate one electron at a time,
+    smaller chunks can resolve further OOM issues, and evaluating all points at
+    once is fastest.
 
     Args:
         phys_conf (:class:`deepqmc.types.PhysicalConfiguration`): electron and
@@ -175,15 +329,59 @@ def nonlocal_potential(rng, phys_conf, mol, wf):
         mol (:class:`deepqmc.Molecule`): a molecule that is used to load the
             pseudopotential parameters.
         wf (deepqmc.wf.WaveFunction): the wave function ansatz.
+        psi (~deepqmc.types.Psi): optional, the value of the wave function at
+            :data:`phys_conf`, if already known.
+        wf_ratio (str): optional, how the wave function ratios at the quadrature
+            points are evaluated, either ``'exact'``, or ``'locality'`` for the
+            locality approximation (see :func:`locality_wf_ratio`).
+        screening_tol (float): optional, if given, the quadrature is evaluated
+            only for the electrons within the cutoff radius of each core, outside
+            of which all Gaussian terms of the nonlocal pseudopotential are
+            smaller than :data:`screening_tol` (see :func:`pp_nl_cutoff_radius`).
+        screening_capacity (int): optional, the static number of electrons
+            nearest to each core that are considered for the quadrature when
+            screening, defaults to twice the largest number of valence electrons
+            of the cores with a pseudopotential. The cost of the nonlocal
+            pseudopotential scales with this number rather than with the number
+            of electrons. If more electrons are within the cutoff radius, the most
+            distant ones are neglected, and their number is reported with
+            :data:`return_overflow`.
+        quadrature_chunk_size (int): optional, the number of quadrature points
+            evaluated at once, all points are evaluated at once if :data:`None`.
+        geometry (PairwiseGeometry): optional, the precomputed geometry of
+            :data:`phys_conf`.
+        return_overflow (bool): optional, whether to return also the number of
+            electrons within the cutoff radii of the cores, which are neglected
+            because they exceed the screening capacity.
     """
 
-    # get value of the denominator (which is constant)
-    denominator_wf_sign, denominator_wf_exponent = wf(phys_conf)
+    if wf_ratio not in WF_RATIOS:
+        raise ValueError(f'Unknown wave function ratio: {wf_ratio!r}')
+    if wf_ratio == 'locality':
+        locality_ratio = locality_wf_ratio(wf, phys_conf)
+    else:
+        # get value of the denominator (which is constant)
+        denominator_wf_sign, denominator_wf_exponent = (
+            wf(phys_conf) if psi is None else psi
+        )
+
+    def wf_ratio_fn(i, r_i):
+        quadrature_phys_conf = displace_electron(phys_conf, i, r_i)
+        if wf_ratio == 'locality':
+            return locality_ratio(quadrature_phys_conf, i)
+        # numerator
+        sign, exponent = wf(quadrature_phys_conf)
+        return denominator_wf_sign * sign * jnp.exp(exponent - denominator_wf_exponent)
 
     pp_nl_params = jnp.array(mol.pp_nl_params)
+    n_elec = len(phys_conf.r)
     nuc_with_nl_pot = mol.nuc_with_nl_pot  # filter out masked nuclei
+    n_screened = min(
+        screening_capacity or int(2 * mol.ns_valence[nuc_with_nl_pot].max()), n_elec
+    )
 
-    def add_nl_potential_for_one_nucleus(i, val):
+    def add_nl_potential_for_one_nucleus(i, carry):
+        val, n_overflow = carry
         nucleus_index = nuc_with_nl_pot[i]
         nl_params = pp_nl_params[nucleus_index]
         l_max_p1 = nl_params.shape[0]  # l_max_p1 = l_max + 1
@@ -196,68 +394,147 @@ def nonlocal_potential(rng, phys_conf, mol, wf):
             axis=-1,
         )
 
-        quadrature_phys_conf = get_quadrature_points(
-            rng, phys_conf.R[nucleus_index], phys_conf
-        )
-
         # (2l+1)/12 coefficient
-        coefs = jnp.tile(
-            (jnp.arange(l_max_p1) * 2 + 1) / 12, (len(phys_conf.r), 1)
-        )  # shape: (N,l_max)
+        coefs = (jnp.arange(l_max_p1) * 2 + 1) / 12  # shape: (l_max,)
 
-        dists = pairwise_distance(phys_conf.r, phys_conf.R[nucleus_index, None])
+        dists = (
+            pairwise_distance(phys_conf.r, phys_conf.R[nucleus_index, None])
+            if geometry is None
+            else geometry.dists_nuc[:, nucleus_index, None]
+        )
+        if screening_tol is None:
+            elec_idxs = jnp.arange(n_elec)
+            is_near = jnp.ones(n_elec, bool)
+        else:
+            is_near = dists[:, 0] < pp_nl_cutoff_radius(nl_params, screening_tol)
+            n_overflow += jnp.maximum(is_near.sum() - n_screened, 0)
+            elec_idxs = jnp.argsort(dists[:, 0])[:n_screened]
+            is_near = is_near[elec_idxs]
         nl_pot_coefs = jnp.einsum(
             'kj,ikj->ikj',
             nl_params[:, 1, :],
             jnp.exp(-jnp.einsum('ij,kj->ikj', (dists**2), nl_params[:, 0, :])),
         ).sum(axis=-1)
+        nl_pot_coefs = nl_pot_coefs[elec_idxs]  # shape: (n_screened,l_max)
 
-        def nl_potential_for_one_nucleus_and_one_electron(
-            i,
-            val,
-            quadrature_phys_conf=quadrature_phys_conf,
-            legendre_values=legendre_values,
-            coefs=coefs,
-            nl_pot_coefs=nl_pot_coefs,
-        ):
-            # numerator
-            sign, exponent = jax.vmap(wf)(quadrature_phys_conf[i])  # shape (12,)
-            wf_ratio = (
-                denominator_wf_sign * sign * jnp.exp(exponent - denominator_wf_exponent)
-            )  # shape (12,)
-            wf_ratio_tile = wf_ratio[..., None] * legendre_values  # shape (12,l_max)
-            # sum over 12 "virtual" electron configurations
-            num_integral_one_e = jnp.sum(wf_ratio_tile, axis=-2)  # shape (1,)
-            coef = coefs[i]  # shape (l_max,)
-            nl_pot_coef = nl_pot_coefs[i]  # shape (1,)
-            nl_potential_one_e = jnp.sum(
-                nl_pot_coef * coef * num_integral_one_e, axis=(-1,)
-            )  # shape ()
-            return val + nl_potential_one_e
-
-        nl_potential_for_one_nucleus = jax.lax.fori_loop(
-            0,
-            mol.ns_valence.astype(int).sum(),
-            nl_potential_for_one_nucleus_and_one_electron,
-            0.0,
+        quadrature_points = get_quadrature_points(
+            rng, phys_conf.R[nucleus_index], phys_conf
         )
-        return val + nl_potential_for_one_nucleus
-
-    total_nl_potential = jax.lax.fori_loop(
-        0, len(nuc_with_nl_pot), add_nl_potential_for_one_nucleus, 0.0
+        quadrature_points = quadrature_points[elec_idxs]  # shape: (n_screened,12,3)
+        wf_ratios = chunked_vmap(wf_ratio_fn, quadrature_chunk_size)(
+            jnp.repeat(elec_idxs, 12), quadrature_points.reshape(-1, 3)
+        )
+        wf_ratios = wf_ratios.reshape(-1, 12)  # shape: (n_screened,12)
+        # sum over 12 "virtual" electron configurations
+        num_integrals = wf_ratios @ legendre_values  # shape: (n_screened,l_max)
+        nl_potentials = jnp.sum(nl_pot_coefs * coefs * num_integrals, axis=-1)
+        return val + jnp.where(is_near, nl_potentials, 0.0).sum(), n_overflow
+
+    total_nl_potential, n_overflow = jax.lax.fori_loop(
+        0, len(nuc_with_nl_pot), add_nl_potential_for_one_nucleus, (0.0, 0)
     )
 
-    return total_nl_potential
+    return (total_nl_potential, n_overflow) if return_overflow else total_nl_potential
 
 
-def laplacian(f):
+def laplacian(f, has_aux=False):
+    r"""Compute the Laplacian and the gradient of a scalar function.
+
+    Args:
+        f (Callable): the function of a flat coordinate vector.
+        has_aux (bool): optional, if :data:`True`, :data:`f` returns a pair of its
+            value and auxiliary data, which is returned as the third element
+            without evaluating :data:`f` again.
+    """
+
     def lap(x):
+        x = cast_to_compute('laplacian', x)
         n_coord = len(x)
-        grad_f = jax.grad(f)
+        grad_f = jax.grad(f, has_aux=has_aux)
+        df, grad_f_jvp = jax.linearize(grad_f, x)
+        eye = jnp.eye(n_coord, dtype=x.dtype)
+        if has_aux:
+            df, aux = df
+            d2f_i = lambda i: grad_f_jvp(eye[i])[0][i]
+        else:
+            d2f_i = lambda i: grad_f_jvp(eye[i])[i]
+        d2f = lambda i, val: val + cast_to_output('laplacian', d2f_i(i))
+        d2f_sum = jax.lax.fori_loop(
+            0, n_coord, d2f, jnp.zeros((), output_dtype('laplacian', df.dtype))
+        )
+        df = cast_to_output('laplacian', df)
+        return (d2f_sum, df, aux) if has_aux else (d2f_sum, df)
+
+    return lap
+
+
+def forward_laplacian(f, has_aux=False):
+    r"""Compute the Laplacian and the gradient of a scalar function in forward mode.
+
+    The value, the first derivatives and the diagonal second derivatives are
+    propagated together through a single forward evaluation of :data:`f`, which is
+    vectorized over all coordinate directions, instead of a sequence of
+    Hessian-vector products. The value is computed only once, since it does not
+    depend on the direction. Has the same interface as :func:`laplacian`.
+    """
+
+    def lap(x):
+        x = cast_to_compute('laplacian', x)
+
+        def f_aux(x):
+            return f(x) if has_aux else (f(x), None)
+
+        def derivatives(v):
+            def df(x):
+                _, df, aux = jax.jvp(f_aux, (x,), (v,), has_aux=True)
+                return df, aux
+
+            df, d2f, aux = jax.jvp(df, (x,), (v,), has_aux=True)
+            return df, d2f, aux
+
+        df, d2f, aux = jax.vmap(derivatives, out_axes=(0, 0, None))(
+            jnp.eye(len(x), dtype=x.dtype)
+        )
+        d2f, df = cast_to_output('laplacian', (d2f.sum(), df))
+        return (d2f, df, aux) if has_aux else (d2f, df)
+
+    return lap
+
+
+LAPLACIANS = {'hvp': laplacian, 'forward': forward_laplacian}
+
+
+PROBES = {'rademacher': jax.random.rademacher, 'gaussian': jax.random.normal}
+
+
+def hutchinson_laplacian(f, rng, n_probes, probes='rademacher', has_aux=False):
+    r"""Estimate the Laplacian of a scalar function with random probes.
+
+    The trace of the Hessian is estimated without bias as the mean of
+    :math:`\mathbf v^T\mathbf H\mathbf v` over :data:`n_probes` random vectors
+    with :math:`\mathbb E[\mathbf v\mathbf v^T]=\mathbf 1`, which requires
+    :data:`n_probes` Hessian-vector products instead of one per coordinate. The
+    gradient is exact. Has otherwise the same interface as :func:`laplacian`.
+
+    Args:
+        f (Callable): the function of a flat coordinate vector.
+        rng (jax.random.PRNGKey): key used for sampling the probes.
+        n_probes (int): the number of probe vectors.
+        probes (str): optional, the distribution of the probe vectors, either
+            ``'rademacher'`` or ``'gaussian'``.
+        has_aux (bool): optional, see :func:`laplacian`.
+    """
+
+    def lap(x):
+        x = cast_to_compute('laplacian', x)
+        grad_f = jax.grad(f, has_aux=has_aux)
         df, grad_f_jvp = jax.linearize(grad_f, x)
-        eye = jnp.eye(n_coord)
-        d2f = lambda i, val: val + grad_f_jvp(eye[i])[i]
-        d2f_sum = jax.lax.fori_loop(0, n_coord, d2f, 0.0)
-        return d2f_sum, df
+        v = PROBES[probes](rng, (n_probes, len(x)), x.dtype)
+        hv = jax.vmap(grad_f_jvp)(v)
+        if has_aux:
+            (df, aux), hv = df, hv[0]
+        d2f = cast_to_output('laplacian', jnp.sum(v * hv, axis=-1)).mean()
+        df = cast_to_output('laplacian', df)
+        return (d2f, df, aux) if has_aux else (d2f, df)
 
     return lap
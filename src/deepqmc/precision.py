@@ -0,0 +1,159 @@
+from contextlib import contextmanager
+from functools import partial
+
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import jmp
+
+__all__ = ()
+
+PRECISION_COMPONENTS = (
+    'gnn',
+    'envelope',
+    'slater',
+    'laplacian',
+    'energy',
+    'curvature',
+)
+
+_policies = {}
+
+
+def _module_classes():
+    from .gnn import ElectronGNN
+    from .wf.nn_wave_function.env import ExponentialEnvelopes
+
+    return {'gnn': ElectronGNN, 'envelope': ExponentialEnvelopes}
+
+
+def _apply_policies(policies):
+    _policies.clear()
+    _policies.update(policies)
+    for component, cls in _module_classes().items():
+        if component in policies:
+            hk.mixed_precision.set_policy(cls, policies[component])
+        else:
+            hk.mixed_precision.clear_policy(cls)
+
+
+def set_precision_policy(precision):
+    r"""Set the precision of the individual components of the computation.
+
+    The components are the graph neural network (``'gnn'``), the orbital envelopes
+    (``'envelope'``), the evaluation of the Slater determinants (``'slater'``), the
+    Laplacian of the wave function (``'laplacian'``), the local energies and their
+    statistics (``'energy'``), and the estimation of the KFAC curvature
+    (``'curvature'``). The inputs of a component are cast to its compute dtype, and
+    its results are accumulated and returned in its output dtype. The parameters
+    of the haiku modules are stored in the param dtype of their policy. Components
+    without a policy run in the default precision, which is double precision if
+    any of the policies refers to :data:`float64`.
+
+    Args:
+        precision (dict): maps the names of the components to their policies,
+            specified as in :func:`jmp.get_policy`, e.g.,
+            ``'params=float32,compute=bfloat16,output=float32'``.
+
+    Returns:
+        the previous policies and double precision flag, which can be restored
+        with :func:`restore_precision_policy`.
+    """
+    unknown = set(precision) - set(PRECISION_COMPONENTS)
+    if unknown:
+        raise ValueError(f'Unknown precision components: {sorted(unknown)}')
+    previous = dict(_policies), jax.config.jax_enable_x64
+    policies = {k: jmp.get_policy(v) for k, v in precision.items()}
+    if any(
+        dtype == jnp.float64
+        for policy in policies.values()
+        for dtype in (policy.param_dtype, policy.compute_dtype, policy.output_dtype)
+    ):
+        jax.config.update('jax_enable_x64', True)
+    _apply_policies(policies)
+    return previous
+
+
+def restore_precision_policy(previous):
+    r"""Restore the policies returned by :func:`set_precision_policy`."""
+    policies, enable_x64 = previous
+    jax.config.update('jax_enable_x64', enable_x64)
+    _apply_policies(policies)
+
+
+def clear_precision_policy():
+    r"""Run all components in the default precision."""
+    _apply_policies({})
+
+
+@contextmanager
+def full_precision():
+    r"""Temporarily run all components in the default precision."""
+    policies = dict(_policies)
+    _apply_policies({})
+    try:
+        yield
+    finally:
+        _apply_policies(policies)
+
+
+def cast_to_compute(component, tree):
+    r"""Cast the floating point leaves of a pytree to the compute dtype."""
+    policy = _policies.get(component)
+    return tree if policy is None else policy.cast_to_compute(tree)
+
+
+def cast_to_output(component, tree):
+    r"""Cast the floating point leaves of a pytree to the output dtype."""
+    policy = _policies.get(component)
+    return tree if policy is None else policy.cast_to_output(tree)
+
+
+def output_dtype(component, default):
+    r"""Return the output dtype of a component, or :data:`default` without policy."""
+    policy = _policies.get(component)
+    return default if policy is None else policy.output_dtype
+
+
+def precision_drift(rng, hamil, ansatz, params, phys_conf):
+    r"""Compare the wave function and local energies to a full-precision reference.
+
+    The reference is evaluated without any precision policy, in double precision
+    if enabled.
+
+    Args:
+        rng (~jax.random.PRNGKey): key used for the local energies.
+        hamil (~deepqmc.hamil.Hamiltonian): the Hamiltonian of the physical system.
+        ansatz (~deepqmc.wf.WaveFunction): the wave function ansatz.
+        params (dict): the parameters of the ansatz.
+        phys_conf (~deepqmc.types.PhysicalConfiguration): a batch of
+            configurations.
+
+    Returns:
+        dict: the maximum and mean absolute deviations of the log of the wave
+        function and of the local energies from the reference.
+    """
+    rngs = jax.random.split(rng, len(phys_conf))
+
+    def evaluate(params, phys_conf):
+        wf = partial(ansatz.apply, params)
+        E_loc, _ = jax.vmap(hamil.local_energy(wf))(rngs, phys_conf)
+        return jax.vmap(wf)(phys_conf).log, E_loc
+
+    # new function objects, so that the traces of the policies are not reused
+    log_psi, E_loc = jax.jit(partial(evaluate))(params, phys_conf)
+    with full_precision():
+        dtype = jnp.float64 if jax.config.jax_enable_x64 else jnp.float32
+        params_ref, phys_conf_ref = jmp.Policy(dtype, dtype, dtype).cast_to_param(
+            (params, phys_conf)
+        )
+        log_psi_ref, E_loc_ref = jax.jit(partial(evaluate))(params_ref, phys_conf_ref)
+    stats = {}
+    for name, x, x_ref in [
+        ('log_psi', log_psi, log_psi_ref),
+        ('E_loc', E_loc, E_loc_ref),
+    ]:
+        drift = jnp.abs(x.astype(dtype) - x_ref)
+        stats[f'{name}/max_drift'] = jnp.nanmax(drift)
+        stats[f'{name}/mean_drift'] = jnp.nanmean(drift)
+    return stats
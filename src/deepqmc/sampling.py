@@ -1,6 +1,6 @@
 import logging
 from functools import partial
-from statistics import mean, stdev
+from itertools import islice
 from typing import Sequence
 
 import haiku as hk
@@ -9,13 +9,32 @@ import jax.numpy as jnp
 import jax_dataclasses as jdc
 from jax import lax
 
-from .physics import pairwise_diffs, pairwise_self_distance
+from .parallel import (
+    DEVICE_AXIS,
+    all_device_gather,
+    all_device_mean,
+    gather_on_one_device,
+    pmap,
+    replicate_on_devices,
+    select_one_device,
+    split_on_devices,
+)
+from .physics import pairwise_diffs, pairwise_self_distance, slater_matrix
 from .types import PhysicalConfiguration
-from .utils import multinomial_resampling, split_dict
+from .utils import (
+    exp_normalize_mean,
+    log_effective_sample_size,
+    multinomial_resampling,
+    residual_resampling,
+    split_dict,
+    stratified_resampling,
+    systematic_resampling,
+)
 
 __all__ = [
     'MetropolisSampler',
     'LangevinSampler',
+    'SingleElectronMetropolisSampler',
     'DecorrSampler',
     'ResampledSampler',
     'chain',
@@ -23,14 +42,23 @@ __all__ = [
 
 log = logging.getLogger(__name__)
 
+STATS_LEVELS = ('none', 'cheap', 'full')
+
 
 class Sampler:
-    r"""Base class for all QMC samplers."""
+    r"""Base class for all QMC samplers.
+
+    The :meth:`sample` method of all samplers accepts the keyword argument
+    :data:`stats_level`, which controls the sampling statistics computed
+    along with the samples: ``'none'`` computes no statistics, ``'cheap'`` only
+    those that are linear in the number of walkers, and ``'full'`` additionally
+    the more expensive ones, such as the mean interelectronic distance.
+    """
 
     def init(self, rng, wf, n):
         raise NotImplementedError
 
-    def sample(self, rng, state, wf):
+    def sample(self, rng, state, wf, *, stats_level='full'):
         raise NotImplementedError
 
 
@@ -65,29 +93,33 @@ class MetropolisSampler(Sampler):
         state = {**state, 'psi': psi}
         return state
 
-    def update(self, state, wf, R):
+    def update(self, state, wf, R, rng=None):
         return self._update(state, wf, R)
 
-    def init(self, rng, wf, n, R):
-        state = {
+    def _init_state(self, rng, n, R):
+        return {
             'r': self.hamil.init_sample(rng, R, n).r,
             'age': jnp.zeros(n, jnp.int32),
             'tau': jnp.array(self.initial_tau),
         }
 
+    def init(self, rng, wf, n, R):
+        state = self._init_state(rng, n, R)
         return self._update(state, wf, R)
 
-    def _proposal(self, state, rng):
+    def _proposal(self, state, rng, wf, R):
         r = state['r']
-        return r + state['tau'] * jax.random.normal(rng, r.shape)
+        return r + state['tau'] * jax.random.normal(rng, r.shape), None
 
     def _acc_log_prob(self, state, prop):
         return 2 * (prop['psi'].log - state['psi'].log)
 
-    def sample(self, rng, state, wf, R):
+    def sample(self, rng, state, wf, R, *, stats_level='full'):
+        assert stats_level in STATS_LEVELS
         rng_prop, rng_acc = jax.random.split(rng)
+        r_prop, move_acceptance = self._proposal(state, rng_prop, wf, R)
         prop = {
-            'r': self._proposal(state, rng_prop),
+            'r': r_prop,
             'age': jnp.zeros_like(state['age']),
             **{k: v for k, v in state.items() if k not in self.WALKER_STATE},
         }
@@ -96,10 +128,14 @@ class MetropolisSampler(Sampler):
         accepted = log_prob > jnp.log(jax.random.uniform(rng_acc, log_prob.shape))
         if self.max_age:
             accepted = accepted | (state['age'] >= self.max_age)
-        acceptance = accepted.astype(int).sum() / accepted.shape[0]
+        accepted_all = all_device_gather(accepted)
+        acceptance = accepted_all.astype(int).sum() / accepted_all.shape[0]
+        move_acceptance = (
+            acceptance if move_acceptance is None else all_device_mean(move_acceptance)
+        )
         if self.target_acceptance:
             prop['tau'] /= self.target_acceptance / jnp.max(
-                jnp.stack([acceptance, jnp.array(0.05)])
+                jnp.stack([move_acceptance, jnp.array(0.05)])
             )
         state = {**state, 'age': state['age'] + 1}
         (prop, other), (state, _) = (
@@ -111,15 +147,21 @@ class MetropolisSampler(Sampler):
             ),
             **other,
         }
-        stats = {
-            'sampling/acceptance': acceptance,
-            'sampling/tau': state['tau'],
-            'sampling/age/mean': jnp.mean(state['age']),
-            'sampling/age/max': jnp.max(state['age']),
-            'sampling/log_psi/mean': jnp.mean(state['psi'].log),
-            'sampling/log_psi/std': jnp.std(state['psi'].log),
-            'sampling/dists/mean': jnp.mean(pairwise_self_distance(state['r'])),
-        }
+        stats = {}
+        if stats_level in {'cheap', 'full'}:
+            age, log_psi = all_device_gather((state['age'], state['psi'].log))
+            stats = {
+                'sampling/acceptance': acceptance,
+                'sampling/tau': state['tau'],
+                'sampling/age/mean': jnp.mean(age),
+                'sampling/age/max': jnp.max(age),
+                'sampling/log_psi/mean': jnp.mean(log_psi),
+                'sampling/log_psi/std': jnp.std(log_psi),
+            }
+        if stats_level == 'full':
+            stats['sampling/dists/mean'] = all_device_mean(
+                jnp.mean(pairwise_self_distance(state['r']))
+            )
         return state, self.phys_conf(R, state['r']), stats
 
     def phys_conf(self, R, r, **kwargs):
@@ -138,11 +180,87 @@ class LangevinSampler(MetropolisSampler):
     Langevin Monte Carlo sampler.
 
     Derived from :class:`MetropolisSampler`.
+
+    With :data:`local_energy=True` the local energies of the proposed walkers are
+    evaluated in every step, and the gradient of the log of the wave function
+    obtained together with their Laplacian provides the drift of the next
+    proposal. The accepted walkers carry their local energies and Hamiltonian
+    statistics in the walker state, which are then reused by
+    :func:`~deepqmc.fit.fit_wf` when evaluating the wave function, instead of
+    evaluating the wave function and its derivatives once more. This is
+    intended for evaluations in which every step of the sampler yields a
+    sample, since the Laplacian is also evaluated in decorrelating steps. The
+    keys of the local energies are drawn per walker in every step, and from the
+    key passed to :meth:`update` for walkers taken over from another sampler.
+
+    Args:
+        hamil (~deepqmc.hamil.Hamiltonian): the Hamiltonian of the physical system
+        local_energy (bool): optional, whether to evaluate the local energies
+            of the proposed walkers.
+        kwargs: all other arguments are passed to :class:`MetropolisSampler`.
     """
 
     WALKER_STATE = MetropolisSampler.WALKER_STATE + ['force']
 
+    def __init__(self, hamil, *, local_energy=False, **kwargs):
+        super().__init__(hamil, **kwargs)
+        self.local_energy = local_energy
+        if local_energy:
+            self.WALKER_STATE = self.WALKER_STATE + ['E_loc', 'hamil_stats']
+
+    def _init_state(self, rng, n, R):
+        if not self.local_energy:
+            return super()._init_state(rng, n, R)
+        rng, rng_energy = jax.random.split(rng)
+        return {
+            **super()._init_state(rng, n, R),
+            'energy_rng': jax.random.split(rng_energy, n),
+        }
+
+    def update(self, state, wf, R, rng=None):
+        if self.local_energy and 'energy_rng' not in state:
+            # walkers of another sampler, e.g., restored from a training checkpoint
+            if rng is None:
+                raise ValueError(
+                    'Evaluating the local energies of the walkers requires a key'
+                )
+            state = {**state, 'energy_rng': jax.random.split(rng, len(state['r']))}
+        return self._update(state, wf, R)
+
+    def _update_with_local_energy(self, state, wf, R):
+        phys_conf = self.phys_conf(R, state['r'])
+        (E_loc, force, psi), hamil_stats = jax.vmap(
+            self.hamil.local_energy(wf, return_grad=True, return_psi=True)
+        )(state['energy_rng'], phys_conf)
+        force = clean_force(
+            force.reshape(state['r'].shape),
+            phys_conf,
+            self.hamil.mol,
+            tau=state['tau'],
+        )
+        return {
+            **state,
+            'psi': psi,
+            'force': force,
+            'E_loc': E_loc,
+            'hamil_stats': hamil_stats,
+        }
+
+    def sample(self, rng, state, wf, R, *, stats_level='full'):
+        if self.local_energy:
+            # the keys of the local energies are drawn per walker, such that they
+            # are split along with the walkers between the devices
+            rng, rng_energy = jax.random.split(rng)
+            state = {
+                **state,
+                'energy_rng': jax.random.split(rng_energy, len(state['r'])),
+            }
+        return super().sample(rng, state, wf, R, stats_level=stats_level)
+
     def _update(self, state, wf, R):
+        if self.local_energy:
+            return self._update_with_local_energy(state, wf, R)
+
         @jax.vmap
         @partial(jax.value_and_grad, has_aux=True)
         def wf_and_force(r):
@@ -156,10 +274,10 @@ class LangevinSampler(MetropolisSampler):
         state = {**state, 'psi': psi, 'force': force}
         return state
 
-    def _proposal(self, state, rng):
+    def _proposal(self, state, rng, wf, R):
         r, tau = state['r'], state['tau']
         r = r + tau * state['force'] + jnp.sqrt(tau) * jax.random.normal(rng, r.shape)
-        return r
+        return r, None
 
     def _acc_log_prob(self, state, prop):
         log_G_ratios = jnp.sum(
@@ -173,11 +291,119 @@ class LangevinSampler(MetropolisSampler):
         return log_G_ratios + 2 * (prop['psi'].log - state['psi'].log)
 
 
+class SingleElectronMetropolisSampler(MetropolisSampler):
+    r"""
+    Metropolis--Hastings sampler with single-electron moves.
+
+    Derived from :class:`MetropolisSampler`. Each step consists of a sweep over the
+    electrons in random order, in which one electron (or a small group of electrons)
+    is moved at a time. The moves of the sweep are accepted or rejected according
+    to the Slater determinants of the orbitals without backflow, whose ratios are
+    obtained from rank-1 (Sherman--Morrison) updates of the inverse Slater matrices
+    cached in the walker state. Since the backflow and the Jastrow factor cannot be
+    updated in this way, the whole sweep is finally accepted or rejected based on a
+    single evaluation of the full wave function, which corrects for the difference
+    between the two distributions (delayed acceptance). The cost of a sweep is
+    therefore dominated by a single wave function evaluation and
+    :math:`\mathcal O(N^3)` operations for the determinant updates.
+
+    Requires a wave function that supports :data:`return_mos='envelope'`, such as
+    :class:`~deepqmc.wf.NeuralNetworkWaveFunction`.
+
+    Args:
+        hamil (~deepqmc.hamil.Hamiltonian): the Hamiltonian of the physical system
+        group_size (int): optional, the number of electrons moved together in a
+            single move of the sweep.
+        kwargs: all other arguments are passed to :class:`MetropolisSampler`.
+    """
+
+    WALKER_STATE = MetropolisSampler.WALKER_STATE + ['slater_inv', 'slater_logdet']
+
+    def __init__(self, hamil, *, group_size=1, **kwargs):
+        super().__init__(hamil, **kwargs)
+        self.group_size = group_size
+
+    def _update(self, state, wf, R):
+        state = super()._update(state, wf, R)
+        slater = jax.vmap(lambda phys_conf: slater_matrices(wf, phys_conf))(
+            self.phys_conf(R, state['r'])
+        )
+        _, logdet = jnp.linalg.slogdet(slater)
+        return {**state, 'slater_inv': jnp.linalg.inv(slater), 'slater_logdet': logdet}
+
+    def _acc_log_prob(self, state, prop):
+        # the sweep samples the mixture of the squared determinants,
+        # this is corrected for here
+        log_prob_sweep = jax.nn.logsumexp(2 * prop['slater_logdet'], axis=-1)
+        log_prob_sweep -= jax.nn.logsumexp(2 * state['slater_logdet'], axis=-1)
+        return super()._acc_log_prob(state, prop) - log_prob_sweep
+
+    def _proposal(self, state, rng, wf, R):
+        sweep = jax.vmap(partial(self._sweep, wf=wf, R=R, tau=state['tau']))
+        r, move_acceptance = sweep(
+            jax.random.split(rng, len(state['r'])),
+            state['r'],
+            state['slater_inv'],
+            state['slater_logdet'],
+        )
+        # the step size is adapted to the acceptance of the individual moves,
+        # as rejecting all moves of a sweep would result in a trivially accepted step
+        return r, move_acceptance.mean()
+
+    def _sweep(self, rng, r, inv, logdet, *, wf, R, tau):
+        n_elec = len(r)
+        n_groups = -(-n_elec // self.group_size)
+        rng_perm, rng_flip, rng_moves = jax.random.split(rng, 3)
+        # a random order of the moves is needed for the sweep to obey detailed
+        # balance, incomplete groups are padded with -1 and placed either first or
+        # last with equal probability
+        groups = jnp.concatenate(
+            [
+                jax.random.permutation(rng_perm, n_elec),
+                -jnp.ones(n_groups * self.group_size - n_elec, dtype=jnp.int32),
+            ]
+        ).reshape(n_groups, self.group_size)
+        groups = jnp.where(jax.random.bernoulli(rng_flip), groups[::-1], groups)
+
+        def move(carry, xs):
+            r, inv, logdet = carry
+            group, rng = xs
+            rng_prop, rng_acc = jax.random.split(rng)
+            valid = group >= 0
+            idx = jnp.where(valid, group, 0)
+            step = tau * jax.random.normal(rng_prop, (self.group_size, 3))
+            r_prop = r.at[idx].add(jnp.where(valid[:, None], step, 0))
+            rows = slater_matrices(wf, PhysicalConfiguration(R, r_prop, jnp.array(0)))[
+                :, idx
+            ]
+            inv_prop, logdet_prop = inv, logdet
+            for k in range(self.group_size):
+                inv_k, log_ratio = sherman_morrison_update(inv_prop, rows[:, k], idx[k])
+                inv_prop = jnp.where(valid[k], inv_k, inv_prop)
+                logdet_prop = jnp.where(valid[k], logdet_prop + log_ratio, logdet_prop)
+            log_prob = jax.nn.logsumexp(2 * logdet_prop) - jax.nn.logsumexp(2 * logdet)
+            accepted = log_prob > jnp.log(jax.random.uniform(rng_acc))
+            return (
+                jax.tree_util.tree_map(
+                    partial(jnp.where, accepted),
+                    (r_prop, inv_prop, logdet_prop),
+                    (r, inv, logdet),
+                ),
+                accepted,
+            )
+
+        (r, _, _), accepted = lax.scan(
+            move, (r, inv, logdet), (groups, jax.random.split(rng_moves, n_groups))
+        )
+        return r, accepted.astype(int).sum() / n_groups
+
+
 class DecorrSampler(Sampler):
     r"""
     Insert decorrelating steps into chained samplers.
 
     This sampler cannot be used as the last element of a sampler chain.
+    No sampling statistics are computed in the decorrelating steps.
 
     Args:
         length (int): the samples will be taken in every :data:`length` MCMC step,
@@ -187,15 +413,15 @@ class DecorrSampler(Sampler):
     def __init__(self, *, length):
         self.length = length
 
-    def sample(self, rng, state, wf, R):
+    def sample(self, rng, state, wf, R, *, stats_level='full'):
         sample = super().sample  # lax cannot parse super()
-        state, stats = lax.scan(
-            lambda state, rng: sample(rng, state, wf, R)[::2],
+        rngs = jax.random.split(rng, self.length)
+        state, _ = lax.scan(
+            lambda state, rng: (sample(rng, state, wf, R, stats_level='none')[0], None),
             state,
-            jax.random.split(rng, self.length),
+            rngs[:-1],
         )
-        stats = {k: v[-1] for k, v in stats.items()}
-        return state, self.phys_conf(R, state['r']), stats
+        return sample(rngs[-1], state, wf, R, stats_level=stats_level)
 
 
 class ResampledSampler(Sampler):
@@ -206,10 +432,21 @@ class ResampledSampler(Sampler):
     The resampling is performed by accumulating weights on each MCMC walker
     in each step. Based on a fixed resampling period :data:`period` and/or a
     threshold :data:`treshold` on the normalized effective sample size the walker
-    positions are sampled according to the multinomial distribution defined by
-    these weights, and the weights are reset to one. Either :data:`period` or
-    :data:`treshold` have to be specified.
-
+    positions are resampled according to these weights, and the weights are reset
+    to one. In the sharded mode, the walkers of each device are resampled
+    separately, and are then weighted with the mean weight of the walkers of the
+    device before the resampling, such that the share of each device in the total
+    weight is preserved. Either :data:`period` or :data:`treshold` have to be
+    specified.
+
+    All resampling schemes are based on the inverse of the cumulative weights and
+    scale as :math:`\mathcal O(n\log n)` with the number of walkers. The
+    multinomial scheme draws each walker independently, the stratified and
+    systematic schemes draw one walker from each of :math:`n` equal strata of the
+    cumulative weights with independent or common offsets, and the residual
+    scheme copies each walker :math:`\lfloor nw_i\rfloor` times and draws the
+    remaining walkers multinomially. The latter three schemes have lower variance
+    than the multinomial one.
 
     Args:
         period (int): optional, if specified the walkers are resampled every
@@ -217,18 +454,31 @@ class ResampledSampler(Sampler):
         treshold (float): optional, if specified the walkers are resampled if
             the effective sample size normalized with the batch size is below
             :data:`treshold`.
+        resampling (str): optional, the resampling scheme, one of
+            ``'multinomial'``, ``'stratified'``, ``'systematic'`` or
+            ``'residual'``.
     """
 
-    def __init__(self, *, period=None, treshold=None):
+    RESAMPLING = {
+        'multinomial': multinomial_resampling,
+        'stratified': stratified_resampling,
+        'systematic': systematic_resampling,
+        'residual': residual_resampling,
+    }
+
+    def __init__(self, *, period=None, treshold=None, resampling='multinomial'):
         assert period is not None or treshold is not None
+        if resampling not in self.RESAMPLING:
+            raise ValueError(f'Unknown resampling scheme: {resampling!r}')
         self.period = period
         self.treshold = treshold
+        self.resampling = resampling
 
-    def update(self, state, wf, R):
+    def update(self, state, wf, R, rng=None):
         state['log_weight'] -= 2 * state['psi'].log
-        state = self._update(state, wf, R)
+        state = super().update(state, wf, R, rng=rng)
         state['log_weight'] += 2 * state['psi'].log
-        state['log_weight'] -= state['log_weight'].max()
+        state['log_weight'] -= all_device_gather(state['log_weight']).max()
         return state
 
     def init(self, *args, **kwargs):
@@ -241,26 +491,37 @@ class ResampledSampler(Sampler):
         return state
 
     def resample_walkers(self, rng_re, state):
-        idx = multinomial_resampling(rng_re, jnp.exp(state['log_weight']))
+        log_weight = state['log_weight']
+        weight = exp_normalize_mean(log_weight)
+        idx = self.RESAMPLING[self.resampling](rng_re, weight)
+        # the walkers of each device are resampled separately, and keep the share
+        # of the device in the total weight, i.e., the mean weight of its walkers
+        log_mean_weight = jax.nn.logsumexp(log_weight) - jnp.log(len(log_weight))
+        log_mean_weight -= all_device_gather(log_mean_weight[None]).max()
         state, other = split_dict(state, lambda k: k in self.WALKER_STATE)
         state = {
             **jax.tree_util.tree_map(lambda x: x[idx], state),
             **other,
             'step': jnp.array(0),
-            'log_weight': jnp.zeros_like(other['log_weight']),
+            'log_weight': jnp.full_like(log_weight, log_mean_weight),
         }
         return state
 
-    def sample(self, rng, state, wf, R):
+    def sample(self, rng, state, wf, R, *, stats_level='full'):
         rng_re, rng_smpl = jax.random.split(rng)
-        state, _, stats = super().sample(rng_smpl, state, wf, R)
+        state, _, stats = super().sample(
+            rng_smpl, state, wf, R, stats_level=stats_level
+        )
         state['step'] += 1
-        weight = jnp.exp(state['log_weight'])
-        ess = jnp.sum(weight) ** 2 / jnp.sum(weight**2)
-        stats['sampling/effective sample size'] = ess
+        # the walkers are resampled on each device separately, but all devices
+        # resample in the same step based on the total effective sample size
+        log_weight = all_device_gather(state['log_weight'])
+        ess = jnp.exp(log_effective_sample_size(log_weight))
+        if stats_level != 'none':
+            stats['sampling/effective sample size'] = ess
         state = jax.lax.cond(
             (self.period is not None and state['step'] >= self.period)
-            | (self.treshold is not None and ess / len(weight) < self.treshold),
+            | (self.treshold is not None and ess / len(log_weight) < self.treshold),
             self.resample_walkers,
             lambda rng, state: state,
             rng_re,
@@ -270,9 +531,28 @@ class ResampledSampler(Sampler):
 
 
 class MultimoleculeSampler(Sampler):
+    r"""
+    Sample electron configurations for multiple nuclear configurations at once.
+
+    The walker states of the individual molecules are stacked along a leading
+    molecule axis, and a single step of the wrapped sampler is vectorized over
+    the nuclear coordinates, such that the cost of compilation does not grow
+    with the number of molecules. All molecules therefore have to share the
+    number of walkers and the number of nuclei. A single wave function is used
+    for all molecules, the assignment of separate wave functions to the
+    molecules with :meth:`assign_wfs` was removed.
+
+    Args:
+        sampler (~deepqmc.sampling.Sampler): the sampler used for each molecule.
+        mols (~deepqmc.molecule.Molecule): a molecule or a sequence of molecules.
+        mol_idx_factory (Callable): optional, callback for computing the indices
+            of the samples that are used from each molecule.
+    """
+
     def __init__(self, sampler, mols, mol_idx_factory=None):
         self.sampler = sampler
         self.mols = mols if isinstance(mols, Sequence) else [mols]
+        self.R = jnp.stack([mol.coords for mol in self.mols])
 
         class MolIdxFactory:
             @staticmethod
@@ -288,77 +568,70 @@ class MultimoleculeSampler(Sampler):
         self.mol_idx_factory = mol_idx_factory or MolIdxFactory()
 
     def init(self, rng, wf, n):
-        wfs = self.assign_wfs(wf)
         sample_sizes = self.mol_idx_factory.max_per_mol(n, len(self))
+        if len(set(sample_sizes)) > 1:
+            raise ValueError(
+                'The maximum number of samples must be the same for all molecules, '
+                f'got {sample_sizes}'
+            )
         states = [
             self.sampler.init(rng, wf, sample_size, mol.coords)
-            for rng, wf, sample_size, mol in zip(
-                hk.PRNGSequence(rng), wfs, sample_sizes, self.mols
+            for rng, sample_size, mol in zip(
+                hk.PRNGSequence(rng), sample_sizes, self.mols
             )
         ]
-        return states
-
-    def sample(self, rng, state, wave_function, select_idxs):
-        phys_confs, stats = [], []
-        wfs = self.assign_wfs(wave_function)
-        for i, rng in zip(range(len(self)), hk.PRNGSequence(rng)):
-            state[i], phys_conf, stat = self.sampler.sample(
-                rng, state[i], wfs[i], self.mols[i].coords
-            )
-            phys_confs.append(phys_conf)
-            stats.append({'per_mol': stat})
-
-        phys_conf = self.join_mols(phys_confs, select_idxs)
-        stats = self.join_mols(stats, None)
-        return state, phys_conf, stats
-
-    def assign_wfs(self, wf):
-        r"""Assign WF models to all molecules.
-
-        This allows for using different WFs for each molecule,
-        useful e.g. with HF baselines.
-        """
-        return wf if isinstance(wf, Sequence) else len(self) * [wf]
-
-    def update(self, states, wf):
-        wfs = self.assign_wfs(wf)
-        return [
-            self.sampler.update(state, wf, mol.coords)
-            for state, wf, mol in zip(states, wfs, self.mols)
-        ]
+        return jax.tree_util.tree_map(lambda *xs: jnp.stack(xs), *states)
+
+    def sample(self, rng, state, wave_function, select_idxs, *, stats_level='full'):
+        rngs = jnp.stack([rng for rng, _ in zip(hk.PRNGSequence(rng), self.mols)])
+        state, phys_conf, stats = jax.vmap(
+            partial(self.sampler.sample, stats_level=stats_level),
+            in_axes=(0, 0, None, 0),
+        )(rngs, state, wave_function, self.R)
+        phys_conf = self.join_mols(phys_conf, select_idxs)
+        return state, phys_conf, {'per_mol': stats}
+
+    def update(self, state, wf, rng=None):
+        rngs = None if rng is None else jax.random.split(rng, len(self))
+        return jax.vmap(self.sampler.update, in_axes=(0, None, 0, 0))(
+            state, wf, self.R, rngs
+        )
 
-    def get_state(self, key, states, select_idxs, default=None):
+    def get_state(self, key, state, select_idxs, default=None):
         try:
-            data = [state[key] for state in states]
+            data = state[key]
         except KeyError:
             return default
-        data = self.join_mols(data, select_idxs)
-        return data
+        if select_idxs is None:
+            # data is zero dimensional for each molecule
+            return data
+        return self.join_mols(data, select_idxs)
+
+    def join_mols(self, data, select_idxs):
+        r"""Merge the molecule and walker axes of the stacked data.
 
-    def join_mols(self, data_per_mol, select_idxs):
-        if all(isinstance(d, PhysicalConfiguration) for d in data_per_mol):
+        Args:
+            data: a pytree with leaves of shape (:math:`N_\text{mol}`,
+                :math:`N_\text{walker}`, ...).
+            select_idxs (jax.Array): the indices of the samples to return.
+        """
+        if isinstance(data, PhysicalConfiguration):
             # phys_conf is special because we need to store which molecule the samples
             # are coming from
-            data_per_mol = [
-                jdc.replace(pc, mol_idx=i * jnp.ones(len(pc), dtype=jnp.int32))
-                for i, pc in enumerate(data_per_mol)
-            ]
-        if select_idxs is None:
-            # data is zero dimensional
-            return jax.tree_util.tree_map(
-                lambda *xs: jnp.concatenate([x[select_idxs] for x in xs]),
-                *data_per_mol,
+            data = jdc.replace(
+                data,
+                mol_idx=jnp.broadcast_to(
+                    jnp.arange(len(self), dtype=jnp.int32)[:, None],
+                    data.mol_idx.shape,
+                ),
             )
         return jax.tree_util.tree_map(
-            lambda *xs: jnp.concatenate(xs)[select_idxs], *data_per_mol
+            lambda x: x.reshape(-1, *x.shape[2:])[select_idxs], data
         )
 
-    def phys_conf(self, states, select_idxs):
-        phys_confs = [
-            self.sampler.phys_conf(mol.coords, state['r'])
-            for state, mol in zip(states, self.mols)
-        ]
-        return self.join_mols(phys_confs, select_idxs)
+    def phys_conf(self, state, select_idxs):
+        phys_conf = jax.vmap(self.sampler.phys_conf)(self.R, state['r'])
+        return self.join_mols(phys_conf, select_idxs)
 
     def select_idxs(self, sample_size, *args, **kwargs):
         n_smpl_per_mol = self.mol_idx_factory.n_per_mol(
@@ -420,6 +693,33 @@ def chain(*samplers):
     return chained
 
 
+def slater_matrices(wf, phys_conf):
+    r"""Return the Slater matrices of the orbitals without backflow.
+
+    See :func:`~deepqmc.physics.slater_matrix` for their layout.
+    """
+    return slater_matrix(*wf(phys_conf, return_mos='envelope'))
+
+
+def sherman_morrison_update(inv, row, i):
+    r"""Update inverse Slater matrices upon replacing the :data:`i`-th row.
+
+    Args:
+        inv (float, (:math:`N_\text{det}`, :math:`N`, :math:`N`)): the inverses
+            of the Slater matrices.
+        row (float, (:math:`N_\text{det}`, :math:`N`)): the new rows.
+        i (int): the index of the row to replace.
+
+    Returns:
+        the updated inverses and the logarithms of the absolute values of the
+        determinant ratios.
+    """
+    ratio = jnp.einsum('kj,kj->k', row, inv[:, :, i])
+    u = jnp.einsum('kj,kjl->kl', row, inv) - jax.nn.one_hot(i, inv.shape[-1])
+    inv = inv - inv[:, :, i, None] * u[:, None, :] / ratio[:, None, None]
+    return inv, jnp.log(jnp.abs(ratio))
+
+
 def diffs_to_nearest_nuc(r, coords):
     z = pairwise_diffs(r, coords)
     idx = jnp.argmin(z[..., -1], axis=-1)
@@ -463,22 +763,111 @@ def equilibrate(
     *,
     block_size,
     n_blocks=5,
+    stats_level='full',
+    report_every=1,
+    sharded=False,
 ):
-    criterion = jax.jit(criterion)
+    r"""Equilibrate the sampler until a criterion converges.
 
-    @jax.jit
-    def sample_wf(rng, state, select_idxs):
-        return sampler.sample(rng, state, wf, select_idxs)
+    The sampler runs on device in chunks of up to :data:`report_every` steps,
+    such that the host is only synchronized between the chunks. The values of
+    the criterion from the last :data:`n_blocks` blocks of :data:`block_size`
+    steps are kept on device, and the equilibration stops right after the step
+    in which the means of the first and last block agree within their standard
+    deviations. The steps are the same as when returning to the host after each
+    step.
 
+    Args:
+        rng (jax.random.PRNGKey): key used for PRNG.
+        wf (Callable): the wave function to sample.
+        sampler (~deepqmc.sampling.MultimoleculeSampler): the sampler.
+        state (dict): the state of the sampler.
+        criterion (Callable): maps the sampled physical configuration to the
+            scalar used to assess the convergence.
+        steps (Iterable): the iterable over the step indices, its length limits
+            the number of equilibration steps.
+        sample_size (int): the number of walkers.
+        block_size (int): the number of steps in a block.
+        n_blocks (int): optional, the number of blocks compared.
+        stats_level (str): optional, the level of the sampler statistics.
+        report_every (int): optional, the maximum number of steps between two
+            returns to the host.
+        sharded (bool): optional, whether the walkers are split across devices.
+
+    Yields:
+        (int, dict, dict): the index of the last step of a chunk, the sampler
+        state and the sampler statistics of that step.
+    """
+    n_devices = jax.local_device_count() if sharded else 1
     buffer_size = block_size * n_blocks
-    buffer = []
-    for step, rng in zip(steps, hk.PRNGSequence(rng)):
-        select_idxs = sampler.select_idxs(sample_size, step)
-        state, phys_conf, stats = sample_wf(rng, state, select_idxs)
-        yield step, state, stats
-        buffer = [*buffer[-buffer_size + 1 :], criterion(phys_conf).item()]
-        if len(buffer) < buffer_size:
-            continue
+
+    def is_converged(buffer, n_filled):
         b1, b2 = buffer[:block_size], buffer[-block_size:]
-        if abs(mean(b1) - mean(b2)) < min(stdev(b1), stdev(b2)):
+        return (n_filled >= buffer_size) & (
+            jnp.abs(b1.mean() - b2.mean()) < jnp.minimum(b1.std(ddof=1), b2.std(ddof=1))
+        )
+
+    def sample_wf(rng, state, buffer, n_filled, select_idxs):
+        if sharded:
+            rng = jax.random.split(rng, n_devices)[lax.axis_index(DEVICE_AXIS)]
+        state, phys_conf, stats = sampler.sample(
+            rng, state, wf, select_idxs, stats_level=stats_level
+        )
+        crit = all_device_mean(criterion(phys_conf))
+        buffer = jnp.concatenate([buffer[1:], crit[None]])
+        return state, buffer, jnp.minimum(n_filled + 1, buffer_size), stats
+
+    def sample_chunk(rngs, select_idxs, n_steps, state, buffer, n_filled):
+        def cond_fn(carry):
+            i, _, _, _, converged, _ = carry
+            return (i < n_steps) & ~converged
+
+        def body_fn(carry):
+            i, state, buffer, n_filled, _, _ = carry
+            state, buffer, n_filled, stats = sample_wf(
+                rngs[i], state, buffer, n_filled, select_idxs[i]
+            )
+            return i + 1, state, buffer, n_filled, is_converged(buffer, n_filled), stats
+
+        *_, stats = jax.eval_shape(
+            sample_wf, rngs[0], state, buffer, n_filled, select_idxs[0]
+        )
+        stats = jax.tree_util.tree_map(jnp.zeros_like, stats)
+        n_done, state, buffer, n_filled, converged, stats = lax.while_loop(
+            cond_fn,
+            body_fn,
+            (jnp.int32(0), state, buffer, n_filled, jnp.array(False), stats),
+        )
+        return state, buffer, n_filled, n_done, converged, stats
+
+    buffer, n_filled = jnp.zeros(buffer_size), jnp.int32(0)
+    if sharded:
+        sample_chunk = pmap(sample_chunk, in_axes=(None, None, None, 0, 0, 0))
+        state = split_on_devices(state, n_devices, axis=1)
+        buffer, n_filled = replicate_on_devices((buffer, n_filled), n_devices)
+    else:
+        sample_chunk = jax.jit(sample_chunk)
+
+    steps, rngs = iter(steps), hk.PRNGSequence(rng)
+    while chunk := list(islice(steps, report_every)):
+        # the chunks are padded to a fixed length to be compiled only once
+        padded = chunk + (report_every - len(chunk)) * chunk[-1:]
+        state, buffer, n_filled, n_done, converged, stats = sample_chunk(
+            jnp.stack([next(rngs) for _ in padded]),
+            jnp.stack(
+                [sampler.select_idxs(sample_size // n_devices, step) for step in padded]
+            ),
+            len(chunk),
+            state,
+            buffer,
+            n_filled,
+        )
+        if sharded:
+            n_done, converged, stats = select_one_device((n_done, converged, stats))
+        yield (
+            chunk[n_done.item() - 1],
+            gather_on_one_device(state, axis=1) if sharded else state,
+            stats,
+        )
+        if converged:
             break
@@ -0,0 +1,149 @@
+from collections import namedtuple
+
+import jax
+import jax.numpy as jnp
+from jax import lax
+
+__all__ = ()
+
+TRACE_MODES = ('full', 'decimated', 'summarized')
+
+DECIMATED_LABELS = ('step', 'E_loc', 'sign_psi', 'log_psi')
+
+BlockingState = namedtuple('BlockingState', 'n total sqtotal pending has_pending')
+
+
+def init_blocking(n_levels):
+    r"""Initialize the blocking accumulators of a time series.
+
+    The accumulators hold the sums of the averages over blocks of :math:`2^l`
+    consecutive values, for each level :math:`l`, from which the standard error of
+    the mean of a correlated series is estimated [Flyvbjerg & Petersen 1989].
+
+    Args:
+        n_levels (int): the number of block sizes.
+    """
+    zeros = jnp.zeros(n_levels)
+    return BlockingState(
+        n=zeros, total=zeros, sqtotal=zeros, pending=zeros, has_pending=zeros > 0
+    )
+
+
+def update_blocking(x, state):
+    r"""Add a value of the series to the blocking accumulators."""
+
+    def update_level(carry, level):
+        x, complete = carry
+        n, total, sqtotal, pending, has_pending = level
+        n = n + complete
+        total = total + jnp.where(complete, x, 0.0)
+        sqtotal = sqtotal + jnp.where(complete, x**2, 0.0)
+        # two consecutive blocks form a block of the next level
+        carry = (pending + x) / 2, complete & has_pending
+        pending = jnp.where(complete & ~has_pending, x, pending)
+        has_pending = jnp.where(complete, ~has_pending, has_pending)
+        return carry, BlockingState(n, total, sqtotal, pending, has_pending)
+
+    _, state = lax.scan(update_level, (x, jnp.array(True)), state)
+    return state
+
+
+def blocking_error(state):
+    r"""Estimate the standard error of the mean at each block size.
+
+    The estimate increases with the block size until the blocks are uncorrelated,
+    the value of its plateau is the standard error of the mean. Levels with fewer
+    than two blocks are :data:`nan`.
+    """
+    mean = state.total / state.n
+    var = state.sqtotal / state.n - mean**2
+    return jnp.where(
+        state.n > 1, jnp.sqrt(jnp.maximum(var, 0.0) / (state.n - 1)), jnp.nan
+    )
+
+
+TraceState = namedtuple('TraceState', 'blocking')
+
+
+def init_trace(
+    mode='full',
+    *,
+    every=1,
+    n_walkers=None,
+    quantiles=(0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99),
+    n_bins=32,
+    n_levels=20,
+):
+    r"""Initialize the trace of the walkers written to the results.
+
+    In the :data:`'full'` mode, the local energies and wave function values of all
+    walkers are recorded in every step. In the :data:`'decimated'` mode, they are
+    recorded only every :data:`every` steps, for the first :data:`n_walkers`
+    walkers, along with the index of the step. In the :data:`'summarized'` mode,
+    only statistics of the walkers are recorded, which are evaluated on the
+    device: the mean, standard deviation, quantiles and histogram of the local
+    energies, the quantiles of the log of the wave function, the mean of its sign,
+    and the blocking estimates of the standard error of the mean energy up to the
+    current step, see :func:`blocking_error`. The blocking accumulators are not
+    stored in the checkpoints, such that after a restart the estimates cover only
+    the steps since the restart.
+
+    Args:
+        mode (str): one of :data:`'full'`, :data:`'decimated'` and
+            :data:`'summarized'`.
+        every (int): the number of steps between two recorded steps in the
+            decimated mode.
+        n_walkers (int): optional, the number of recorded walkers in the
+            decimated mode, all by default.
+        quantiles (Sequence[float]): the quantiles recorded in the summarized mode.
+        n_bins (int): the number of bins of the histogram of the local energies
+            in the summarized mode, which spans the outermost quantiles.
+        n_levels (int): the number of block sizes of the blocking analysis in the
+            summarized mode.
+
+    Returns:
+        tuple: the initial state of the trace of a molecule, and a function that
+        takes the step, the local energies, the signs and logs of the wave function
+        of the walkers of the molecule, and the state of its trace, and returns the
+        updated state and the rows to record.
+    """
+    if mode not in TRACE_MODES:
+        raise ValueError(f'Unknown trace mode: {mode!r}, expected one of {TRACE_MODES}')
+    quantiles = jnp.array(quantiles)
+    state = TraceState(
+        blocking=init_blocking(n_levels) if mode == 'summarized' else None
+    )
+
+    @jax.jit
+    def summarize(E_loc, sign_psi, log_psi, state):
+        E_mean = jnp.nanmean(E_loc)
+        E_quantiles = jnp.nanquantile(E_loc, quantiles)
+        hist_range = E_quantiles[jnp.array([0, -1])]
+        hist, _ = jnp.histogram(E_loc, bins=n_bins, range=hist_range)
+        blocking = update_blocking(E_mean, state.blocking)
+        return state._replace(blocking=blocking), {
+            'E_loc_mean': E_mean,
+            'E_loc_std': jnp.nanstd(E_loc),
+            'E_loc_quantiles': E_quantiles,
+            'E_loc_hist': hist,
+            'E_loc_hist_range': hist_range,
+            'E_loc_blocking_error': blocking_error(blocking),
+            'log_psi_quantiles': jnp.nanquantile(log_psi, quantiles),
+            'sign_psi_mean': sign_psi.mean(),
+        }
+
+    def update(step, E_loc, sign_psi, log_psi, state):
+        if mode == 'summarized':
+            return summarize(E_loc, sign_psi, log_psi, state)
+        if mode == 'decimated':
+            if step % every:
+                return state, {}
+            return state, {
+                'step': step,
+                'E_loc': E_loc[:n_walkers],
+                'sign_psi': sign_psi[:n_walkers],
+                'log_psi': log_psi[:n_walkers],
+            }
+        return state, {'E_loc': E_loc, 'sign_psi': sign_psi, 'log_psi': log_psi}
+
+    return state, update
@@ -8,17 +8,30 @@ import h5py
 import jax
 import jax.numpy as jnp
 import kfac_jax
+import numpy as np
 import optax
 from jax import tree_util
 from tqdm.auto import tqdm, trange
 from uncertainties import ufloat
 
-from .ewm import init_ewm
-from .fit import fit_wf
-from .log import CheckpointStore, H5LogTable, TensorboardMetricLogger
+from .ewm import init_batched_ewm
+from .fit import TrainState, fit_wf
+from .log import (
+    AsyncMetricLogger,
+    CheckpointStore,
+    H5LogWriter,
+    JSONLMetricLogger,
+    TensorboardMetricLogger,
+)
 from .physics import pairwise_self_distance
+from .precision import (
+    precision_drift,
+    restore_precision_policy,
+    set_precision_policy,
+)
 from .pretrain import pretrain
 from .sampling import MultimoleculeSampler, equilibrate
+from .trace import DECIMATED_LABELS, init_trace
 from .utils import InverseSchedule, segment_nanmean
 from .wf.base import init_wf_params
 
@@ -68,8 +81,15 @@ def train(  # noqa: C901
     fit_kwargs=None,
     chkptdir=None,
     chkpts_kwargs=None,
+    h5_kwargs=None,
+    trace_kwargs=None,
     metric_logger=None,
+    metric_logger_kwargs=None,
     mol_idx_factory=None,
+    log_every=1,
+    sharded=False,
+    stochastic_laplacian=None,
+    precision=None,
 ):
     r"""Train or evaluate a JAX wave function model.
 
@@ -120,17 +140,52 @@ def train(  # noqa: C901
             are only saved if :data:`workdir` is not :data:`None`. Default:
             data:`workdir`.
         chkpts_kwargs (dict): optional, extra arguments for checkpointing.
+        h5_kwargs (dict): optional, extra arguments for the buffered writing of
+            the results to the HDF5 file, see :class:`~deepqmc.log.H5LogWriter`.
+        trace_kwargs (dict): optional, specifies which data of the walkers is
+            written to the HDF5 file in each step, see
+            :func:`~deepqmc.trace.init_trace`. By default the local energies and
+            wave function values of all walkers are written.
         metric_logger: optional, an object that consumes metric logging information.
             If not specified, the default `~.log.TensorboardMetricLogger` is used
-            to create tensorboard logs.
+            to create tensorboard logs, which are written on a background thread
+            by `~.log.AsyncMetricLogger`.
+        metric_logger_kwargs (dict): optional, extra arguments for the default
+            `~.log.AsyncMetricLogger`. If :data:`jsonl` is :data:`True`, the
+            metrics are also written to :data:`metrics.jsonl` in the working
+            directory.
         mol_idx_factory (Callable): optional, callback for computing the indices
             of the molecule from which samples are to be taken in a given step.
+        log_every (int): optional, the number of steps between two updates of the
+            metric logger. The sampling statistics are only computed in these steps,
+            and the equilibration runs this many steps on device between reports.
+        sharded (bool): optional, if :data:`True` the walkers are split across all
+            local devices, whereas the parameters and optimizer state are
+            replicated. The number of walkers of each molecule must be divisible
+            by the number of devices.
+        stochastic_laplacian (dict): optional, if specified the Laplacian is
+            estimated stochastically at the beginning of the training, which is
+            cheaper but adds noise to the local energies. Contains the number of
+            probe vectors (:data:`n_probes`) and optionally their distribution
+            (:data:`probes`), see
+            :meth:`~deepqmc.hamil.MolecularHamiltonian.local_energy`. The exact
+            Laplacian is used from step :data:`until_step`, or once the variance
+            of the local energy of all molecules is below :data:`until_variance`.
+            Restarts from earlier checkpoints switch at the same step.
+        precision (dict): optional, the precision policies of the components of
+            the computation, see :func:`~deepqmc.precision.set_precision_policy`.
+            The deviation of the log of the wave function and the local energies
+            from a full-precision evaluation is reported after the equilibration.
+            The previous policies are restored once the training is finished.
     """
 
+    fused_steps = (fit_kwargs or {}).get('fused_steps')
     rng = jax.random.PRNGKey(seed)
     mode = 'evaluation' if opt is None else 'training'
     mols = mols or hamil.mol
     sampler = MultimoleculeSampler(sampler, mols, mol_idx_factory)
+    if sharded:
+        log.info(f'Splitting walkers across {jax.local_device_count()} devices')
     if isinstance(opt, str):
         opt_kwargs = OPT_KWARGS.get(opt, {}) | (opt_kwargs or {})
         opt = (
@@ -145,19 +200,28 @@ def train(  # noqa: C901
         os.makedirs(chkptdir, exist_ok=True)
         chkpts = CheckpointStore(chkptdir, **(chkpts_kwargs or {}))
         if metric_logger is None and workdir:
-            metric_logger = TensorboardMetricLogger(workdir, len(sampler))
+            metric_kwargs = dict(metric_logger_kwargs or {})
+            loggers = [TensorboardMetricLogger(workdir, len(sampler))]
+            if metric_kwargs.pop('jsonl', False):
+                loggers.append(
+                    JSONLMetricLogger(os.path.join(workdir, 'metrics.jsonl'))
+                )
+            metric_logger = AsyncMetricLogger(loggers, **metric_kwargs)
         log.debug('Setting up HDF5 file...')
         h5file = h5py.File(os.path.join(workdir, 'result.h5'), 'a', libver='v110')
         h5file.swmr_mode = True
+        h5writer = H5LogWriter(h5file, **(h5_kwargs or {}))
         tables = []
         for i, mol in enumerate(sampler.mols):
             group = h5file.require_group(str(i)) if len(sampler.mols) > 1 else h5file
             group.attrs.create('geometry', mol.coords.tolist())
-            table = H5LogTable(group)
-            table.resize(init_step)
+            table = h5writer.table(group)
+            table.resize(init_step, DECIMATED_LABELS)
             tables.append(table)
         h5file.flush()
 
+    # the policies are global, and are restored once the training is finished
+    previous_precision = set_precision_policy(precision) if precision else None
     pbar = None
     try:
         if train_state:
@@ -188,8 +252,7 @@ def train(  # noqa: C901
                         raise NotImplementedError
                     opt_pretrain = getattr(optax, opt_pretrain)
                 opt_pretrain = opt_pretrain(**opt_pretrain_kwargs)
-                ewm_state, update_ewm = init_ewm(decay_alpha=1.0)
-                ewm_states = len(sampler) * [ewm_state]
+                ewm_state, update_ewm = init_batched_ewm(len(sampler), decay_alpha=1.0)
                 pbar = tqdm(range(pretrain_steps), desc='pretrain', disable=None)
                 for step, params, losses in pretrain(  # noqa: B007
                     rng_pretrain,
@@ -203,22 +266,14 @@ def train(  # noqa: C901
                 ):
                     mol_idx = sampler.mol_idx(sample_size, step)
                     per_mol_losses = segment_nanmean(losses, mol_idx, len(sampler))
-                    ewm_states = [
-                        ewm_state if jnp.isnan(loss) else update_ewm(loss, ewm_state)
-                        for loss, ewm_state in zip(per_mol_losses, ewm_states)
-                    ]
-                    ewm_means = [
-                        ewm_state.mean if ewm_state.mean is not None else 0.0
-                        for ewm_state in ewm_states
-                    ]
+                    ewm_state = update_ewm(per_mol_losses, ewm_state)
+                    ewm_means = jax.device_get(jnp.nan_to_num(ewm_state.mean))
                     mse_rep = '|'.join(f'{mean:0.2e}' for mean in ewm_means)
                     pbar.set_postfix(MSE=mse_rep)
                     pretrain_stats = {
                         'per_mol': {
                             'MSE': per_mol_losses,
-                            'MSE/ewm': jnp.array(
-                                [ewm_state.mean for ewm_state in ewm_states]
-                            ),
+                            'MSE/ewm': ewm_state.mean,
                         }
                     }
                     if metric_logger:
@@ -233,35 +288,109 @@ def train(  # noqa: C901
                 sample_size,
             )
             log.info('Equilibrating sampler...')
-            pbar = tqdm(
-                count() if max_eq_steps is None else range(max_eq_steps),
-                desc='equilibrate sampler',
-                disable=None,
-            )
+            pbar = tqdm(total=max_eq_steps, desc='equilibrate sampler', disable=None)
             for step, smpl_state, smpl_stats in equilibrate(  # noqa: B007
                 rng_eq,
                 partial(ansatz.apply, params),
                 sampler,
                 smpl_state,
                 lambda phys_conf: pairwise_self_distance(phys_conf.r).mean(),
-                pbar,
+                count() if max_eq_steps is None else range(max_eq_steps),
                 sample_size,
                 block_size=10,
+                report_every=log_every,
+                sharded=sharded,
             ):
                 tau_rep = '|'.join(
                     f'{tau:.3f}' for tau in sampler.get_state('tau', smpl_state, None)
                 )
+                # the steps of a chunk are reported at once
+                pbar.update(step + 1 - pbar.n)
                 pbar.set_postfix(tau=tau_rep)
                 if metric_logger:
                     metric_logger.update(step, smpl_stats, prefix='equilibration')
             pbar.close()
-            train_state = smpl_state, params, None
+            train_state = TrainState(smpl_state, params, None)
             if workdir and mode == 'training':
                 chkpts.update(init_step, train_state)
             log.info(f'Start {mode}')
+
+        if precision:
+            rng, rng_drift = jax.random.split(rng)
+            drift = precision_drift(
+                rng_drift,
+                hamil,
+                ansatz,
+                train_state[1],
+                sampler.phys_conf(
+                    train_state[0], sampler.select_idxs(sample_size, init_step)
+                ),
+            )
+            log.info(
+                'Precision drift: '
+                + ', '.join(f'{k} = {v:.2e}' for k, v in drift.items())
+            )
+            if metric_logger:
+                metric_logger.update(
+                    init_step, {'per_mol': {}, **drift}, prefix='precision'
+                )
+
+        laplacian_kwargs = dict(stochastic_laplacian or {})
+        exact_laplacian_from = laplacian_kwargs.pop('until_step', None)
+        until_variance = laplacian_kwargs.pop('until_variance', None)
+
+        def fit(rng, steps, train_state):
+            nonlocal exact_laplacian_from
+            # a single iterator over the steps is shared by both phases, so that
+            # the training continues with the exact Laplacian from the step after
+            # the switch, instead of iterating the steps again
+            steps = iter(steps)
+            fit_steps = partial(
+                fit_wf,
+                hamil=hamil,
+                ansatz=ansatz,
+                opt=opt,
+                sampler=sampler,
+                sample_size=sample_size,
+                steps=steps,
+                smpl_stats_every=log_every,
+                sharded=sharded,
+                **(fit_kwargs or {}),
+            )
+            # a restart from a checkpoint after the switch, e.g., due to a NaN,
+            # continues with the exact Laplacian
+            if (
+                stochastic_laplacian
+                and mode == 'training'
+                and (exact_laplacian_from is None or init_step < exact_laplacian_from)
+            ):
+                rng, rng_stochastic = jax.random.split(rng)
+                for step, train_state, E_loc, stats in fit_steps(
+                    rng_stochastic,
+                    train_state=train_state,
+                    local_energy_kwargs=laplacian_kwargs,
+                ):
+                    yield step, train_state, E_loc, stats
+                    # the variance of the last step of a fused block
+                    E_loc_std = stats['per_mol']['E_loc/std']
+                    if (
+                        exact_laplacian_from is not None
+                        and step + 1 >= exact_laplacian_from
+                    ) or (
+                        until_variance is not None
+                        and (E_loc_std**2 < until_variance).all()
+                    ):
+                        break
+                else:
+                    return
+                exact_laplacian_from = step + 1
+                log.info(f'Switching to the exact Laplacian after step {step}')
+            yield from fit_steps(rng, train_state=train_state)
+
         best_ene = None
-        ewm_state, update_ewm = init_ewm()
-        ewm_states = len(sampler) * [ewm_state]
+        ewm_state, update_ewm = init_batched_ewm(len(sampler))
+        trace_state, update_trace = init_trace(**(trace_kwargs or {}))
+        trace_states = len(sampler) * [trace_state]
         for attempt in range(max_restarts):
             try:
                 pbar = trange(
@@ -272,75 +401,77 @@ def train(  # noqa: C901
                     desc=mode,
                     disable=None,
                 )
-                for step, train_state, E_loc, stats in fit_wf(  # noqa: B007
-                    rng,
-                    hamil,
-                    ansatz,
-                    opt,
-                    sampler,
-                    sample_size,
-                    pbar,
-                    train_state,
-                    **(fit_kwargs or {}),
+                for last_step, train_state, E_locs, stats in fit(
+                    rng, pbar, train_state
                 ):
-                    psi = sampler.get_state(
-                        'psi',
-                        train_state.sampler,
-                        sampler.select_idxs(sample_size, step),
-                    )
-                    if jnp.isnan(psi.log).any():
+                    if fused_steps:
+                        # the local energies and wave function values of all
+                        # steps of a fused block, with the statistics of its last
+                        smpl_psis = stats.pop('psi')
+                    else:
+                        E_locs = [E_locs]
+                        smpl_psis = tree_util.tree_map(
+                            lambda x: x[None], train_state.sampler['psi']
+                        )
+                    first_step = last_step - len(E_locs) + 1
+                    if jnp.isnan(smpl_psis.log).any():
                         raise NanError()
-                    mol_idx = sampler.mol_idx(sample_size, step)
-                    per_mol_energy = segment_nanmean(E_loc, mol_idx, len(sampler))
-                    ewm_states = [
-                        ewm_state if jnp.isnan(ene) else update_ewm(ene, ewm_state)
-                        for ene, ewm_state in zip(per_mol_energy, ewm_states)
-                    ]
+                    for k, E_loc in enumerate(E_locs):
+                        step = first_step + k
+                        mol_idx = sampler.mol_idx(sample_size, step)
+                        per_mol_energy = segment_nanmean(E_loc, mol_idx, len(sampler))
+                        ewm_state = update_ewm(per_mol_energy, ewm_state)
+                        ewm_means, ewm_errors = jax.device_get(
+                            (ewm_state.mean, jnp.sqrt(ewm_state.sqerr))
+                        )
+                        ene = [ufloat(e, s) for e, s in zip(ewm_means, ewm_errors)]
+                        if all(e.s > 0 for e in ene):
+                            energies = '|'.join(f'{e:S}' for e in ene)
+                            pbar.set_postfix(E=energies)
+                            if best_ene is None or any(
+                                map(lambda x, y: x.s < 0.5 * y.s, ene, best_ene)
+                            ):
+                                best_ene = ene
+                                log.info(
+                                    f'Progress: {step + 1}/{steps}, energy = {energies}'
+                                )
+                        if workdir:
+                            for i, (table, ewm_mean) in enumerate(
+                                zip(tables, ewm_means)
+                            ):
+                                trace_states[i], trace = update_trace(
+                                    step,
+                                    E_loc[mol_idx == i],
+                                    smpl_psis.sign[k, i],
+                                    smpl_psis.log[k, i],
+                                    trace_states[i],
+                                )
+                                for label, row in trace.items():
+                                    table.row[label] = row
+                                if not np.isnan(ewm_mean):
+                                    table.row['E_ewm'] = ewm_mean
+                            h5writer.step()
                     stats['per_mol'] = {
-                        'energy/ewm': jnp.array(
-                            [ewm_state.mean for ewm_state in ewm_states]
-                        ),
-                        'energy/ewm_error': jnp.sqrt(
-                            jnp.array([ewm_state.sqerr for ewm_state in ewm_states])
-                        ),
+                        'energy/ewm': ewm_state.mean,
+                        'energy/ewm_error': jnp.sqrt(ewm_state.sqerr),
                         **stats['per_mol'],
                     }
-                    ene = [
-                        ufloat(e, s)
-                        for e, s in zip(
-                            stats['per_mol']['energy/ewm'],
-                            stats['per_mol']['energy/ewm_error'],
-                        )
-                    ]
-                    if all(e.s for e in ene):
-                        energies = '|'.join(f'{e:S}' for e in ene)
-                        pbar.set_postfix(E=energies)
-                        if best_ene is None or any(
-                            map(lambda x, y: x.s < 0.5 * y.s, ene, best_ene)
-                        ):
-                            best_ene = ene
-                            log.info(
-                                f'Progress: {step + 1}/{steps}, energy = {energies}'
-                            )
                     if workdir:
                         if mode == 'training':
-                            # the convention is that chkpt-i contains the step i-1 -> i
+                            # the convention is that chkpt-i contains the
+                            # step i-1 -> i
                             chkpts.update(
-                                step + 1,
+                                last_step + 1,
                                 train_state,
                                 stats['per_mol']['E_loc/std'].mean(),
                             )
-                        for i, (table, ewm_state, smpl_state) in enumerate(
-                            zip(tables, ewm_states, train_state.sampler)
+                        # the statistics of a fused block are those of its last
+                        # step, reported if any step of the block is logged
+                        if metric_logger and any(
+                            step % log_every == 0
+                            for step in range(first_step, last_step + 1)
                         ):
-                            table.row['E_loc'] = E_loc[mol_idx == i]
-                            if ewm_state.mean is not None:
-                                table.row['E_ewm'] = ewm_state.mean
-                            table.row['sign_psi'] = smpl_state['psi'].sign
-                            table.row['log_psi'] = smpl_state['psi'].log
-                        h5file.flush()
-                        if metric_logger:
-                            metric_logger.update(step, stats)
+                            metric_logger.update(last_step, stats)
                 log.info(f'The {mode} has been completed!')
                 return train_state
             except NanError:
@@ -348,14 +479,19 @@ def train(  # noqa: C901
                 log.warn('Restarting due to a NaN...')
                 if attempt < max_restarts:
                     init_step, train_state = chkpts.last
+                    # the blocking estimates restart with the training
+                    trace_states = len(sampler) * [trace_state]
         log.warn(
             f'The {mode} has crashed before all steps were completed ({step}/{steps})!'
         )
         raise TrainingCrash(train_state)
     finally:
+        if previous_precision:
+            restore_precision_policy(previous_precision)
         if pbar:
             pbar.close()
         if workdir:
             chkpts.close()
             metric_logger.close()
+            h5writer.close()
             h5file.close()
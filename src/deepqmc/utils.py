@@ -19,13 +19,40 @@ def unflatten(x, axis, shape):
     return x.reshape(*begin, *shape, *end)
 
 
+def _inverse_cdf_resampling(weights, u):
+    weights_cum = jnp.cumsum(weights / jnp.sum(weights))
+    return jnp.searchsorted(weights_cum[:-1], u, side='right')
+
+
 def multinomial_resampling(rng, weights, n_samples=None):
+    n_samples = n_samples or len(weights)
+    return _inverse_cdf_resampling(weights, 1 - uniform(rng, (n_samples,)))
+
+
+def stratified_resampling(rng, weights, n_samples=None):
+    n_samples = n_samples or len(weights)
+    u = (jnp.arange(n_samples) + uniform(rng, (n_samples,))) / n_samples
+    return _inverse_cdf_resampling(weights, u)
+
+
+def systematic_resampling(rng, weights, n_samples=None):
+    n_samples = n_samples or len(weights)
+    u = (jnp.arange(n_samples) + uniform(rng)) / n_samples
+    return _inverse_cdf_resampling(weights, u)
+
+
+def residual_resampling(rng, weights, n_samples=None):
     n = len(weights)
     n_samples = n_samples or n
-    weights_normalized = weights / jnp.sum(weights)
-    i, j = jnp.triu_indices(n)
-    weights_cum = jnp.zeros((n, n)).at[i, j].set(weights_normalized[j]).sum(axis=-1)
-    return n - 1 - (uniform(rng, (n_samples,))[:, None] > weights_cum).sum(axis=-1)
+    weights_scaled = n_samples * weights / jnp.sum(weights)
+    n_copies = jnp.floor(weights_scaled).astype(int)
+    idx_copies = jnp.repeat(jnp.arange(n), n_copies, total_repeat_length=n_samples)
+    idx_residual = multinomial_resampling(rng, weights_scaled - n_copies, n_samples)
+    return jnp.where(jnp.arange(n_samples) < n_copies.sum(), idx_copies, idx_residual)
+
+
+def log_effective_sample_size(log_weights):
+    return 2 * jax.nn.logsumexp(log_weights) - jax.nn.logsumexp(2 * log_weights)
 
 
 def factorial2(n):
@@ -72,6 +99,36 @@ def split_dict(dct, cond):
     return included, excluded
 
 
+def chunked_vmap(f, chunk_size=None):
+    r"""Vectorize a function over the leading axis of its arguments in chunks.
+
+    The chunks of :data:`chunk_size` elements are evaluated one after another with
+    :func:`jax.lax.map`, and the remaining elements at the end in a single call, so
+    that the peak memory is bounded by the chunk size. Without :data:`chunk_size`
+    it is equivalent to :func:`jax.vmap`.
+    """
+    vf = jax.vmap(f)
+
+    def chunked(*args):
+        n = len(jax.tree_util.tree_leaves(args)[0])
+        if chunk_size is None or n <= chunk_size:
+            return vf(*args)
+        n_full = n - n % chunk_size
+        chunks = jax.tree_util.tree_map(
+            lambda x: x[:n_full].reshape(-1, chunk_size, *x.shape[1:]), args
+        )
+        out = jax.tree_util.tree_map(
+            lambda x: x.reshape(-1, *x.shape[2:]),
+            jax.lax.map(lambda args: vf(*args), chunks),
+        )
+        if n_full < n:
+            rest = vf(*jax.tree_util.tree_map(lambda x: x[n_full:], args))
+            out = jax.tree_util.tree_map(lambda *xs: jnp.concatenate(xs), out, rest)
+        return out
+
+    return chunked
+
+
 def InverseSchedule(init_value, decay_rate):
     return lambda n: init_value / (1 + n / decay_rate)
 
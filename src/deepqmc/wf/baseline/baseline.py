@@ -36,9 +36,13 @@ class Baseline(WaveFunction):
         )
         self.confs = confs[:, :n_determinants]
 
-    def __call__(self, phys_conf):
+    def __call__(self, phys_conf, geometry=None):
         mol_idx = phys_conf.mol_idx
-        diffs = pairwise_diffs(phys_conf.r, phys_conf.R)
+        diffs = (
+            pairwise_diffs(phys_conf.r, phys_conf.R)
+            if geometry is None
+            else geometry.diffs_nuc
+        )
         n_el = diffs.shape[-3]
         aos = self.basis(diffs)
         mos = jnp.einsum('...mo,...em->...eo', self.mo_coeffs[mol_idx], aos)
@@ -62,8 +62,12 @@ class ExponentialEnvelopes(hk.Module):
         orbs = (pi * jnp.exp(-exponent)).sum(axis=-1)  # [n_el, n_orb]
         return unflatten(orbs, -1, (self.n_det, -1)).swapaxes(-2, -3)
 
-    def __call__(self, phys_conf):
-        diffs = pairwise_diffs(phys_conf.r, phys_conf.R)
+    def __call__(self, phys_conf, geometry=None):
+        diffs = (
+            pairwise_diffs(phys_conf.r, phys_conf.R)
+            if geometry is None
+            else geometry.diffs_nuc
+        )
         if self.spin_restricted:
             return self._call_for_one_spin(self.zetas[0], self.pi[0], diffs)
         else:
@@ -2,7 +2,8 @@ import haiku as hk
 import jax
 import jax.numpy as jnp
 
-from ...physics import pairwise_diffs, pairwise_self_distance
+from ...physics import pairwise_geometry
+from ...precision import cast_to_compute, cast_to_output
 from ...types import Psi
 from ...utils import flatten, triu_flat
 from ..base import WaveFunction
@@ -38,7 +39,7 @@ class BackflowOp(hk.Module):
 def eval_log_slater(xs):
     if xs.shape[-1] == 0:
         return jnp.ones(xs.shape[:-2]), jnp.zeros(xs.shape[:-2])
-    return jnp.linalg.slogdet(xs)
+    return cast_to_output('slater', jnp.linalg.slogdet(cast_to_compute('slater', xs)))
 
 
 class NeuralNetworkWaveFunction(WaveFunction):
@@ -69,6 +70,21 @@ class NeuralNetworkWaveFunction(WaveFunction):
                 and an additive term
         conf_coeff (Callable): returns a function that combines the determinants
             to obtain the WF value
+
+    Calling the wave function with :data:`return_mos=True` returns the spin-up and
+    spin-down molecular orbitals (including the backflow) instead of the wave
+    function value. With :data:`return_mos='envelope'` the orbitals are returned
+    without the backflow, such that each row depends on the position of a single
+    electron only. With :data:`return_mos='frozen'` a dictionary is returned, which
+    contains the orbitals without (``'envelope'``) and with (``'orbitals'``) the
+    backflow, the multiplicative backflow factors (``'mult'``), and the weights of
+    the determinants in the wave function (``'det_weights'``). These allow for
+    evaluating the ratios of the wave function upon moving a single electron with
+    the backflow, the Jastrow factor and the electronic cusps frozen (the locality
+    approximation). The weights assume a linear combination of the determinants,
+    i.e., a :class:`haiku.Linear` :data:`conf_coeff` without bias. A
+    :class:`~deepqmc.physics.PairwiseGeometry` of the configuration can be passed
+    as :data:`geometry`, e.g., by the Hamiltonian, which then shares it.
     """
 
     def __init__(
@@ -118,22 +134,48 @@ class NeuralNetworkWaveFunction(WaveFunction):
 
         return self.backflow_op(xs, fs_mult, fs_add, dists_nuc)
 
-    def __call__(self, phys_conf, return_mos=False):
-        diffs_nuc = pairwise_diffs(phys_conf.r, phys_conf.R)
-        dists_nuc = jnp.sqrt(diffs_nuc[..., -1])
-        dists_elec = pairwise_self_distance(phys_conf.r, full=True)
-        orb = self.envelope(phys_conf)
-        jastrow, fs = self.omni(phys_conf) if self.omni else (None, None)
+    def _backflow_mult(self, xs, fs):
+        if fs is None or self.backflow_transform == 'add':
+            return jnp.ones_like(xs)
+        fs_mult = (
+            jnp.split(fs, 2, axis=0)[0] if self.backflow_transform == 'both' else fs
+        )
+        return jnp.broadcast_to(
+            self.backflow_op.mult_act(fs_mult.squeeze(axis=0)), xs.shape
+        )
+
+    def __call__(self, phys_conf, return_mos=False, geometry=None):
+        if geometry is None:
+            geometry = pairwise_geometry(phys_conf)
+        dists_nuc, dists_elec = geometry.dists_nuc, geometry.dists_elec
+        orb = self.envelope(phys_conf, geometry)
         orb_up, orb_down = (
             (orb, orb)
             if self.full_determinant
             else jnp.split(orb, [self.n_up], axis=-1)
         )
         orb_up, orb_down = orb_up[:, : self.n_up], orb_down[:, self.n_up :]
+        if return_mos == 'envelope':
+            return orb_up, orb_down
+        jastrow, fs = self.omni(phys_conf) if self.omni else (None, None)
+        if return_mos == 'frozen':
+            if not (
+                isinstance(self.conf_coeff, hk.Linear) and not self.conf_coeff.with_bias
+            ):
+                raise ValueError(
+                    'The weights of the determinants require a linear conf_coeff'
+                )
+            frozen = {
+                'envelope': (orb_up, orb_down),
+                'mult': (
+                    self._backflow_mult(orb_up, None if fs is None else fs[0]),
+                    self._backflow_mult(orb_down, None if fs is None else fs[1]),
+                ),
+            }
         if fs is not None:
             orb_up = self._backflow_op(orb_up, fs[0], dists_nuc[: self.n_up])
             orb_down = self._backflow_op(orb_down, fs[1], dists_nuc[self.n_up :])
-        if return_mos:
+        if return_mos and return_mos != 'frozen':
             return orb_up, orb_down
         if self.full_determinant:
             sign, xs = eval_log_slater(jnp.concatenate([orb_up, orb_down], axis=-2))
@@ -147,6 +189,12 @@ class NeuralNetworkWaveFunction(WaveFunction):
         # replace -inf shifts, to avoid running into nans (see sloglindet)
         xs = sign * jnp.exp(xs - xs_shift)
         psi = self.conf_coeff(xs).squeeze()
+        if return_mos == 'frozen':
+            return {
+                **frozen,
+                'orbitals': (orb_up, orb_down),
+                'det_weights': self.conf_coeff(jnp.diag(xs)).squeeze(axis=-1) / psi,
+            }
         log_psi = jnp.log(jnp.abs(psi)) + xs_shift
         sign_psi = jax.lax.stop_gradient(jnp.sign(psi))
         if self.cusp_same:
@@ -69,7 +69,9 @@ class Helpers:
     def transform_model(model, *model_args, **model_kwargs):
         return hk.without_apply_rng(
             hk.transform(
-                lambda *call_args: model(*model_args, **model_kwargs)(*call_args)
+                lambda *call_args, **call_kwargs: model(*model_args, **model_kwargs)(
+                    *call_args, **call_kwargs
+                )
             )
         )
 
@@ -0,0 +1,52 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from deepqmc.ewm import init_batched_ewm, init_ewm
+
+EWM_KWARGS = {'max_alpha': 0.9, 'decay_alpha': 2}
+
+
+def buffered_ewm(xs, max_alpha, decay_alpha):
+    # the averages over the buffer of all previous values, newest first
+    alphas = np.ones(1)
+    results = [(xs[0], 1.0, 1.0)]
+    for step in range(len(xs) - 1):
+        alpha = max(1 - max_alpha, 1 / (2 + step / decay_alpha))
+        alphas = np.concatenate([[alpha], alphas])
+        weights = alphas * np.concatenate([[1.0], np.cumprod(1 - alphas[:-1])])
+        values = xs[step + 1 :: -1]
+        mean = (weights * values).sum()
+        sqdev = weights * (values - mean) ** 2
+        results.append((mean, sqdev.sum(), (weights * sqdev).sum()))
+    return np.array(results)
+
+
+def test_ewm_equals_buffered(helpers):
+    state, update = init_ewm(**EWM_KWARGS)
+    window_size = state.params['window_size']
+    xs = np.asarray(jax.random.normal(helpers.rng(), (window_size,)), np.float64)
+    expected = buffered_ewm(xs, **EWM_KWARGS)
+    for x, (mean, var, sqerr) in zip(xs, expected):
+        state = update(jnp.array(x, jnp.float32), state)
+        assert np.allclose(
+            [state.mean, state.var, state.sqerr], [mean, var, sqerr], atol=1e-6
+        )
+
+
+def test_batched_ewm_skips_nans(helpers):
+    xs = jax.random.normal(helpers.rng(), (3,))
+    state, update = init_ewm(**EWM_KWARGS)
+    batched_state, batched_update = init_batched_ewm(2, **EWM_KWARGS)
+    batched_state = batched_update(jnp.array([xs[0], jnp.nan]), batched_state)
+    # an average without values is nan
+    assert jnp.isnan(batched_state.mean[1])
+    for x, y in [(xs[1], xs[2]), (xs[2], jnp.nan)]:
+        batched_state = batched_update(jnp.array([x, y]), batched_state)
+    for x in xs:
+        state = update(x, state)
+    assert jnp.allclose(batched_state.mean[0], state.mean)
+    assert jnp.allclose(batched_state.sqerr[0], state.sqerr)
+    # the second average starts with its first value
+    assert batched_state.step[1] == 0
+    assert jnp.allclose(batched_state.mean[1], xs[2])
@@ -0,0 +1,116 @@
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+import kfac_jax
+import optax
+import pytest
+
+from deepqmc.fit import TrainState, fit_wf, init_fit
+from deepqmc.sampling import (
+    MetropolisSampler,
+    MultimoleculeSampler,
+    ResampledSampler,
+    chain,
+)
+from deepqmc.train import OPT_KWARGS
+
+
+def test_pipelined_fit(helpers):
+    mol = helpers.mol('H2')
+    hamil = helpers.hamil(mol)
+    ansatz, _ = helpers.create_ansatz(hamil)
+    # the walkers are not moved, so that the pipelined training, in which the
+    # walkers are reweighted to the current parameters, agrees with the usual one
+    sampler = MultimoleculeSampler(
+        chain(ResampledSampler(period=10), MetropolisSampler(hamil, tau=0.0)),
+        [mol],
+    )
+    params, smpl_state = init_fit(helpers.rng(), hamil, ansatz, sampler, 8)
+    results = [
+        list(
+            fit_wf(
+                helpers.rng(1),
+                hamil,
+                ansatz,
+                optax.adam(1e-2),
+                sampler,
+                8,
+                range(3),
+                TrainState(smpl_state, params, None),
+                pipelined=pipelined,
+            )
+        )
+        for pipelined in [False, True]
+    ]
+    phys_conf = sampler.phys_conf(smpl_state, jnp.arange(8))
+
+    def log_psi(params):
+        return jax.vmap(partial(ansatz.apply, params))(phys_conf).log
+
+    log_psi_init = log_psi(params)
+    prev_params = params
+    for (_, train_state, E_loc, _), (_, train_state_pl, E_loc_pl, _) in zip(*results):
+        assert jnp.allclose(E_loc, E_loc_pl, atol=1e-6)
+        assert jax.tree_util.tree_all(
+            jax.tree_util.tree_map(
+                partial(jnp.allclose, atol=1e-5),
+                train_state.params,
+                train_state_pl.params,
+            )
+        )
+        # the walkers are weighted by the ratio of the wave functions with the
+        # parameters of the optimizer step and of the initial sampling
+        log_weight = 2 * (log_psi(prev_params) - log_psi_init)
+        assert jnp.allclose(
+            train_state_pl.sampler['log_weight'][0],
+            log_weight - log_weight.max(),
+            atol=1e-5,
+        )
+        prev_params = train_state_pl.params
+    assert not jnp.allclose(log_weight, 0)
+
+
+@pytest.mark.parametrize(
+    'opt',
+    [optax.adam(1e-2), partial(kfac_jax.Optimizer, **OPT_KWARGS['kfac'])],
+    ids=['adam', 'kfac'],
+)
+def test_fused_fit(helpers, opt):
+    mol = helpers.mol('H2')
+    hamil = helpers.hamil(mol)
+    ansatz, _ = helpers.create_ansatz(hamil)
+    sampler = MultimoleculeSampler(MetropolisSampler(hamil, tau=0.1), [mol])
+    # the buffers of the parameters are donated to the next step by KFAC
+    results = [
+        [
+            jax.device_get(result)
+            for result in fit_wf(
+                helpers.rng(),
+                hamil,
+                ansatz,
+                opt,
+                sampler,
+                8,
+                range(3),
+                fused_steps=fused_steps,
+            )
+        ]
+        for fused_steps in [None, 2]
+    ]
+    unfused = {step: result for step, *result in results[0]}
+    close = partial(jnp.allclose, atol=1e-5)
+    # the last block contains a single step
+    assert [step for step, *_ in results[1]] == [1, 2]
+    for step, train_state, E_locs, stats in results[1]:
+        train_state_ref, E_loc_ref, stats_ref = unfused[step]
+        assert jax.tree_util.tree_all(
+            jax.tree_util.tree_map(close, train_state.params, train_state_ref.params)
+        )
+        assert close(E_locs[-1], E_loc_ref)
+        assert close(E_locs[0], unfused[step - len(E_locs) + 1][1])
+        assert close(stats['psi'].log[-1], train_state_ref.sampler['psi'].log)
+        assert close(
+            stats['per_mol']['sampling/acceptance'],
+            stats_ref['per_mol']['sampling/acceptance'],
+        )
@@ -57,3 +57,18 @@ class TestGNN:
         ndarrays_regression.check(
             {'embedding': emb}, default_tolerance={'rtol': 1e-4, 'atol': 1e-6}
         )
+
+    def test_dense_edges(self, helpers):
+        mol = helpers.mol()
+        hamil = helpers.hamil(mol)
+        phys_conf = helpers.phys_conf(hamil)
+        _gnn = helpers.init_conf('gnn')
+        gnn = helpers.transform_model(_gnn, mol, 8)
+        dense_gnn = helpers.transform_model(_gnn, mol, 8, dense_edges=True)
+        params = helpers.init_model(gnn, phys_conf)
+        assert jnp.allclose(
+            dense_gnn.apply(params, phys_conf),
+            gnn.apply(params, phys_conf),
+            rtol=1e-5,
+            atol=1e-6,
+        )
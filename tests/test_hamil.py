@@ -1,5 +1,6 @@
 from functools import partial
 
+import jax.numpy as jnp
 import pytest
 
 from deepqmc.hamil import MolecularHamiltonian
@@ -32,3 +33,16 @@ class TestHamil:
             {'E_loc': E_loc},
             default_tolerance={'rtol': 2e-4},
         )
+
+    def test_shared_geometry(self, helpers, hamil, mol_kwargs):
+        hamil = helpers.hamil(helpers.mol(**mol_kwargs))
+        phys_conf = helpers.phys_conf(hamil)
+        wf, params = helpers.create_ansatz(hamil)
+        E_loc, _ = hamil.local_energy(partial(wf.apply, params))(
+            helpers.rng(), phys_conf
+        )
+        # the wave function evaluates its own geometry
+        E_loc_own, _ = hamil.local_energy(
+            lambda phys_conf, geometry=None: wf.apply(params, phys_conf)
+        )(helpers.rng(), phys_conf)
+        assert jnp.allclose(E_loc, E_loc_own)
@@ -0,0 +1,40 @@
+import pickle
+
+import h5py
+import jax.numpy as jnp
+
+from deepqmc.fit import TrainState
+from deepqmc.log import H5LogWriter, load_checkpoint
+from deepqmc.trace import DECIMATED_LABELS
+
+
+def test_load_legacy_checkpoint(tmp_path):
+    states = [
+        {'r': jnp.full((4, 2, 3), i), 'tau': jnp.array(0.1 * i)} for i in range(3)
+    ]
+    path = tmp_path / 'chkpt-10.pt'
+    with path.open('wb') as f:
+        pickle.dump((10, TrainState(states, {'w': jnp.ones(2)}, None)), f)
+    step, train_state = load_checkpoint(path)
+    assert step == 10
+    assert train_state.sampler['r'].shape == (3, 4, 2, 3)
+    assert jnp.allclose(train_state.sampler['tau'], jnp.array([0.0, 0.1, 0.2]))
+    assert jnp.allclose(train_state.params['w'], 1)
+
+
+def test_resize_table(tmp_path):
+    with h5py.File(tmp_path / 'result.h5', 'w') as f:
+        writer = H5LogWriter(f)
+        table = writer.table(f)
+        for step in range(6):
+            table.row['E_ewm'] = jnp.array(float(step))
+            if not step % 2:
+                table.row['step'] = step
+                table.row['E_loc'] = jnp.full(3, float(step))
+            writer.step()
+        writer.close()
+        # the restart from step 3 keeps the decimated rows of steps 0 and 2
+        table.resize(3, DECIMATED_LABELS)
+        assert f['E_ewm'][:].tolist() == [0, 1, 2]
+        assert f['step'][:].tolist() == [0, 2]
+        assert f['E_loc'].shape == (2, 3)
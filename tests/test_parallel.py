@@ -0,0 +1,209 @@
+import os
+import subprocess
+import sys
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+import kfac_jax
+import optax
+import pytest
+
+from deepqmc.fit import TrainState, fit_wf, init_fit
+from deepqmc.sampling import (
+    LangevinSampler,
+    MetropolisSampler,
+    MultimoleculeSampler,
+    ResampledSampler,
+    chain,
+)
+from deepqmc.train import OPT_KWARGS
+
+requires_devices = pytest.mark.skipif(
+    jax.local_device_count() < 2, reason='requires multiple devices'
+)
+
+
+@pytest.mark.skipif(jax.local_device_count() > 1, reason='multiple devices present')
+def test_on_virtual_devices():
+    # multiple virtual CPU devices are used to test the sharded execution, the
+    # flag has to be set before the backend is initialized, so that the tests
+    # are run in a separate process
+    env = {
+        **os.environ,
+        'XLA_FLAGS': ' '.join(
+            [
+                os.environ.get('XLA_FLAGS', ''),
+                '--xla_force_host_platform_device_count=2',
+            ]
+        ),
+    }
+    result = subprocess.run(
+        [
+            sys.executable,
+            '-m',
+            'pytest',
+            '-q',
+            '-p',
+            'no:cacheprovider',
+            '-p',
+            'no:warnings',
+            __file__,
+        ],
+        cwd=os.path.dirname(__file__),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+
+
+@requires_devices
+@pytest.mark.parametrize(
+    'opt',
+    [optax.adam(1e-3), partial(kfac_jax.Optimizer, **OPT_KWARGS['kfac'])],
+    ids=['adam', 'kfac'],
+)
+def test_sharded_fit(helpers, opt):
+    mol = helpers.mol()
+    hamil = helpers.hamil(mol)
+    ansatz, params = helpers.create_ansatz(hamil)
+    sampler = MultimoleculeSampler(chain(MetropolisSampler(hamil, tau=0.1)), [mol, mol])
+    for _, train_state, E_loc, stats in fit_wf(  # noqa: B007
+        helpers.rng(), hamil, ansatz, opt, sampler, 8, range(2), sharded=True
+    ):
+        pass
+    # the training state holds all walkers and a single copy of the parameters
+    assert train_state.sampler['r'].shape == (2, 4, mol.n_up + mol.n_down, 3)
+    assert train_state.sampler['tau'].shape == (2,)
+    assert jax.tree_util.tree_all(
+        jax.tree_util.tree_map(
+            lambda x, y: x.shape == y.shape, params, train_state.params
+        )
+    )
+    assert E_loc.shape == (8,) and jnp.isfinite(E_loc).all()
+    assert stats['per_mol']['E_loc/mean'].shape == (2,)
+
+
+@requires_devices
+def test_sharded_langevin_local_energy(helpers):
+    mol = helpers.mol()
+    hamil = helpers.hamil(mol)
+    ansatz, params = helpers.create_ansatz(hamil)
+    smpl_state = MultimoleculeSampler(MetropolisSampler(hamil), [mol, mol]).init(
+        helpers.rng(), partial(ansatz.apply, params), 8
+    )
+    sampler = MultimoleculeSampler(
+        LangevinSampler(hamil, tau=0.1, local_energy=True), [mol, mol]
+    )
+    # the walkers of the training are taken over by the sampler
+    for _, train_state, E_loc, _ in fit_wf(  # noqa: B007
+        helpers.rng(),
+        hamil,
+        ansatz,
+        None,
+        sampler,
+        8,
+        range(2),
+        (smpl_state, params, None),
+        sharded=True,
+    ):
+        pass
+    assert train_state.sampler['energy_rng'].shape == (2, 4, 2)
+    # the keys of the local energies differ between the walkers of all devices
+    assert (
+        len(jnp.unique(train_state.sampler['energy_rng'].reshape(-1, 2), axis=0)) == 8
+    )
+    assert E_loc.shape == (8,) and jnp.isfinite(E_loc).all()
+
+
+@requires_devices
+def test_sharded_fit_equals_unsharded(helpers):
+    mol = helpers.mol('H2')
+    hamil = helpers.hamil(mol)
+    ansatz, _ = helpers.create_ansatz(hamil)
+    # the walkers are not moved, so that the sampled walkers are independent of
+    # the random keys, which differ between the devices, while the weights of
+    # the walkers change with the parameters
+    sampler = MultimoleculeSampler(
+        chain(ResampledSampler(period=10), MetropolisSampler(hamil, tau=0.0)),
+        [mol, mol],
+    )
+    results = [
+        list(
+            fit_wf(
+                helpers.rng(),
+                hamil,
+                ansatz,
+                optax.adam(1e-2),
+                sampler,
+                8,
+                range(3),
+                sharded=sharded,
+            )
+        )
+        for sharded in [False, True]
+    ]
+    # the rounding errors are amplified by Adam for the parameters with small
+    # gradients
+    close = partial(jnp.allclose, atol=1e-5)
+    for (_, *result), (_, *result_sharded) in zip(*results):
+        assert jax.tree_util.tree_all(
+            jax.tree_util.tree_map(close, result, result_sharded)
+        )
+    train_state = result[0]
+    assert not jnp.allclose(train_state.sampler['log_weight'], 0)
+
+
+@requires_devices
+def test_sharded_resampling(helpers):
+    mol = helpers.mol('H2')
+    hamil = helpers.hamil(mol)
+    ansatz, _ = helpers.create_ansatz(hamil)
+
+    def sampler(period):
+        return MultimoleculeSampler(
+            chain(ResampledSampler(period=period), MetropolisSampler(hamil, tau=0.0)),
+            [mol, mol],
+        )
+
+    params, smpl_state = init_fit(helpers.rng(), hamil, ansatz, sampler(1), 8)
+    # the walkers of each device are identical, such that resampling them
+    # separately on each device leaves the weighted walkers unchanged, while the
+    # weights differ between the devices
+    r = smpl_state['r']
+    smpl_state['r'] = jnp.concatenate(
+        [jnp.repeat(r[:, :1], 2, axis=1), jnp.repeat(r[:, 2:3], 2, axis=1)], axis=1
+    )
+    smpl_state = sampler(1).update(smpl_state, partial(ansatz.apply, params))
+    smpl_state['log_weight'] = jnp.zeros_like(smpl_state['log_weight'])
+    results = [
+        list(
+            fit_wf(
+                helpers.rng(),
+                hamil,
+                ansatz,
+                # unlike Adam, SGD does not amplify the rounding errors of the
+                # vanishing gradients of the scale of the wave function
+                optax.sgd(3e-2),
+                sampler(period),
+                8,
+                range(3),
+                TrainState(smpl_state, params, None),
+                sharded=sharded,
+            )
+        ) for period, sharded in [(10, False), (1, True)]
+    ]
+    # the weights of the devices lead to small differences of the parameters
+    close = partial(jnp.allclose, rtol=0, atol=1e-9)
+    for (_, train_state, *_), (_, train_state_sharded, *_) in zip(*results):
+        assert jax.tree_util.tree_all(
+            jax.tree_util.tree_map(
+                close, train_state.params, train_state_sharded.params
+            )
+        )
+    # the walkers are resampled in every step, after which the weights differ
+    # only between the devices
+    log_weight = train_state_sharded.sampler['log_weight']
+    assert (train_state_sharded.sampler['step'] == 0).all()
+    assert not jnp.allclose(log_weight[:, 0], log_weight[:, -1])
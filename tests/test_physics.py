@@ -1,6 +1,16 @@
+from functools import partial
+
+import jax
+import jax.numpy as jnp
 import pytest
 
-from deepqmc.physics import local_potential, nonlocal_potential
+from deepqmc import MolecularHamiltonian
+from deepqmc.physics import (
+    hutchinson_laplacian,
+    laplacian,
+    local_potential,
+    nonlocal_potential,
+)
 
 
 @pytest.mark.parametrize('pp_type', [None, 'bfd', 'ccECP'])
@@ -25,3 +35,108 @@ class TestPhysics:
         )
         # note: nonlocal_potential is not particularly
         # numerically stable, hence the large tolerance
+
+    def test_locality_approximation(self, helpers, name, pp_type, ndarrays_regression):
+        if not pp_type:
+            pytest.skip('No pseudopotential')
+        mol = helpers.mol(name, pp_type)
+        hamil = helpers.hamil(mol)
+        phys_conf = helpers.phys_conf(hamil)
+        _wf, params = helpers.create_ansatz(hamil)
+        wf = lambda phys_conf, **kwargs: _wf.apply(params, phys_conf, **kwargs)
+        ndarrays_regression.check(
+            {
+                'nonlocal_potential': nonlocal_potential(
+                    helpers.rng(), phys_conf, mol, wf, wf_ratio='locality'
+                )
+            },
+            default_tolerance={'rtol': 2e-2, 'atol': 1e-8},
+        )
+
+    def test_screening(self, helpers, name, pp_type):
+        if not pp_type:
+            pytest.skip('No pseudopotential')
+        mol = helpers.mol(name, pp_type)
+        hamil = helpers.hamil(mol)
+        phys_conf = helpers.phys_conf(hamil)
+        _wf, params = helpers.create_ansatz(hamil)
+        wf = lambda phys_conf: _wf.apply(params, phys_conf)
+        V_nl = nonlocal_potential(helpers.rng(), phys_conf, mol, wf)
+        V_nl_screened = nonlocal_potential(
+            helpers.rng(), phys_conf, mol, wf, screening_tol=1e-10
+        )
+        assert jnp.allclose(V_nl_screened, V_nl, rtol=1e-5, atol=1e-8)
+
+
+@pytest.mark.parametrize('pp_type', ['bfd', 'ccECP'])
+def test_locality_approximation_exact(helpers, pp_type):
+    mol = helpers.mol('LiH', pp_type)
+    hamil = helpers.hamil(mol)
+    phys_conf = helpers.phys_conf(hamil)
+    # without the Jastrow factor, the backflow and the cusps the locality
+    # approximation is exact
+    _wf = helpers.transform_model(
+        partial(helpers.init_conf('ansatz'), omni_factory=None, cusp_electrons=False),
+        hamil,
+    )
+    params = helpers.init_model(_wf, phys_conf)
+    wf = lambda phys_conf, **kwargs: _wf.apply(params, phys_conf, **kwargs)
+    V_nl, V_nl_locality = (
+        nonlocal_potential(helpers.rng(), phys_conf, mol, wf, wf_ratio=wf_ratio)
+        for wf_ratio in ['exact', 'locality']
+    )
+    assert jnp.allclose(V_nl_locality, V_nl, rtol=1e-4, atol=1e-6)
+
+
+def test_screening_capacity(helpers):
+    mol = helpers.mol('LiH', 'bfd')
+    hamil = helpers.hamil(mol)
+    phys_conf = helpers.phys_conf(hamil, n=16)
+    _wf, params = helpers.create_ansatz(hamil)
+    wf = partial(_wf.apply, params)
+
+    def screened(capacity):
+        return jax.vmap(
+            lambda phys_conf: nonlocal_potential(
+                helpers.rng(),
+                phys_conf,
+                mol,
+                wf,
+                screening_tol=1e-3,
+                screening_capacity=capacity,
+                return_overflow=True,
+            )
+        )(phys_conf)
+
+    V_nl, n_overflow = screened(1)
+    V_nl_all, n_overflow_all = screened(len(phys_conf.r[0]))
+    assert (n_overflow_all == 0).all()
+    # the results agree if the capacity suffices, and the electrons exceeding it
+    # are reported otherwise
+    assert (n_overflow > 0).any() and (n_overflow == 0).any()
+    ok = n_overflow == 0
+    assert jnp.allclose(V_nl[ok], V_nl_all[ok])
+    assert not jnp.isclose(V_nl[~ok], V_nl_all[~ok]).any()
+    hamil = MolecularHamiltonian(
+        mol=mol, nonlocal_kwargs={'screening_tol': 1e-3, 'screening_capacity': 1}
+    )
+    _, stats = jax.vmap(hamil.local_energy(wf))(
+        jax.random.split(helpers.rng(), 16), phys_conf
+    )
+    assert (stats['hamil/V_nl_overflow'] == n_overflow).all()
+
+
+@pytest.mark.parametrize('probes', ['rademacher', 'gaussian'])
+def test_hutchinson_laplacian(helpers, probes):
+    def f(x):
+        return jnp.sum(jnp.sin(x) * x**2) + jnp.prod(jnp.cos(x))
+
+    x = jax.random.normal(helpers.rng(), (6,))
+    lap_exact, grad_exact = laplacian(f)(x)
+    lap, grad = jax.vmap(
+        lambda rng: hutchinson_laplacian(f, rng, n_probes=1, probes=probes)(x)
+    )(jax.random.split(helpers.rng(1), 4000))
+    assert jnp.allclose(grad, grad_exact, rtol=1e-5)
+    # the mean of the estimates agrees with the exact Laplacian within its error
+    assert jnp.abs(lap.mean() - lap_exact) < 4 * lap.std() / jnp.sqrt(len(lap))
+    assert lap.std() > 0
@@ -0,0 +1,44 @@
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import pytest
+
+from deepqmc.gnn import ElectronGNN
+from deepqmc.precision import (
+    precision_drift,
+    restore_precision_policy,
+    set_precision_policy,
+)
+
+BF16 = 'params=float32,compute=bfloat16,output=float32'
+
+
+@pytest.fixture
+def precision():
+    previous = []
+    yield lambda policies: previous.append(set_precision_policy(policies))
+    for prev in reversed(previous):
+        restore_precision_policy(prev)
+
+
+def test_precision_drift(helpers, precision):
+    hamil = helpers.hamil(helpers.mol('H2'))
+    ansatz, params = helpers.create_ansatz(hamil)
+    phys_conf = helpers.phys_conf(hamil, n=8)
+    drift = precision_drift(helpers.rng(), hamil, ansatz, params, phys_conf)
+    assert all(v == 0 for v in drift.values())
+    precision({'gnn': BF16, 'envelope': BF16})
+    drift = precision_drift(helpers.rng(), hamil, ansatz, params, phys_conf)
+    # the drift is of the order of the resolution of bfloat16
+    assert 0 < drift['log_psi/max_drift'] < 0.1
+    assert jnp.isfinite(drift['E_loc/max_drift'])
+
+
+def test_restore_precision_policy():
+    enable_x64 = jax.config.jax_enable_x64
+    previous = set_precision_policy({'gnn': BF16, 'energy': 'float64'})
+    assert hk.mixed_precision.get_policy(ElectronGNN) is not None
+    assert jax.config.jax_enable_x64
+    restore_precision_policy(previous)
+    assert hk.mixed_precision.get_policy(ElectronGNN) is None
+    assert jax.config.jax_enable_x64 == enable_x64
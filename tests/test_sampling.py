@@ -1,5 +1,9 @@
 from functools import partial
+from statistics import mean, stdev
 
+import haiku as hk
+import jax
+import jax.numpy as jnp
 import pytest
 
 from deepqmc.sampling import (
@@ -8,8 +12,13 @@ from deepqmc.sampling import (
     MetropolisSampler,
     MultimoleculeSampler,
     ResampledSampler,
+    SingleElectronMetropolisSampler,
     chain,
+    equilibrate,
+    sherman_morrison_update,
 )
+from deepqmc.physics import pairwise_self_distance
+from deepqmc.utils import residual_resampling, stratified_resampling
 
 
 @pytest.fixture(scope='class')
@@ -26,14 +35,27 @@ def wf(helpers, request):
     [
         (partial(MetropolisSampler, tau=0.1),),
         (partial(LangevinSampler, tau=0.1),),
+        (partial(SingleElectronMetropolisSampler, tau=0.1),),
         (DecorrSampler(length=20), partial(MetropolisSampler, tau=0.1, max_age=20)),
         (
             ResampledSampler(period=3),
             DecorrSampler(length=20),
             partial(MetropolisSampler, tau=0.1),
         ),
+        (
+            ResampledSampler(period=3, resampling='systematic'),
+            DecorrSampler(length=20),
+            partial(MetropolisSampler, tau=0.1),
+        ),
+    ],
+    ids=[
+        'Metropolis',
+        'Langevin',
+        'SingleElectronMetropolis',
+        'DecorrMetropolis',
+        'ResampledDecorrMetropolis',
+        'SystematicResampledDecorrMetropolis',
     ],
-    ids=['Metropolis', 'Langevin', 'DecorrMetropolis', 'ResampledDecorrMetropolis'],
 )
 @pytest.mark.usefixtures('wf')
 class TestSampling:
@@ -63,6 +85,26 @@ class TestSampling:
             default_tolerance={'rtol': 5e-4, 'atol': 1e-6},
         )
 
+    def test_sampler_stats_level(self, helpers, samplers):
+        sampler = chain(*samplers[:-1], samplers[-1](self.hamil))
+        smpl_state = sampler.init(
+            helpers.rng(), self.wf, self.SAMPLE_SIZE, self.mol.coords
+        )
+        results = {
+            stats_level: sampler.sample(
+                helpers.rng(),
+                smpl_state,
+                self.wf,
+                self.mol.coords,
+                stats_level=stats_level,
+            )
+            for stats_level in ['none', 'cheap', 'full']
+        }
+        assert helpers.pytree_allclose(results['none'][0], results['full'][0])
+        assert not results['none'][2]
+        assert 'sampling/dists/mean' not in results['cheap'][2]
+        assert set(results['cheap'][2]) < set(results['full'][2])
+
 
 @pytest.mark.parametrize(
     'samplers',
@@ -103,3 +145,92 @@ class TestMultimoleculeSampling:
             helpers.flatten_pytree({'smpl_state': smpl_state, 'stats': stats}),
             default_tolerance={'rtol': 5e-4, 'atol': 1e-6},
         )
+
+
+def test_langevin_local_energy(helpers):
+    hamil = helpers.hamil(helpers.mol())
+    _wf, params = helpers.create_ansatz(hamil)
+    wf = partial(_wf.apply, params)
+    sampler = LangevinSampler(hamil, tau=0.1, local_energy=True)
+    smpl_state = sampler.init(helpers.rng(), wf, 10, hamil.mol.coords)
+    for step in range(2):
+        smpl_state, phys_conf, _ = sampler.sample(
+            helpers.rng(step), smpl_state, wf, hamil.mol.coords
+        )
+    E_loc, _ = jax.vmap(hamil.local_energy(wf))(
+        jax.random.split(helpers.rng(), 10), phys_conf
+    )
+    assert jnp.allclose(smpl_state['E_loc'], E_loc, rtol=1e-4)
+
+
+def test_sherman_morrison_update(helpers):
+    rng_mat, rng_row = jax.random.split(helpers.rng())
+    mats = jax.random.normal(rng_mat, (3, 5, 5))
+    rows = jax.random.normal(rng_row, (3, 5))
+    inv, log_ratio = sherman_morrison_update(jnp.linalg.inv(mats), rows, 2)
+    new_mats = mats.at[:, 2].set(rows)
+    _, logdet = jnp.linalg.slogdet(mats)
+    _, new_logdet = jnp.linalg.slogdet(new_mats)
+    assert jnp.allclose(inv, jnp.linalg.inv(new_mats), rtol=1e-4, atol=1e-5)
+    assert jnp.allclose(log_ratio, new_logdet - logdet, atol=1e-5)
+
+
+@pytest.mark.parametrize('resampling', [stratified_resampling, residual_resampling])
+def test_resampling(helpers, resampling):
+    weights = jnp.array([0.05, 0.4, 0.15, 0.3, 0.1])
+    n_samples = 23
+    rngs = jax.random.split(helpers.rng(), 1000)
+    idxs = jax.vmap(lambda rng: resampling(rng, weights, n_samples))(rngs)
+    counts = jax.vmap(partial(jnp.bincount, length=len(weights)))(idxs)
+    expected = n_samples * weights
+    assert (counts.sum(axis=-1) == n_samples).all()
+    if resampling is stratified_resampling:
+        # each stratum contributes exactly one sample
+        assert (jnp.abs(counts - expected) < 2).all()
+    else:
+        # the deterministic copies are always kept
+        assert (counts >= jnp.floor(expected)).all()
+    assert jnp.allclose(counts.mean(axis=0), expected, atol=0.1)
+
+
+@pytest.mark.parametrize('report_every', [1, 4])
+def test_equilibrate(helpers, report_every):
+    mol = helpers.mol('H2')
+    hamil = helpers.hamil(mol)
+    _wf, params = helpers.create_ansatz(hamil)
+    wf = partial(_wf.apply, params)
+    sampler = MultimoleculeSampler(MetropolisSampler(hamil, tau=0.1), [mol])
+    smpl_state = sampler.init(helpers.rng(), wf, 10)
+    block_size, n_blocks = 3, 2
+
+    def criterion(phys_conf):
+        return pairwise_self_distance(phys_conf.r).mean()
+
+    # the equilibration returning to the host after each step
+    sample_wf = jax.jit(partial(sampler.sample, wave_function=wf))
+    state, buffer = smpl_state, []
+    for step, rng in zip(range(100), hk.PRNGSequence(helpers.rng(1))):  # noqa: B007
+        state, phys_conf, _ = sample_wf(rng, state, select_idxs=jnp.arange(10))
+        buffer = [*buffer[-block_size * n_blocks + 1 :], criterion(phys_conf).item()]
+        if len(buffer) < block_size * n_blocks:
+            continue
+        b1, b2 = buffer[:block_size], buffer[-block_size:]
+        if abs(mean(b1) - mean(b2)) < min(stdev(b1), stdev(b2)):
+            break
+    assert step < 99
+
+    for eq_step, eq_state, _ in equilibrate(  # noqa: B007
+        helpers.rng(1),
+        wf,
+        sampler,
+        smpl_state,
+        criterion,
+        range(100),
+        10,
+        block_size=block_size,
+        n_blocks=n_blocks,
+        report_every=report_every,
+    ):
+        pass
+    assert eq_step == step
+    assert helpers.pytree_allclose(eq_state, state)
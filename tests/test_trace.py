@@ -0,0 +1,70 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from deepqmc.trace import blocking_error, init_blocking, init_trace, update_blocking
+
+
+def test_blocking(helpers):
+    xs = jax.random.normal(helpers.rng(), (100,))
+    state = init_blocking(8)
+    for x in xs:
+        state = update_blocking(x, state)
+    xs = np.asarray(xs, dtype=np.float64)
+    for level, error in enumerate(blocking_error(state)):
+        # the averages over the complete blocks of 2^level consecutive values
+        n = len(xs) // 2**level
+        assert state.n[level] == n
+        if n > 1:
+            blocks = xs[: n * 2**level].reshape(n, -1).mean(axis=-1)
+            assert np.isclose(error, blocks.std() / np.sqrt(n - 1), rtol=1e-4)
+        else:
+            assert jnp.isnan(error)
+
+
+@pytest.fixture
+def walkers(helpers):
+    rng_E, rng_psi = jax.random.split(helpers.rng())
+    E_loc = jax.random.normal(rng_E, (10,))
+    log_psi = jax.random.normal(rng_psi, (10,))
+    return E_loc, jnp.sign(E_loc), log_psi
+
+
+def test_full_trace(walkers):
+    state, update = init_trace('full')
+    _, rows = update(0, *walkers, state)
+    assert set(rows) == {'E_loc', 'sign_psi', 'log_psi'}
+    assert jnp.allclose(rows['E_loc'], walkers[0])
+
+
+def test_decimated_trace(walkers):
+    state, update = init_trace('decimated', every=2, n_walkers=3)
+    assert update(1, *walkers, state)[1] == {}
+    _, rows = update(2, *walkers, state)
+    assert rows['step'] == 2
+    assert jnp.allclose(rows['E_loc'], walkers[0][:3])
+    assert rows['log_psi'].shape == (3,)
+
+
+def test_summarized_trace(walkers):
+    E_loc = walkers[0]
+    state, update = init_trace('summarized', quantiles=(0.0, 0.5, 1.0), n_bins=4)
+    for step in range(2):
+        state, rows = update(step, *walkers, state)
+    assert jnp.allclose(rows['E_loc_mean'], E_loc.mean())
+    assert jnp.allclose(rows['E_loc_std'], E_loc.std())
+    assert jnp.allclose(
+        rows['E_loc_quantiles'], jnp.quantile(E_loc, jnp.array([0, 0.5, 1]))
+    )
+    assert rows['E_loc_hist'].sum() == len(E_loc)
+    assert jnp.allclose(rows['E_loc_hist_range'], jnp.array([E_loc.min(), E_loc.max()]))
+    assert jnp.allclose(rows['sign_psi_mean'], walkers[1].mean())
+    # two identical steps have a vanishing error of the mean
+    assert jnp.isclose(rows['E_loc_blocking_error'][0], 0, atol=1e-5)
+    assert jnp.isnan(rows['E_loc_blocking_error'][1:]).all()
+
+
+def test_unknown_trace_mode():
+    with pytest.raises(ValueError):
+        init_trace('sparse')
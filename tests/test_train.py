@@ -0,0 +1,70 @@
+import logging
+
+import h5py
+import haiku as hk
+
+from deepqmc.gnn import ElectronGNN
+from deepqmc.sampling import MetropolisSampler
+from deepqmc.train import train
+
+
+def test_stochastic_laplacian_switch(helpers, caplog, tmp_path):
+    hamil = helpers.hamil(helpers.mol('H2'))
+    ansatz, _ = helpers.create_ansatz(hamil)
+    with caplog.at_level(logging.INFO, logger='deepqmc.train'):
+        train(
+            hamil,
+            ansatz,
+            'adam',
+            MetropolisSampler(hamil, tau=0.1),
+            steps=4,
+            sample_size=4,
+            seed=0,
+            workdir=str(tmp_path),
+            max_eq_steps=1,
+            stochastic_laplacian={'n_probes': 1, 'until_step': 2},
+            trace_kwargs={'mode': 'decimated'},
+        )
+    assert 'Switching to the exact Laplacian after step 1' in caplog.messages
+    assert 'The training has been completed!' in caplog.messages
+    # the exact Laplacian continues with the step after the switch
+    with h5py.File(tmp_path / 'training' / 'result.h5') as f:
+        assert f['step'][:].tolist() == [0, 1, 2, 3]
+
+
+def test_precision_policy_restored(helpers):
+    hamil = helpers.hamil(helpers.mol('H2'))
+    ansatz, _ = helpers.create_ansatz(hamil)
+    train(
+        hamil,
+        ansatz,
+        'adam',
+        MetropolisSampler(hamil, tau=0.1),
+        steps=1,
+        sample_size=4,
+        seed=0,
+        max_eq_steps=1,
+        precision={'gnn': 'params=float32,compute=bfloat16,output=float32'},
+    )
+    assert hk.mixed_precision.get_policy(ElectronGNN) is None
+
+
+def test_fused_train(helpers, tmp_path):
+    hamil = helpers.hamil(helpers.mol('H2'))
+    ansatz, _ = helpers.create_ansatz(hamil)
+    train(
+        hamil,
+        ansatz,
+        'adam',
+        MetropolisSampler(hamil, tau=0.1),
+        steps=3,
+        sample_size=4,
+        seed=0,
+        workdir=str(tmp_path),
+        max_eq_steps=1,
+        fit_kwargs={'fused_steps': 2},
+        log_every=2,
+    )
+    # a row is written for every step of the fused blocks
+    with h5py.File(tmp_path / 'training' / 'result.h5') as f:
+        assert len(f['E_loc']) == 3
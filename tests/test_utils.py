@@ -0,0 +1,18 @@
+import jax
+import jax.numpy as jnp
+import pytest
+
+from deepqmc.utils import chunked_vmap
+
+
+@pytest.mark.parametrize('n', [12, 10, 3], ids=['divisible', 'rest', 'single'])
+def test_chunked_vmap(helpers, n):
+    def f(x, y):
+        return {'sum': jnp.sum(x * y['a']), 'outer': jnp.outer(x, y['b'])}
+
+    rng_x, rng_a, rng_b = jax.random.split(helpers.rng(), 3)
+    x = jax.random.normal(rng_x, (n, 5))
+    y = {'a': jax.random.normal(rng_a, (n, 5)), 'b': jax.random.normal(rng_b, (n, 2))}
+    expected = jax.vmap(f)(x, y)
+    for chunked in [chunked_vmap(f, 4), jax.jit(chunked_vmap(f, 4)), chunked_vmap(f)]:
+        assert helpers.pytree_allclose(chunked(x, y), expected)
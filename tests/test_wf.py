@@ -1,7 +1,8 @@
 import jax_dataclasses as jdc
+import pytest
 from jax import grad
 
-from deepqmc.physics import laplacian
+from deepqmc.physics import LAPLACIANS
 
 
 class TestNeuralNetworkWaveFunction:
@@ -23,14 +24,16 @@ class TestNeuralNetworkWaveFunction:
             default_tolerance={'rtol': 1e-3, 'atol': 1e-5},
         )
 
-    def test_laplace_psi(self, helpers, ndarrays_regression):
+    @pytest.mark.parametrize('laplacian', ['hvp', 'forward'])
+    def test_laplace_psi(self, helpers, laplacian, ndarrays_regression):
         hamil = helpers.hamil()
         phys_conf = helpers.phys_conf(hamil)
         wf, params = helpers.create_ansatz(hamil)
-        lap_log_psis, quantum_force = laplacian(
+        lap_log_psis, quantum_force = LAPLACIANS[laplacian](
             lambda r: wf.apply(params, jdc.replace(phys_conf, r=r.reshape(-1, 3))).log
         )(phys_conf.r.flatten())
         ndarrays_regression.check(
             {'lap_log_psis': lap_log_psis, 'quantum_force': quantum_force},
+            basename='test_laplace_psi',
             default_tolerance={'rtol': 1e-3, 'atol': 1e-5},
         )